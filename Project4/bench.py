@@ -0,0 +1,201 @@
+# Project 4
+# Library Management
+# bench.py
+"""
+Rough benchmarks for the library persistence layer.
+Run from this folder, e.g.:
+    python bench.py codecs --books 100000 --loans 200000
+    python bench.py memory --loans 1000000
+    python bench.py http --clients 32 --seconds 10
+Nothing here is imported by main.py or the tests.
+"""
+
+import argparse
+import dataclasses
+import gc
+import http.client
+import json
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from main import LibraryApp, Loan, SNAPSHOT_CODECS, convert_snapshot, _LoanColumns
+
+
+def build_library(state_path: Path, books: int, patrons: int, loans: int) -> LibraryApp:
+    app = LibraryApp(state_path=state_path)
+    book_ids = [app.add_book(f"Title {i}", f"Author {i % 5000}", 1900 + i % 120, copies=3).id for i in range(books)]
+    patron_ids = [app.add_patron(f"Patron {i}", f"patron{i}@example.com").id for i in range(patrons)]
+    for i in range(loans):
+        book_id = book_ids[i % books]
+        if app.books[book_id].copies_available == 0:
+            continue
+        loan = app.checkout_book(book_id, patron_ids[i % patrons])
+        if i % 3:
+            app.return_book(loan.id)
+    return app
+
+
+def timed(label: str, fn):
+    start = time.perf_counter()
+    result = fn()
+    print(f"  {label:<28} {time.perf_counter() - start:8.3f} s")
+    return result
+
+
+def open_summary(path: Path, **options) -> dict:
+    app = LibraryApp(state_path=path, **options)
+    try:
+        return app.summary()
+    finally:
+        app.close()
+
+
+def bench_codecs(args) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        print(f"Building library: {args.books} books, {args.patrons} patrons, {args.loans} loans")
+        app = build_library(tmp / "state.json", args.books, args.patrons, args.loans)
+        sizes = {}
+        for name in SNAPSHOT_CODECS:
+            path = tmp / f"state.{name}"
+            app.codec = SNAPSHOT_CODECS[name]
+            print(f"{name}:")
+            timed("save", lambda: app.save_state(path))
+            timed("load", lambda: LibraryApp(state_path=path))
+            timed("lazy open", lambda: LibraryApp(state_path=path, lazy=True).close())
+            timed("load + summary", lambda: open_summary(path))
+            timed("lazy open + summary", lambda: open_summary(path, lazy=True))
+            sizes[name] = path.stat().st_size
+            print(f"  {'size':<28} {sizes[name] / 1e6:8.2f} MB")
+        timed("convert json -> binary", lambda: convert_snapshot(tmp / "state.json", tmp / "conv.bin", "binary"))
+        print(f"binary is {sizes['json'] / sizes['binary']:.1f}x smaller than json")
+
+
+def measured(label: str, count: int, build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"  {label:<28} {used / count:8.1f} bytes/loan")
+    return result
+
+
+def bench_memory(args) -> None:
+    # each representation is built from freshly decoded records, as a load would,
+    # so the cost of its id and date strings is counted too
+    DictLoan = dataclasses.make_dataclass(  # how Loan was stored before slots
+        "DictLoan", [(f.name, f.type) for f in dataclasses.fields(Loan)])
+    books = [Loan.create("", "").id for _ in range(max(1, args.loans // 20))]
+    patrons = [Loan.create("", "").id for _ in range(max(1, args.loans // 50))]
+    lines = []
+    for i in range(args.loans):
+        loan = Loan.create(books[i % len(books)], patrons[i % len(patrons)])
+        if i % 3:
+            loan.return_date = loan.loan_date
+        lines.append(json.dumps(loan.to_dict()))
+    print(f"{args.loans} loans:")
+    measured("dict of dataclasses", args.loans,
+             lambda: {rec["id"]: DictLoan(**rec) for rec in map(json.loads, lines)})
+    measured("dict of slotted Loan", args.loans,
+             lambda: {rec["id"]: Loan.from_dict(rec) for rec in map(json.loads, lines)})
+    store = measured("columnar _LoanColumns", args.loans,
+                     lambda: _LoanColumns(Loan.from_dict(rec) for rec in map(json.loads, lines)))
+    timed("scan columnar return dates", lambda: sum(1 for loan in store.values() if loan.return_date))
+
+
+def _call(conn: http.client.HTTPConnection, method: str, path: str, body=None):
+    conn.request(method, path, json.dumps(body) if body is not None else None,
+                 {"Content-Type": "application/json"})
+    response = conn.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def bench_http(args) -> None:
+    # load-test a running server (--url) or one started here on a temp state file
+    import server
+    tmp = None
+    local = None
+    if args.url:
+        parts = urlsplit(args.url)
+        host, port = parts.hostname, parts.port or 80
+    else:
+        tmp = tempfile.TemporaryDirectory()
+        local = server.LibraryServer(("127.0.0.1", 0), server.make_app(Path(tmp.name) / "state.json",
+                                                                       args.group_commit_window))
+        threading.Thread(target=local.serve_forever, daemon=True).start()
+        host, port = local.server_address
+        print(f"Started a local server on port {port} (group commit window {args.group_commit_window}s)")
+    setup = http.client.HTTPConnection(host, port)
+    books = [_call(setup, "POST", "/books", {"title": f"Load {i}", "author": "Bench", "year": 2000,
+                                             "copies": 1000000})[1]["id"] for i in range(args.books)]
+    patrons = [_call(setup, "POST", "/patrons", {"name": f"Terminal {i}", "email": f"t{i}@example.com"})[1]["id"]
+               for i in range(args.clients)]
+    setup.close()
+    latencies = [[] for _ in range(args.clients)]
+    deadline = time.perf_counter() + args.seconds
+
+    def terminal(n: int) -> None:
+        rng = random.Random(n)
+        conn = http.client.HTTPConnection(host, port)  # one keep-alive connection per terminal
+        out = []
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            if out and rng.random() < 0.5:
+                status, _ = _call(conn, "POST", f"/loans/{out.pop()}/return")
+            else:
+                status, loan = _call(conn, "POST", "/loans", {"book_id": rng.choice(books), "patron_id": patrons[n]})
+                out.append(loan["id"])
+            if status >= 400:
+                raise RuntimeError(f"request failed with {status}")
+            latencies[n].append(time.perf_counter() - start)
+        conn.close()
+
+    workers = [threading.Thread(target=terminal, args=(n,)) for n in range(args.clients)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+    done = sorted(x for per in latencies for x in per)
+    print(f"{len(done)} mutations from {args.clients} terminals in {elapsed:.1f} s: {len(done) / elapsed:,.0f} req/s")
+    print(f"  latency p50 {done[len(done) // 2] * 1000:.2f} ms, p99 {done[int(len(done) * 0.99)] * 1000:.2f} ms")
+    if local is not None:
+        local.shutdown()
+        local.server_close()
+        local.app.close()
+        tmp.cleanup()
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+    codecs = sub.add_parser("codecs", help="snapshot size and save/load time per codec")
+    codecs.add_argument("--books", type=int, default=50000)
+    codecs.add_argument("--patrons", type=int, default=5000)
+    codecs.add_argument("--loans", type=int, default=100000)
+    codecs.set_defaults(run=bench_codecs)
+    memory = sub.add_parser("memory", help="bytes per loan for each in-memory representation")
+    memory.add_argument("--loans", type=int, default=500000)
+    memory.set_defaults(run=bench_memory)
+    load = sub.add_parser("http", help="checkout/return throughput against the HTTP service")
+    load.add_argument("--url", help="a running server, e.g. http://127.0.0.1:8326 (default: start one here)")
+    load.add_argument("--clients", type=int, default=16)
+    load.add_argument("--books", type=int, default=100)
+    load.add_argument("--seconds", type=float, default=5.0)
+    load.add_argument("--group-commit-window", type=float, default=0.002)
+    load.set_defaults(run=bench_http)
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
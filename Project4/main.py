@@ -6,24 +6,77 @@
 Simple Library Management System .
 Provides:
 - Book / Patron / Loan classes
-- LibraryApp controller with persistence (JSON), CSV import/export
-- CLI demo when run directly
+- LibraryApp controller with pluggable persistence (JSON or compact binary snapshot +
+  optional append-only journal, or SQLite), CSV import/export
+- AsyncLibraryApp: asyncio facade that saves off the event loop
+- Scriptable command-line interface (single commands or a JSONL batch file)
+  and the interactive demo when run directly
 Uses pathlib, context managers, and explicit error handling.
 """
 
-from dataclasses import dataclass, asdict
-from datetime import datetime
+from dataclasses import dataclass, asdict, fields, field
+import dataclasses
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Optional, Dict, List
+import collections
+from collections.abc import MutableMapping
+from typing import Optional, Dict, List, Iterator, Tuple, Callable, TextIO, Iterable, Set
 import uuid
 import json
 import csv
+import io
+import sqlite3
+import re
+import struct
+import itertools
+import zlib
+import gzip
+import bz2
+import lzma
+import functools
+import inspect
+import typing
+import contextlib
+import operator
+import argparse
+import concurrent.futures
+import asyncio
+import bisect
+import heapq
+import math
+from array import array
+import os
+import tempfile
+import threading
+import time
+import sys
 
 # ---------------------------
 # Domain models
 # ---------------------------
 
-@dataclass
+# per-instance __dict__ dominates memory with millions of records; slots need 3.10+
+_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+# loan period in days per item type; other types lend like books
+LOAN_PERIODS: Dict[str, int] = {"book": 21, "dvd": 7, "magazine": 14}
+
+
+def loan_period(item_type: str) -> int:
+    return LOAN_PERIODS.get(item_type, LOAN_PERIODS["book"])
+
+
+@dataclass(frozen=True)
+class FineRate:
+    per_day: float = 0.25
+    max_days: int = 14  # the fine stops growing after this many days overdue
+
+
+# default fine schedule per item type; other types are fined like books
+FINE_RATES: Dict[str, FineRate] = {"book": FineRate()}
+
+
+@dataclass(**_SLOTS)
 class Book:
     id: str
     title: str
@@ -31,9 +84,12 @@ class Book:
     year: Optional[int]
     copies_total: int
     copies_available: int
+    isbn: Optional[str] = None
+    item_type: str = "book"
 
     @staticmethod
-    def create(title: str, author: str, year: Optional[int], copies: int = 1) -> "Book":
+    def create(title: str, author: str, year: Optional[int], copies: int = 1,
+               isbn: Optional[str] = None, item_type: str = "book") -> "Book":
         return Book(
             id=str(uuid.uuid4()),
             title=title,
@@ -41,210 +97,3388 @@ class Book:
             year=year,
             copies_total=copies,
             copies_available=copies,
+            isbn=isbn,
+            item_type=item_type,
+        )
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Book":
+        return cls(**data)
+
+
+@dataclass(**_SLOTS)
+class Patron:
+    id: str
+    name: str
+    email: str
+
+    @staticmethod
+    def create(name: str, email: str) -> "Patron":
+        return Patron(id=str(uuid.uuid4()), name=name, email=email)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Patron":
+        return cls(**data)
+
+
+@dataclass(**_SLOTS)
+class Loan:
+    id: str
+    book_id: str
+    patron_id: str
+    loan_date: str
+    return_date: Optional[str]
+    due_date: Optional[str] = None  # None on loans made before due dates existed
+
+    @staticmethod
+    def create(book_id: str, patron_id: str, loan_days: int = LOAN_PERIODS["book"]) -> "Loan":
+        now = datetime.utcnow()
+        return Loan(
+            id=str(uuid.uuid4()),
+            book_id=book_id,
+            patron_id=patron_id,
+            loan_date=now.isoformat(),
+            return_date=None,
+            due_date=(now + timedelta(days=loan_days)).isoformat(),
         )
 
-    def to_dict(self) -> dict:
-        return asdict(self)
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Loan":
+        return cls(**data)
+
+
+class BatchError(ValueError):
+    """A batch was rejected as a whole; `errors` maps item position -> reason."""
+
+    def __init__(self, errors: Dict[int, str]):
+        self.errors = errors
+        first = min(errors)
+        super().__init__(f"{len(errors)} of the batch rejected (item {first}: {errors[first]})")
+
+
+@dataclass
+class BatchResult:
+    loans: List[Loan] = field(default_factory=list)  # in request order, rejected items left out
+    errors: Dict[int, str] = field(default_factory=dict)  # item position -> reason
+
+
+# ---------------------------
+# Persistence & I/O
+# ---------------------------
+
+class PersistenceError(Exception):
+    pass
+
+
+def _atomic_write(path: Path, write, mode: str = "w") -> None:
+    """
+    Write `path` via a temp file in the same directory and rename it into
+    place, so readers see either the old file or the new one, never half.
+    """
+    encoding = None if "b" in mode else "utf-8"
+    fd, tmp = tempfile.mkstemp(prefix=path.name + ".", suffix=".tmp", dir=str(path.parent))
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    if os.name == "posix":
+        # make the rename itself durable
+        dir_fd = os.open(str(path.parent), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class _GroupCommit:
+    """
+    Lets many threads share one physical commit. The first caller becomes
+    the leader, waits `window` seconds for others to pile on, then runs the
+    commit once for everybody who arrived before it started.
+    """
+
+    class _Batch:
+        def __init__(self):
+            self.done = False
+            self.error: Optional[Exception] = None
+
+    def __init__(self, window: float = 0.0):
+        self.window = window
+        self._cond = threading.Condition()
+        self._pending: Optional["_GroupCommit._Batch"] = None
+        self._leading = False
+
+    def run(self, action) -> None:
+        with self._cond:
+            if self._pending is None:
+                self._pending = self._Batch()
+            batch = self._pending
+            while not batch.done and self._leading:
+                self._cond.wait()
+            if not batch.done:
+                self._leading = True
+        if not batch.done:
+            try:
+                if self.window > 0:
+                    time.sleep(self.window)
+                with self._cond:
+                    # seal the batch; later callers queue for the next commit
+                    self._pending = None
+                try:
+                    action()
+                except Exception as e:
+                    batch.error = e
+            finally:
+                with self._cond:
+                    batch.done = True
+                    self._leading = False
+                    self._cond.notify_all()
+        if batch.error is not None:
+            raise batch.error
+
+
+class _RWLock:
+    """
+    Shared/exclusive lock. Any number of threads may hold it shared at once;
+    an exclusive holder has it alone. Waiting exclusive callers block new
+    shared ones so they cannot starve. Re-entrant per thread, but a shared
+    hold cannot be upgraded to exclusive.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer: Optional[int] = None
+        self._writers_waiting = 0
+        self._depth = threading.local()
+
+    @contextlib.contextmanager
+    def shared(self):
+        depth = getattr(self._depth, "n", 0)
+        if not depth:
+            with self._cond:
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+                self._readers += 1
+        self._depth.n = depth + 1
+        try:
+            yield
+        finally:
+            self._depth.n = depth
+            if not depth:
+                with self._cond:
+                    self._readers -= 1
+                    if not self._readers:
+                        self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        depth = getattr(self._depth, "n", 0)
+        me = threading.get_ident()
+        if depth and self._writer != me:
+            raise RuntimeError("cannot take an exclusive lock while holding it shared")
+        if not depth:
+            with self._cond:
+                self._writers_waiting += 1
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._writers_waiting -= 1
+                self._writer = me
+        self._depth.n = depth + 1
+        try:
+            yield
+        finally:
+            self._depth.n = depth
+            if not depth:
+                with self._cond:
+                    self._writer = None
+                    self._cond.notify_all()
+
+    def held_exclusively(self) -> bool:
+        return self._writer == threading.get_ident()
+
+
+class _StripedLocks:
+    """A fixed pool of locks; a key always maps to the same one."""
+
+    def __init__(self, stripes: int = 64):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    @contextlib.contextmanager
+    def hold(self, *keys: str):
+        # in stripe order, so two callers holding overlapping keys cannot deadlock
+        locks = [self._locks[i] for i in sorted({hash(k) % len(self._locks) for k in keys})]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+
+class _Unlocked:
+    """Stands in for _RWLock/_StripedLocks/RLock when thread_safe is off."""
+
+    _none = contextlib.nullcontext()
+
+    def shared(self):
+        return self._none
+
+    exclusive = shared
+
+    def hold(self, *keys: str):
+        return self._none
+
+    def held_exclusively(self) -> bool:
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+def _guarded(mode: str):
+    """Run a LibraryApp method holding its state lock in `mode` ("shared" or "exclusive")."""
+    def wrap(method):
+        @functools.wraps(method)
+        def guarded(self, *args, **kwargs):
+            with getattr(self._state_lock, mode)():
+                return method(self, *args, **kwargs)
+        return guarded
+    return wrap
+
+
+class _IndexNotBuilt(Exception):
+    """A query under the shared lock needs a derived index nobody has built yet."""
+
+
+def _query(method):
+    """
+    Run a LibraryApp query under the shared state lock, reading its indexes
+    under the shared index lock. An index is only built with the state lock
+    held exclusively (no mutation half-applied), so the first query to need
+    one reruns that way.
+    """
+    @functools.wraps(method)
+    def query(self, *args, **kwargs):
+        try:
+            with self._state_lock.shared(), self._index_lock.shared():
+                return method(self, *args, **kwargs)
+        except _IndexNotBuilt:
+            pass
+        with self._state_lock.exclusive():
+            return method(self, *args, **kwargs)
+    return query
+
+
+class _Journal:
+    """
+    Append-only log of mutation records (one compact JSON object per line).
+    When the live log passes `compact_threshold` bytes it is rotated into a
+    segment file and folded into a fresh snapshot on a background thread.
+    There is never more than one segment: while one exists (its fold is
+    running, failed, or was cut short by an exit) the live log just keeps
+    growing, and a leftover segment is folded when the journal is opened.
+    """
+
+    def __init__(self, state_path: Path, compact_threshold: int, codec: "SnapshotCodec"):
+        self.state_path = state_path
+        self.codec = codec
+        self.segment_path, self.path = _journal_paths(state_path)
+        self.compact_threshold = compact_threshold
+        self._lock = threading.Lock()
+        self._compactor: Optional[threading.Thread] = None
+        self._compact_error: Optional[Exception] = None
+        self._f = self.path.open("a", encoding="utf-8")
+        if self.segment_path.exists():
+            # left by an earlier session; on failure it stays and is replayed on load
+            self._fold_segment()
+
+    def append(self, records: List[dict]) -> None:
+        lines = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records)
+        with self._lock:
+            self._f.write(lines)
+            self._f.flush()
+            if self._f.tell() >= self.compact_threshold:
+                self._rotate()
+
+    def sync(self) -> None:
+        with self._lock:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def _rotate(self) -> None:
+        # only one segment at a time; replacing an unfolded one would lose its records
+        if self.segment_path.exists():
+            return
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        os.replace(self.path, self.segment_path)
+        self._f = self.path.open("a", encoding="utf-8")
+        self._compactor = threading.Thread(target=self._fold_segment, name="journal-compactor", daemon=True)
+        self._compactor.start()
+
+    def _fold_segment(self) -> None:
+        # works purely on files so the live app keeps mutating while this runs
+        try:
+            data = {section: {} for section in _STATE_SECTIONS}
+            if self.state_path.exists():
+                for section, key, record in codec_for_file(self.state_path).records(self.state_path):
+                    data[section][key] = record
+            for rec in _read_journal(self.segment_path):
+                _apply_record_to_dicts(data, rec)
+            data = _current_records(data)
+            data["stats"] = _snapshot_stats(data)
+            _atomic_write(self.state_path, lambda f: self.codec.dump(f, data), "wb" if self.codec.binary else "w")
+            self.segment_path.unlink()
+        except Exception as e:
+            # segment stays on disk and is replayed on the next load
+            self._compact_error = e
+
+    def wait_for_compaction(self) -> None:
+        t = self._compactor
+        if t is not None:
+            t.join()
+        if self._compact_error is not None:
+            e, self._compact_error = self._compact_error, None
+            raise PersistenceError(f"Background compaction of {self.segment_path} failed: {e}")
+
+    def truncate(self) -> None:
+        """Drop all logged records (caller has just written a full snapshot)."""
+        with self._lock:
+            self._f.close()
+            if self.segment_path.exists():
+                self.segment_path.unlink()
+            self._f = self.path.open("w", encoding="utf-8")
+
+    def close(self) -> None:
+        try:
+            self.wait_for_compaction()
+        finally:
+            # a failed fold is reported, but the log must not be left open
+            with self._lock:
+                if not self._f.closed:
+                    self._f.close()
+
+
+def _journal_paths(state_path: Path) -> List[Path]:
+    # replay order: a rotated segment (fold still pending) before the live log
+    return [state_path.with_name(state_path.name + ".journal.1"),
+            state_path.with_name(state_path.name + ".journal")]
+
+
+def _read_journal(path: Path) -> Iterator[dict]:
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                # torn final write from a crash; everything before it is intact
+                break
+            yield json.loads(line)
+
+
+_STATE_SECTIONS = ("books", "patrons", "loans")
+_PROGRESS_EVERY = 10000
+# fast path for `"<plain key>": ` and the separator after a value
+_ENTRY_HEAD = re.compile(r'\s*"([^"\\]*)"\s*:\s*')
+_ENTRY_SEP = re.compile(r'\s*([,}])')
+
+
+class _JsonStateReader:
+    """
+    Incremental reader for the snapshot layout
+    {"books": {id: {...}}, "patrons": {...}, "loans": {...}}.
+    Yields one (section, id, record) at a time from a fixed-size buffer, so
+    the whole document never has to be parsed into memory at once.
+    `spans()` instead yields where each record sits in the file, keyed by
+    the id as written between its quotes.
+    """
+
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, f: TextIO, chunk_size: int = 1 << 16):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._buf = ""
+        self._pos = 0
+        self._base = 0  # file offset of self._buf[0]
+        self._eof = False
+
+    def _fill(self, size: int = 0) -> bool:
+        data = self._f.read(max(size, self._chunk_size))
+        if not data:
+            self._eof = True
+            return False
+        self._base += self._pos
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def _next_char(self) -> str:
+        while True:
+            buf, pos = self._buf, self._pos
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            self._pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of state file")
+
+    def _expect(self, ch: str) -> None:
+        got = self._next_char()
+        if got != ch:
+            raise ValueError(f"Expected {ch!r} at offset {self._pos}, found {got!r}")
+        self._pos += 1
+
+    def _value(self):
+        self._next_char()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # double what is buffered so a large value is re-parsed only O(log n) times
+                if self._fill(len(self._buf) - self._pos):
+                    continue
+                raise
+            if end == len(self._buf) and not self._eof and self._fill():
+                # a bare number could continue in the next chunk
+                continue
+            self._pos = end
+            return value
+
+    def _members(self) -> Iterator[str]:
+        """Iterate keys of the object starting at the cursor, leaving it on each value."""
+        self._expect("{")
+        if self._next_char() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            yield key
+            sep = self._next_char()
+            self._pos += 1
+            if sep == "}":
+                return
+            if sep != ",":
+                raise ValueError(f"Expected ',' or '}}' at offset {self._pos - 1}, found {sep!r}")
+
+    def _entries(self, decode: bool = True) -> Iterator[Tuple[str, Optional[dict], int, int]]:
+        """
+        Iterate (key, value, start, end) for the object at the cursor, where
+        start/end are file offsets of the value. With decode=False flat values
+        are only located, not parsed, and value is None; keys then come as
+        written between the quotes, escapes and all.
+        """
+        self._expect("{")
+        if self._next_char() == "}":
+            self._pos += 1
+            return
+        match_head, match_sep, decode_at = _ENTRY_HEAD.match, _ENTRY_SEP.match, self._decoder.raw_decode
+        while True:
+            buf = self._buf
+            head = match_head(buf, self._pos)
+            sep = None
+            if head is not None:
+                start = head.end()
+                value = None
+                end = -1
+                if not decode and buf.startswith("{", start):
+                    # flat record: the first '}' closes it unless a string is involved
+                    close = buf.find("}", start)
+                    if (close > 0 and buf.count('"', start, close) % 2 == 0
+                            and buf.find("\\", start, close) < 0 and buf.find("{", start + 1, close) < 0):
+                        end = close + 1
+                if end < 0:
+                    try:
+                        value, end = decode_at(buf, start)
+                    except json.JSONDecodeError:
+                        end = -1
+                if end >= 0:
+                    sep = match_sep(buf, end)
+            if sep is not None:
+                self._pos = sep.end()
+                yield head.group(1), value, self._base + start, self._base + end
+                if sep.group(1) == "}":
+                    return
+                continue
+            # slow path: entry straddles the buffer end or has an escaped key
+            self._next_char()
+            key_at = self._base + self._pos
+            key = self._value()
+            if not decode:
+                # refills keep the buffer from the key on, so its source is still there
+                key = self._buf[key_at - self._base + 1:self._pos - 1]
+            self._expect(":")
+            self._next_char()
+            start = self._base + self._pos
+            value = self._value()
+            end = self._base + self._pos
+            sep_ch = self._next_char()
+            self._pos += 1
+            yield key, (value if decode else None), start, end
+            if sep_ch == "}":
+                return
+            if sep_ch != ",":
+                raise ValueError(f"Expected ',' or '}}' at offset {self._pos - 1}, found {sep_ch!r}")
+
+    def __iter__(self) -> Iterator[Tuple[str, str, dict]]:
+        for section in self._members():
+            if section in _STATE_SECTIONS:
+                for key, value, _, _ in self._entries():
+                    yield section, key, value
+            else:
+                self._value()
+
+    def spans(self) -> Iterator[Tuple[str, str, int, int]]:
+        for section in self._members():
+            if section in _STATE_SECTIONS:
+                for key, _, start, end in self._entries(decode=False):
+                    yield section, key, start, end
+            else:
+                self._value()
+
+    def stats(self) -> Optional[dict]:
+        # written ahead of the records, so only the head of the file is read
+        for section in self._members():
+            return self._value() if section == "stats" else None
+        return None
+
+
+class _LazyTable(MutableMapping):
+    """
+    Dict-like view over one section of a state file. Only a (start, end, row)
+    span per id is kept up front; a record is read and turned into a model
+    the first time it is looked up, then cached. The last decoded chunk is
+    kept too, so neighbours stored in the same chunk are cheap.
+
+    The file is opened up front and held: spans are offsets into that
+    particular file, and a journal fold may rename a new snapshot over the
+    path at any time.
+    """
+
+    def __init__(self, path: Path, factory: Callable[[dict], object], spans: Dict[str, Tuple[int, int, int]],
+                 decode: Callable[[bytes], List[dict]]):
+        self._path = path
+        self._factory = factory
+        self._decode = decode
+        self._chunk_start = -1
+        self._chunk: List[dict] = []
+        self._spans = spans
+        self._loaded: Dict[str, object] = {}
+        self._added = 0  # keys in _loaded that the file never had
+        self._f = path.open("rb")
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        obj = self._loaded.get(key)
+        if obj is not None:
+            return obj
+        return self._loaded.setdefault(key, self._peek(key))
+
+    def _peek(self, key):
+        obj = self._loaded.get(key)
+        if obj is not None:
+            return obj
+        start, end, row = self._spans[key]
+        with self._lock:
+            if self._chunk_start != start:
+                self._f.seek(start)
+                self._chunk = self._decode(self._f.read(end - start))
+                self._chunk_start = start
+            record = self._chunk[row]
+        return self._factory(record)
+
+    def scan(self) -> Iterator:
+        """Every record, read-only: records not looked up yet are decoded but not cached."""
+        return map(self._peek, list(self))
+
+    def __setitem__(self, key, value) -> None:
+        if key not in self._loaded and key not in self._spans:
+            self._added += 1
+        self._loaded[key] = value
+
+    def __delitem__(self, key) -> None:
+        if key not in self:
+            raise KeyError(key)
+        if key not in self._spans:
+            self._added -= 1
+        self._spans.pop(key, None)
+        self._loaded.pop(key, None)
+
+    def __contains__(self, key) -> bool:
+        return key in self._loaded or key in self._spans
+
+    def __iter__(self):
+        yield from self._spans
+        if self._added:
+            for key in self._loaded:
+                if key not in self._spans:
+                    yield key
+
+    def __len__(self) -> int:
+        return len(self._spans) + self._added
+
+    def materialize(self) -> None:
+        """Load every remaining record and let go of the state file."""
+        for key in self._spans:
+            self[key]
+        self._spans = {}
+        self._added = len(self._loaded)
+        self._chunk_start, self._chunk = -1, []
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+
+# ---------------------------
+# Snapshot codecs
+# ---------------------------
+
+class SnapshotCodec:
+    """
+    How a full snapshot is laid out on disk. `dump` writes
+    {"books": {id: record}, "patrons": ..., "loans": ...}; `records` streams
+    it back one (section, id, record) at a time. For lazy tables `spans`
+    yields (section, id, start, end, row): the byte range of the chunk that
+    holds the record and its position in what `decoders()[section]` returns
+    for those bytes. `data` may also carry a "stats" entry (see
+    _snapshot_stats), written ahead of the records so `stats` can read it
+    back without touching them.
+    """
+
+    name = ""
+    binary = False
+
+    def dump(self, f, data: Dict[str, Dict[str, dict]]) -> None:
+        raise NotImplementedError
+
+    def records(self, path: Path) -> Iterator[Tuple[str, str, dict]]:
+        raise NotImplementedError
+
+    def models(self, path: Path) -> Iterator[Tuple[str, str, object]]:
+        """Like `records`, but each record already built into its section's model."""
+        factories = {name: model.from_dict for name, model in _MODELS}
+        for section, key, record in self.records(path):
+            yield section, key, factories[section](record)
+
+    def spans(self, path: Path) -> Iterator[Tuple[str, str, int, int, int]]:
+        raise NotImplementedError
+
+    def decoders(self, path: Path) -> Dict[str, Callable[[bytes], List[dict]]]:
+        raise NotImplementedError
+
+    def stats(self, path: Path) -> Optional[dict]:
+        return None
+
+
+class JsonCodec(SnapshotCodec):
+    """The original human-readable `indent=2` JSON snapshot."""
+
+    name = "json"
+
+    def dump(self, f, data: Dict[str, Dict[str, dict]]) -> None:
+        if "stats" in data:
+            data = {"stats": data["stats"], **data}
+        json.dump(data, f, indent=2)
+
+    def records(self, path: Path) -> Iterator[Tuple[str, str, dict]]:
+        with path.open("r", encoding="utf-8") as f:
+            yield from _JsonStateReader(f)
+
+    def spans(self, path: Path) -> Iterator[Tuple[str, str, int, int, int]]:
+        # latin-1 keeps one char per byte, so reader offsets are file offsets;
+        # keys come back as written, so UTF-8 and escapes are decoded here
+        with path.open("rb") as raw, io.TextIOWrapper(raw, encoding="latin-1") as f:
+            for section, key, start, end in _JsonStateReader(f).spans():
+                if not key.isascii() or "\\" in key:
+                    key = json.loads(f'"{key.encode("latin-1").decode("utf-8")}"')
+                yield section, key, start, end, 0
+
+    def decoders(self, path: Path) -> Dict[str, Callable[[bytes], List[dict]]]:
+        decode = lambda raw: [json.loads(raw.decode("utf-8"))]
+        return dict.fromkeys(_STATE_SECTIONS, decode)
+
+    def stats(self, path: Path) -> Optional[dict]:
+        with path.open("r", encoding="utf-8") as f:
+            return _JsonStateReader(f).stats()
+
+
+_BIN_MAGIC = b"LIBSNAP\x01"
+_BLOCK_ROWS = 4096
+_END_OF_BLOCKS = 0xFF
+_COL_STR, _COL_INT, _COL_UUID, _COL_TIME, _COL_JSON = range(5)
+_U8 = struct.Struct("<B")
+_U32 = struct.Struct("<I")
+_BLOCK_HEAD = struct.Struct("<BII")  # section index, rows, payload length
+_COLUMN_HEAD = struct.Struct("<BBI")  # column type, has nulls, data length
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_UUID_TEXT = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+class BinaryCodec(SnapshotCodec):
+    """
+    Compact struct-packed snapshot. Field names are stored once per section
+    in the header and records are written in blocks of up to 4096 rows,
+    column by column, so encoding and decoding are mostly whole-column
+    operations. Canonical UUIDs in `id`/`*_id` columns are stored as 16 raw
+    bytes, naive ISO timestamps in `*_date` columns as int64 microseconds
+    since the epoch, ints as int64 arrays; anything that would not survive
+    the round trip exactly falls back to a JSON-encoded column.
+    """
+
+    name = "binary"
+    binary = True
+
+    def dump(self, f, data: Dict[str, Dict[str, dict]]) -> None:
+        if "stats" in data:
+            # a leading section of (id=name, value) rows
+            stats = {name: {"id": name, "value": value} for name, value in data["stats"].items()}
+            data = {"stats": stats, **{name: data[name] for name in _STATE_SECTIONS if name in data}}
+        sections = [name for name in ("stats",) + _STATE_SECTIONS if name in data]
+        schemas = []
+        for name in sections:
+            first = next(iter(data[name].values()), None)
+            schemas.append(list(first) if first is not None else [])
+        header = bytearray(_BIN_MAGIC)
+        header += _U8.pack(len(sections))
+        for name, fields in zip(sections, schemas):
+            _pack_name(header, name)
+            header += _U8.pack(len(fields))
+            for field in fields:
+                _pack_name(header, field)
+        f.write(header)
+        for index, (name, fields) in enumerate(zip(sections, schemas)):
+            kinds = [_field_kind(field) for field in fields]
+            records = iter(data[name].values())
+            while True:
+                rows = list(itertools.islice(records, _BLOCK_ROWS))
+                if not rows:
+                    break
+                if any(len(r) != len(fields) for r in rows):
+                    raise ValueError(f"{name} records do not all have fields {fields}")
+                payload = bytearray()
+                for field, kind in zip(fields, kinds):
+                    _pack_column(payload, kind, [r[field] for r in rows])
+                f.write(_BLOCK_HEAD.pack(index, len(rows), len(payload)))
+                f.write(payload)
+        f.write(_U8.pack(_END_OF_BLOCKS))
+
+    def _header(self, f) -> List[Tuple[str, List[str]]]:
+        if f.read(len(_BIN_MAGIC)) != _BIN_MAGIC:
+            raise ValueError("Not a binary library snapshot")
+        sections = []
+        for _ in range(f.read(1)[0]):
+            name = _read_name(f)
+            fields = [_read_name(f) for _ in range(f.read(1)[0])]
+            sections.append((name, fields))
+        return sections
+
+    def _blocks(self, f) -> Iterator[Tuple[str, List[str], int, bytes, int]]:
+        sections = self._header(f)
+        offset = f.tell()
+        while True:
+            tag = f.read(1)
+            if not tag:
+                raise ValueError("Unexpected end of binary snapshot")
+            if tag[0] == _END_OF_BLOCKS:
+                return
+            head = tag + f.read(_BLOCK_HEAD.size - 1)
+            if len(head) < _BLOCK_HEAD.size:
+                raise ValueError("Unexpected end of binary snapshot")
+            index, rows, length = _BLOCK_HEAD.unpack(head)
+            payload = f.read(length)
+            if len(payload) != length:
+                raise ValueError("Unexpected end of binary snapshot")
+            name, fields = sections[index]
+            yield name, fields, rows, payload, offset
+            offset += _BLOCK_HEAD.size + length
+
+    def records(self, path: Path) -> Iterator[Tuple[str, str, dict]]:
+        with path.open("rb") as f:
+            for name, fields, rows, payload, _ in self._blocks(f):
+                if name in _STATE_SECTIONS:
+                    for record in _decode_block(fields, rows, payload):
+                        yield name, record["id"], record
+
+    def models(self, path: Path) -> Iterator[Tuple[str, str, object]]:
+        models = dict(_MODELS)
+        names = {name: [attr.name for attr in dataclasses.fields(model)] for name, model in _MODELS}
+        with path.open("rb") as f:
+            for name, fields, rows, payload, _ in self._blocks(f):
+                if name not in _STATE_SECTIONS:
+                    continue
+                columns = _decode_columns(fields, rows, payload)
+                model = models[name]
+                if fields == names[name][:len(fields)]:
+                    # the model's own field order: build straight from the columns
+                    built = map(model, *columns)
+                else:
+                    built = (model.from_dict(dict(zip(fields, row))) for row in zip(*columns))
+                yield from zip(itertools.repeat(name), columns[0], built)
+
+    def spans(self, path: Path) -> Iterator[Tuple[str, str, int, int, int]]:
+        with path.open("rb") as f:
+            for name, fields, rows, payload, offset in self._blocks(f):
+                if name not in _STATE_SECTIONS:
+                    continue
+                # id is always the first column; the others stay packed
+                ids = _unpack_column(payload, 0, rows)[0]
+                end = offset + _BLOCK_HEAD.size + len(payload)
+                for row, key in enumerate(ids):
+                    yield name, key, offset, end, row
+
+    def decoders(self, path: Path) -> Dict[str, Callable[[bytes], List[dict]]]:
+        with path.open("rb") as f:
+            sections = self._header(f)
+
+        def decoder(fields):
+            def decode(raw: bytes) -> List[dict]:
+                rows = _BLOCK_HEAD.unpack_from(raw)[1]
+                return _decode_block(fields, rows, raw[_BLOCK_HEAD.size:])
+            return decode
+
+        return {name: decoder(fields) for name, fields in sections}
+
+    def stats(self, path: Path) -> Optional[dict]:
+        with path.open("rb") as f:
+            # the stats section, when there is one, is the first block
+            name, fields, rows, payload, _ = next(self._blocks(f), (None, None, 0, b"", 0))
+        if name != "stats":
+            return None
+        return {row["id"]: row["value"] for row in _decode_block(fields, rows, payload)}
+
+
+SNAPSHOT_CODECS: Dict[str, SnapshotCodec] = {codec.name: codec for codec in (JsonCodec(), BinaryCodec())}
+
+
+def codec_for_file(path: Path) -> SnapshotCodec:
+    """Pick the codec that wrote `path` by sniffing its first bytes."""
+    with Path(path).open("rb") as f:
+        head = f.read(len(_BIN_MAGIC))
+    return SNAPSHOT_CODECS["binary"] if head == _BIN_MAGIC else SNAPSHOT_CODECS["json"]
+
+
+def _current_records(data: Dict[str, Dict[str, dict]]) -> Dict[str, Dict[str, dict]]:
+    # records written before a model gained fields lack them; the binary
+    # codec needs every record in a section to carry the same fields
+    models = dict(_MODELS)
+    return {section: {key: models[section].from_dict(rec).to_dict() for key, rec in records.items()}
+            for section, records in data.items()}
+
+
+def _count_record(stats: dict, section: str, record: dict, sign: int,
+                  book_of: Callable[[str], Optional["Book"]]) -> None:
+    """Add (sign=1) or take away (sign=-1) one record's share of _snapshot_stats totals."""
+    if section == "books":
+        stats["books"] += sign
+        stats["copies_total"] += sign * record["copies_total"]
+        stats["copies_available"] += sign * record["copies_available"]
+    elif section == "patrons":
+        stats["patrons"] += sign
+    else:
+        stats["loans"] += sign
+        if record["return_date"] is None:
+            stats["open_loans"] += sign
+            if sign < 0:
+                stats["due"].pop(record["id"], None)
+                return
+            if record.get("due_date") is not None:
+                due = _iso_micros(record["due_date"])
+            else:
+                due = _due_micros(Loan.from_dict(record), book_of(record["book_id"]))
+            if due is not None:
+                stats["due"][record["id"]] = due
+
+
+def _snapshot_stats(data: Dict[str, Dict[str, dict]]) -> dict:
+    """
+    The totals behind summary() and the due date of every open loan, as
+    _Stats and _OverdueIndex keep them. They are saved with each snapshot
+    so that a lazy load can answer summary() without decoding the records.
+    """
+    stats = dict.fromkeys(("books", "patrons", "loans", "open_loans", "copies_total", "copies_available"), 0)
+    stats["due"] = {}
+    books = data["books"]
+    book_of = lambda book_id: Book.from_dict(books[book_id]) if book_id in books else None
+    for section in _STATE_SECTIONS:
+        for record in data[section].values():
+            _count_record(stats, section, record, 1, book_of)
+    return stats
+
+
+def convert_snapshot(src: Path, dst: Path, codec: str = "binary") -> None:
+    """Rewrite the snapshot at `src` (any codec) into `dst` using `codec`."""
+    src, dst = Path(src), Path(dst)
+    target = SNAPSHOT_CODECS[codec]
+    try:
+        data = {section: {} for section in _STATE_SECTIONS}
+        for section, key, record in codec_for_file(src).records(src):
+            data[section][key] = record
+        data = _current_records(data)
+        data["stats"] = _snapshot_stats(data)
+        _atomic_write(dst, lambda f: target.dump(f, data), "wb" if target.binary else "w")
+    except Exception as e:
+        raise PersistenceError(f"Failed to convert {src} to {codec}: {e}")
+
+
+def _field_kind(field: str) -> str:
+    if field == "id" or field.endswith("_id"):
+        return "id"
+    if field.endswith("_date"):
+        return "date"
+    return ""
+
+
+def _pack_name(out: bytearray, name: str) -> None:
+    raw = name.encode("utf-8")
+    out += _U8.pack(len(raw))
+    out += raw
+
+
+def _read_name(f) -> str:
+    return f.read(f.read(1)[0]).decode("utf-8")
+
+
+def _pack_column(out: bytearray, kind: str, values: list) -> None:
+    nulls = None
+    present = values
+    if None in values:
+        nulls = bytes(v is None for v in values)
+        present = [v for v in values if v is not None]
+    col_type, data = _COL_JSON, None
+    if all(type(v) is str for v in present):
+        if kind == "id" and all(map(_UUID_TEXT.fullmatch, present)):
+            col_type, data = _COL_UUID, bytes.fromhex("".join(present).replace("-", ""))
+        elif kind == "date":
+            try:
+                stamps = [datetime.fromisoformat(v) for v in present]
+            except ValueError:
+                stamps = None
+            if stamps is not None and all(dt.tzinfo is None and dt.isoformat() == v
+                                          for dt, v in zip(stamps, present)):
+                col_type, data = _COL_TIME, array("q", [(dt - _EPOCH) // _MICROSECOND for dt in stamps]).tobytes()
+        if data is None and not any("\0" in v for v in present):
+            col_type, data = _COL_STR, "\0".join(present).encode("utf-8")
+    elif all(type(v) is int and -(1 << 63) <= v < (1 << 63) for v in present):
+        col_type, data = _COL_INT, array("q", present).tobytes()
+    if data is None:
+        col_type, data = _COL_JSON, json.dumps(present, separators=(",", ":")).encode("utf-8")
+    out += _COLUMN_HEAD.pack(col_type, nulls is not None, len(data))
+    if nulls is not None:
+        out += nulls
+    out += data
+
+
+def _unpack_column(payload: bytes, pos: int, rows: int) -> Tuple[list, int]:
+    col_type, has_nulls, length = _COLUMN_HEAD.unpack_from(payload, pos)
+    pos += _COLUMN_HEAD.size
+    nulls = None
+    if has_nulls:
+        nulls = payload[pos:pos + rows]
+        pos += rows
+    data = payload[pos:pos + length]
+    pos += length
+    if col_type == _COL_STR:
+        present = rows - nulls.count(1) if nulls is not None else rows
+        values = data.decode("utf-8").split("\0") if present else []
+    elif col_type == _COL_UUID:
+        h = data.hex()
+        values = [f"{h[i:i + 8]}-{h[i + 8:i + 12]}-{h[i + 12:i + 16]}-{h[i + 16:i + 20]}-{h[i + 20:i + 32]}"
+                  for i in range(0, len(h), 32)]
+    elif col_type == _COL_TIME:
+        values = [(_EPOCH + _MICROSECOND * m).isoformat() for m in array("q", data)]
+    elif col_type == _COL_INT:
+        values = array("q", data).tolist()
+    elif col_type == _COL_JSON:
+        values = json.loads(data.decode("utf-8"))
+    else:
+        raise ValueError(f"Unknown column type {col_type} in binary snapshot")
+    if nulls is not None:
+        it = iter(values)
+        values = [None if null else next(it) for null in nulls]
+    return values, pos
+
+
+def _decode_columns(fields: List[str], rows: int, payload: bytes) -> List[list]:
+    columns = []
+    pos = 0
+    for _ in fields:
+        values, pos = _unpack_column(payload, pos, rows)
+        columns.append(values)
+    return columns
+
+
+def _decode_block(fields: List[str], rows: int, payload: bytes) -> List[dict]:
+    return [dict(zip(fields, row)) for row in zip(*_decode_columns(fields, rows, payload))]
+
+
+def _apply_record_to_dicts(data: dict, rec: dict) -> None:
+    # the one set of replay rules, for plain record dicts (folds) and
+    # _ReplayOverlay views of loaded tables (loads) alike;
+    # records carry absolute values so replaying one twice is harmless
+    op = rec["op"]
+    if op == "book":
+        data["books"][rec["book"]["id"]] = rec["book"]
+    elif op == "patron":
+        data["patrons"][rec["patron"]["id"]] = rec["patron"]
+    elif op == "checkout":
+        data["loans"][rec["loan"]["id"]] = rec["loan"]
+        data["books"][rec["loan"]["book_id"]]["copies_available"] = rec["copies_available"]
+    elif op == "return":
+        data["loans"][rec["loan_id"]]["return_date"] = rec["return_date"]
+        book = data["books"].get(rec["book_id"])
+        if book is not None:
+            book["copies_available"] = rec["copies_available"]
+    else:
+        raise PersistenceError(f"Unknown journal record: {op!r}")
+
+
+class _ReplayOverlay(dict):
+    """
+    The records of one loaded table that a journal replay touches, as
+    dicts. A record the journal changes in place is copied out of `table`
+    the first time it is referred to; the table itself is left alone.
+    """
+
+    def __init__(self, table: MutableMapping):
+        super().__init__()
+        self.table = table
+
+    def __missing__(self, key):
+        record = self[key] = self.table[key].to_dict()
+        return record
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+# ---------------------------
+# Storage backends
+# ---------------------------
+
+_MODELS = (("books", Book), ("patrons", Patron), ("loans", Loan))
+
+
+class StorageBackend:
+    """
+    Where LibraryApp keeps its state between runs. `load` hands back the
+    books/patrons/loans tables (any MutableMapping keyed by id), `commit` is
+    called with the journal-style records of every mutation, and `save`
+    makes everything so far durable.
+    """
+
+    path: Path
+    codec: SnapshotCodec
+    # True when commit() writes every mutation out (a journal or a database)
+    commits_to_disk = False
+    # _snapshot_stats of the state the last load handed back, when the backend has them
+    stats: Optional[dict] = None
+
+    def load(self, progress: Optional[Callable[[str, int], None]] = None) -> tuple:
+        raise NotImplementedError
+
+    def load_from(self, path: Path, progress: Optional[Callable[[str, int], None]] = None) -> tuple:
+        raise NotImplementedError
+
+    def commit(self, records: Iterable[dict]) -> None:
+        pass
+
+    def transaction(self):
+        """Held around a mutation's table writes and its commit(), so no other caller's commit takes them along."""
+        return contextlib.nullcontext()
+
+    def save(self, app: "LibraryApp") -> None:
+        raise NotImplementedError
+
+    def compact(self, app: "LibraryApp") -> None:
+        self.save(app)
+
+    def snapshot_rows(self, app: "LibraryApp") -> Dict[str, List[tuple]]:
+        """Every record of every table as a tuple of its fields, copied at one point in time."""
+        return {name: list(map(operator.attrgetter(*(f.name for f in fields(model))), getattr(app, name).values()))
+                for name, model in _MODELS}
+
+    def close(self) -> None:
+        pass
+
+
+class JsonBackend(StorageBackend):
+    """
+    Snapshot file (JSON or binary codec) held fully in memory, or lazily with
+    lazy=True. With journal=True mutations are appended to
+    `<state file>.journal` and the log is folded back into the snapshot once
+    it grows past `compact_threshold` bytes. columnar_loans=True keeps loans
+    in a compact _LoanColumns store instead of one object per loan.
+    """
+
+    def __init__(self, path: Path, codec: SnapshotCodec, lazy: bool = False, journal: bool = False,
+                 compact_threshold: int = 4 * 1024 * 1024, columnar_loans: bool = False):
+        if lazy and columnar_loans:
+            raise ValueError("columnar_loans needs every loan in memory; it cannot be combined with lazy=True")
+        self.path = path
+        self._codec = codec
+        self.lazy = lazy
+        self.columnar_loans = columnar_loans
+        self.journaling = journal
+        self.compact_threshold = compact_threshold
+        self._journal: Optional[_Journal] = None
+        self._tables: tuple = ()
+
+    @property
+    def codec(self) -> SnapshotCodec:
+        return self._codec
+
+    @codec.setter
+    def codec(self, codec: SnapshotCodec) -> None:
+        self._codec = codec
+        if self._journal is not None:
+            self._journal.codec = codec
+
+    @property
+    def commits_to_disk(self) -> bool:
+        return self.journaling
+
+    def load(self, progress: Optional[Callable[[str, int], None]] = None) -> tuple:
+        tables = self._read(self.path, progress)
+        if self.journaling and self._journal is None:
+            self._journal = _Journal(self.path, self.compact_threshold, self.codec)
+        return tables
+
+    def load_from(self, path: Path, progress: Optional[Callable[[str, int], None]] = None) -> tuple:
+        tables = self._read(path, progress)
+        self.path = path
+        if self._journal is not None:
+            # keep journaling next to the file we now own
+            self._journal.close()
+            self._journal = _Journal(path, self.compact_threshold, self.codec)
+        return tables
+
+    def commit(self, records: Iterable[dict]) -> None:
+        if self._journal is not None:
+            try:
+                self._journal.append(list(records))
+            except Exception as e:
+                raise PersistenceError(f"Failed to append to journal {self._journal.path}: {e}")
+
+    def save(self, app: "LibraryApp") -> None:
+        if self._journal is not None:
+            # every mutation is already in the journal; just make it durable
+            try:
+                self._journal.sync()
+            except Exception as e:
+                raise PersistenceError(f"Failed to sync journal {self._journal.path}: {e}")
+            return
+        _write_snapshot(app, self.path, self.codec)
+        # the snapshot supersedes anything a journaled session left behind
+        for p in _journal_paths(self.path):
+            if p.exists():
+                p.unlink()
+
+    def compact(self, app: "LibraryApp") -> None:
+        if self._journal is None:
+            self.save(app)
+            return
+        self._journal.wait_for_compaction()
+        _write_snapshot(app, self.path, self.codec)
+        self._journal.truncate()
+
+    def close(self) -> None:
+        journal, self._journal = self._journal, None
+        try:
+            if journal is not None:
+                journal.close()
+        finally:
+            self._close_tables()
+
+    def _close_tables(self) -> None:
+        for table in self._tables:
+            if isinstance(table, _LazyTable):
+                table.close()
+
+    def _read(self, path: Path, progress: Optional[Callable[[str, int], None]]) -> tuple:
+        self._close_tables()
+        self.stats = None
+        tables = {"books": {}, "patrons": {}, "loans": _LoanColumns() if self.columnar_loans else {}}
+        factories = {name: model.from_dict for name, model in _MODELS}
+        if path.exists():
+            counts = dict.fromkeys(_STATE_SECTIONS, 0)
+            codec = codec_for_file(path)
+            if self.lazy:
+                for section, key, start, end, row in codec.spans(path):
+                    tables[section][key] = (start, end, row)
+                    counts[section] += 1
+                    if progress and counts[section] % _PROGRESS_EVERY == 0:
+                        progress(section, counts[section])
+                decoders = codec.decoders(path)
+                tables = {name: _LazyTable(path, factories[name], spans, decoders.get(name))
+                          for name, spans in tables.items()}
+                # lazy tables are never all decoded, so keep the totals saved with them
+                self.stats = codec.stats(path)
+            else:
+                for section, key, obj in codec.models(path):
+                    tables[section][key] = obj
+                    counts[section] += 1
+                    if progress and counts[section] % _PROGRESS_EVERY == 0:
+                        progress(section, counts[section])
+            if progress:
+                for section in _STATE_SECTIONS:
+                    progress(section, counts[section])
+        # replayed as dicts, so each touched record becomes a model only once
+        replayed = {name: _ReplayOverlay(tables[name]) for name in _STATE_SECTIONS}
+        for p in _journal_paths(path):
+            if p.exists():
+                for rec in _read_journal(p):
+                    _apply_record_to_dicts(replayed, rec)
+        book_of = lambda book_id: (Book.from_dict(replayed["books"][book_id]) if book_id in replayed["books"]
+                                   else tables["books"].get(book_id))
+        for name, records in replayed.items():
+            for key, record in records.items():
+                if self.stats is not None:
+                    old = tables[name].get(key)
+                    if old is not None:
+                        _count_record(self.stats, name, old.to_dict(), -1, book_of)
+                    _count_record(self.stats, name, record, 1, book_of)
+                tables[name][key] = factories[name](record)
+        self._tables = (tables["books"], tables["patrons"], tables["loans"])
+        return self._tables
+
+
+def _write_snapshot(app: "LibraryApp", path: Path, codec: SnapshotCodec) -> None:
+    # writers wait only while field tuples are copied; building the dicts,
+    # encoding and the write all run unlocked
+    names = {name: [f.name for f in fields(model)] for name, model in _MODELS}
+    with app._state_lock.exclusive():
+        for table in (app.books, app.patrons, app.loans):
+            if isinstance(table, _LazyTable):
+                # every record is about to be read anyway; also frees the old file
+                table.materialize()
+        rows = {name: list(map(operator.attrgetter(*names[name]), getattr(app, name).values()))
+                for name, _ in _MODELS}
+    # every model's first field is its id
+    data = {name: {row[0]: dict(zip(names[name], row)) for row in rows[name]} for name, _ in _MODELS}
+    data["stats"] = _snapshot_stats(data)
+    try:
+        _atomic_write(path, lambda f: codec.dump(f, data), "wb" if codec.binary else "w")
+    except Exception as e:
+        raise PersistenceError(f"Failed to save state to {path}: {e}")
+
+
+_SQLITE_MAGIC = b"SQLite format 3\x00"
+_SQLITE_PAGE = 1000
+
+
+class SqliteBackend(StorageBackend):
+    """
+    SQLite database with one table per model. The books/patrons/loans
+    tables handed to LibraryApp read and write rows on demand instead of
+    holding them in memory, and every commit() is one transaction in which
+    checkouts and returns are re-checked against the stored rows. All
+    threads share one connection, so a mutation's rows and its commit()
+    run inside transaction(): otherwise another thread's commit or
+    rollback would take them along.
+    """
+
+    commits_to_disk = True
+
+    def __init__(self, path: Path, codec: SnapshotCodec):
+        self.path = path
+        self.codec = codec
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # commits stay atomic; save_state() checkpoints for durability
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for name, model in _MODELS:
+            columns = [f"{f.name} {_sqlite_type(f.type)}" for f in fields(model) if f.name != "id"]
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {name} (id TEXT PRIMARY KEY, {', '.join(columns)})")
+            have = {row[1] for row in conn.execute(f"PRAGMA table_info({name})")}
+            for f in fields(model):
+                if f.name not in have:
+                    # model gained a field since the database was created
+                    conn.execute(f"ALTER TABLE {name} ADD COLUMN {f.name} {_sqlite_type(f.type)}")
+        conn.execute("CREATE INDEX IF NOT EXISTS loans_book_id ON loans(book_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS loans_patron_id ON loans(patron_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS loans_open ON loans(book_id, patron_id) WHERE return_date IS NULL")
+        conn.commit()
+        return conn
+
+    def load(self, progress: Optional[Callable[[str, int], None]] = None) -> tuple:
+        if self._conn is None:
+            self._conn = self._connect()
+        tables = tuple(_SqliteTable(self._conn, name, model, self._lock) for name, model in _MODELS)
+        if progress:
+            for (name, _), table in zip(_MODELS, tables):
+                progress(name, len(table))
+        return tables
+
+    def load_from(self, path: Path, progress: Optional[Callable[[str, int], None]] = None) -> tuple:
+        with path.open("rb") as f:
+            is_db = f.read(len(_SQLITE_MAGIC)) == _SQLITE_MAGIC
+        if is_db:
+            self.close()
+            self.path = path
+            return self.load(progress)
+        # a snapshot file: replace the database contents with it
+        if self._conn is None:
+            self._conn = self._connect()
+        factories = {name: model for name, model in _MODELS}
+        with self._lock:
+            try:
+                for name, _ in _MODELS:
+                    self._conn.execute(f"DELETE FROM {name}")
+                pending: Dict[str, list] = {name: [] for name, _ in _MODELS}
+                tables = {name: _SqliteTable(self._conn, name, model, self._lock) for name, model in _MODELS}
+                for section, _, record in codec_for_file(path).records(path):
+                    pending[section].append(factories[section].from_dict(record))
+                    if len(pending[section]) >= 10000:
+                        tables[section].put_many(pending[section])
+                        pending[section] = []
+                for section, objs in pending.items():
+                    tables[section].put_many(objs)
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        return self.load(progress)
+
+    def transaction(self):
+        return self._lock
+
+    def commit(self, records: Iterable[dict]) -> None:
+        conn = self._conn
+        with self._lock:
+            try:
+                for rec in records:
+                    op = rec["op"]
+                    if op == "checkout":
+                        cur = conn.execute(
+                            "UPDATE books SET copies_available = copies_available - 1 "
+                            "WHERE id = ? AND copies_available > 0", (rec["loan"]["book_id"],))
+                        if cur.rowcount != 1:
+                            raise ValueError("No copies available")
+                    elif op == "return":
+                        cur = conn.execute("UPDATE loans SET return_date = ? WHERE id = ? AND return_date IS NULL",
+                                           (rec["return_date"], rec["loan_id"]))
+                        if cur.rowcount != 1:
+                            raise ValueError("Book already returned")
+                        conn.execute("UPDATE books SET copies_available = copies_available + 1 WHERE id = ?",
+                                     (rec["book_id"],))
+                    # "book"/"patron" rows were written when they were stored in the table
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def save(self, app: "LibraryApp") -> None:
+        with self._lock:
+            try:
+                self._conn.commit()
+                self._conn.execute("PRAGMA wal_checkpoint(FULL)")
+            except Exception as e:
+                raise PersistenceError(f"Failed to save state to {self.path}: {e}")
+
+    def compact(self, app: "LibraryApp") -> None:
+        with self._lock:
+            self._conn.commit()
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def snapshot_rows(self, app: "LibraryApp") -> Dict[str, List[tuple]]:
+        # a separate connection's read transaction sees one committed WAL
+        # snapshot across all tables without blocking the app's writes
+        conn = sqlite3.connect(str(self.path))
+        try:
+            conn.execute("BEGIN")
+            return {name: conn.execute(f"SELECT {', '.join(f.name for f in fields(model))} FROM {name} "
+                                       f"ORDER BY rowid").fetchall()
+                    for name, model in _MODELS}
+        finally:
+            conn.close()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def _sqlite_type(annotation) -> str:
+    types = getattr(annotation, "__args__", (annotation,))
+    if int in types:
+        return "INTEGER"
+    if str in types:
+        return "TEXT"
+    return ""
+
+
+class _SqliteTable(MutableMapping):
+    """Dict-like access to one SQLite table; models are built per lookup."""
+
+    def __init__(self, conn: sqlite3.Connection, name: str, model, lock):
+        self._conn = conn
+        self._name = name
+        self._model = model
+        self._lock = lock
+        self._columns = [f.name for f in fields(model)]
+        cols = ", ".join(self._columns)
+        self._select = f"SELECT {cols} FROM {name}"
+        updates = ", ".join(f"{c} = excluded.{c}" for c in self._columns if c != "id")
+        self._upsert = (f"INSERT INTO {name} ({cols}) VALUES ({', '.join('?' * len(self._columns))}) "
+                        f"ON CONFLICT(id) DO UPDATE SET {updates}")
+
+    def _make(self, row):
+        return self._model.from_dict(dict(zip(self._columns, row)))
+
+    def __getitem__(self, key):
+        with self._lock:
+            row = self._conn.execute(self._select + " WHERE id = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self._make(row)
+
+    def __setitem__(self, key, value) -> None:
+        with self._lock:
+            self._conn.execute(self._upsert, [getattr(value, c) for c in self._columns])
+
+    def put_many(self, values) -> None:
+        with self._lock:
+            self._conn.executemany(self._upsert, ([getattr(v, c) for c in self._columns] for v in values))
+
+    def __delitem__(self, key) -> None:
+        with self._lock:
+            if self._conn.execute(f"DELETE FROM {self._name} WHERE id = ?", (key,)).rowcount == 0:
+                raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return self._conn.execute(f"SELECT 1 FROM {self._name} WHERE id = ?", (key,)).fetchone() is not None
+
+    def __iter__(self):
+        for (key,) in self._scan("id"):
+            yield key
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self._name}").fetchone()[0]
+
+    def values(self):
+        return (self._make(row) for row in self._scan(", ".join(self._columns)))
+
+    def items(self):
+        return ((obj.id, obj) for obj in self.values())
+
+    def aggregate(self, *exprs: str, where: str = "") -> tuple:
+        """One row of SQL aggregates over the table, e.g. aggregate("COUNT(*)", "SUM(copies_total)")."""
+        with self._lock:
+            return self._conn.execute(f"SELECT {', '.join(exprs)} FROM {self._name}"
+                                      + (f" WHERE {where}" if where else "")).fetchone()
+
+    def where(self, clause: str, params: tuple = ()) -> Iterator:
+        """Models matching a SQL WHERE clause (uses the table's indexes)."""
+        return (self._make(row) for row in self._scan(", ".join(self._columns), clause, params))
+
+    def _scan(self, columns: str, where: str = "", params: tuple = ()) -> Iterator[tuple]:
+        # keyset pages: bounded memory, and other statements can run between pages
+        cond = f"({where}) AND " if where else ""
+        sql = f"SELECT rowid, {columns} FROM {self._name} WHERE {cond}rowid > ? ORDER BY rowid LIMIT {_SQLITE_PAGE}"
+        last = -1 << 63
+        while True:
+            with self._lock:
+                rows = self._conn.execute(sql, (*params, last)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row[1:]
+            last = rows[-1][0]
+
+
+# ---------------------------
+# Columnar loan store
+# ---------------------------
+
+_NO_DATE = -(1 << 63)  # return_date is None
+_ODD_DATE = _NO_DATE + 1  # kept verbatim in _LoanColumns._odd_dates
+
+
+def _uuid_text(raw: bytes) -> str:
+    h = raw.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+class _Interner:
+    """Distinct strings numbered in order of first appearance."""
+
+    def __init__(self):
+        self.values: List[str] = []
+        self.numbers: Dict[str, int] = {}
+
+    def number(self, value: str) -> int:
+        n = self.numbers.get(value)
+        if n is None:
+            n = self.numbers[value] = len(self.values)
+            self.values.append(value)
+        return n
+
+
+class _LoanColumns(MutableMapping):
+    """
+    Loans stored column-wise instead of one object each: canonical UUID loan
+    ids as 16-byte keys, book and patron ids as numbers into interned
+    tables, naive ISO dates as int64 microseconds since the epoch. Lookups
+    hand out _LoanView objects that read and write the columns, so code
+    written against Loan (including in-place return_date updates) works
+    unchanged.
+    """
+
+    def __init__(self, loans: Iterable["Loan"] = ()):
+        self._rows: Dict[object, int] = {}
+        self._keys: List[object] = []  # row -> key, None once deleted
+        self._books = _Interner()
+        self._patrons = _Interner()
+        self._book = array("I")
+        self._patron = array("I")
+        self._loan_date = array("q")
+        self._return_date = array("q")
+        self._due_date = array("q")
+        self._dates = {"loan_date": self._loan_date, "return_date": self._return_date, "due_date": self._due_date}
+        self._odd_dates: Dict[Tuple[int, str], str] = {}
+        for loan in loans:
+            self[loan.id] = loan
+
+    @staticmethod
+    def _key(loan_id: str):
+        return bytes.fromhex(loan_id.replace("-", "")) if _UUID_TEXT.fullmatch(loan_id) else loan_id
+
+    def _put_date(self, column: array, row: int, name: str, value: Optional[str]) -> None:
+        self._odd_dates.pop((row, name), None)
+        if value is None:
+            column[row] = _NO_DATE
+            return
+        try:
+            dt = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            dt = None
+        if dt is not None and dt.tzinfo is None and dt.isoformat() == value:
+            column[row] = (dt - _EPOCH) // _MICROSECOND
+        else:
+            column[row] = _ODD_DATE
+            self._odd_dates[(row, name)] = value
+
+    def _get_date(self, column: array, row: int, name: str) -> Optional[str]:
+        m = column[row]
+        if m == _NO_DATE:
+            return None
+        if m == _ODD_DATE:
+            return self._odd_dates[(row, name)]
+        return (_EPOCH + _MICROSECOND * m).isoformat()
+
+    def get_field(self, row: int, name: str):
+        if name == "id":
+            key = self._keys[row]
+            return _uuid_text(key) if isinstance(key, bytes) else key
+        if name == "book_id":
+            return self._books.values[self._book[row]]
+        if name == "patron_id":
+            return self._patrons.values[self._patron[row]]
+        return self._get_date(self._dates[name], row, name)
+
+    def set_field(self, row: int, name: str, value) -> None:
+        if name == "book_id":
+            self._book[row] = self._books.number(value)
+        elif name == "patron_id":
+            self._patron[row] = self._patrons.number(value)
+        elif name in self._dates:
+            self._put_date(self._dates[name], row, name, value)
+        else:
+            raise AttributeError(f"cannot change loan field {name!r} in place")
+
+    def __getitem__(self, loan_id: str) -> "_LoanView":
+        return _LoanView(self, self._rows[self._key(loan_id)])
+
+    def __setitem__(self, loan_id: str, loan: "Loan") -> None:
+        key = self._key(loan_id)
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows[key] = len(self._keys)
+            self._keys.append(key)
+            for column in (self._book, self._patron, *self._dates.values()):
+                column.append(0)
+        self.set_field(row, "book_id", loan.book_id)
+        self.set_field(row, "patron_id", loan.patron_id)
+        for name in self._dates:
+            self.set_field(row, name, getattr(loan, name))
+
+    def __delitem__(self, loan_id: str) -> None:
+        row = self._rows.pop(self._key(loan_id))
+        self._keys[row] = None
+        for name in self._dates:
+            self._odd_dates.pop((row, name), None)
+
+    def __contains__(self, loan_id) -> bool:
+        return isinstance(loan_id, str) and self._key(loan_id) in self._rows
+
+    def __iter__(self) -> Iterator[str]:
+        for key in self._keys:
+            if key is not None:
+                yield _uuid_text(key) if isinstance(key, bytes) else key
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def values(self):
+        return (_LoanView(self, row) for row, key in enumerate(self._keys) if key is not None)
+
+
+class _LoanView(Loan):
+    """A Loan whose fields live in a _LoanColumns row."""
+
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store: _LoanColumns, row: int):
+        self._store = store
+        self._row = row
+
+    def __eq__(self, other):
+        if not isinstance(other, Loan):
+            return NotImplemented
+        return all(getattr(self, f.name) == getattr(other, f.name) for f in fields(Loan))
+
+    __hash__ = None
+
+
+def _column_property(name: str) -> property:
+    return property(lambda self: self._store.get_field(self._row, name),
+                    lambda self, value: self._store.set_field(self._row, name, value))
+
+
+for _field in fields(Loan):
+    setattr(_LoanView, _field.name, _column_property(_field.name))
+del _field
+
+
+# ---------------------------
+# CSV import/export helpers
+# ---------------------------
+
+@dataclass
+class ChunkStats:
+    index: int
+    start: int
+    end: int
+    rows: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds > 0 else float("inf")
+
+
+@dataclass
+class ImportReport:
+    books: List["Book"] = field(default_factory=list)
+    skipped: List[Tuple[int, str]] = field(default_factory=list)  # (line number, reason)
+    chunks: List[ChunkStats] = field(default_factory=list)
+    # counted even when the books themselves are not retained
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+
+
+_IMPORT_COLUMNS: Dict[str, Tuple[str, ...]] = {
+    "title": ("title",),
+    "author": ("author",),
+    "year": ("year",),
+    "copies": ("copies",),
+    "isbn": ("isbn",),
+    "item_type": ("item_type", "type"),
+}
+
+
+@dataclass(frozen=True)
+class ImportProfile:
+    """
+    How one vendor's CSV maps onto Book fields. `aliases` adds header names
+    (matched case-insensitively) on top of the standard ones; the mapping is
+    resolved once per file by compile() so rows are parsed positionally.
+    """
+    name: str = "default"
+    aliases: Dict[str, Tuple[str, ...]] = field(default_factory=dict)
+    delimiter: str = ","
+    default_author: str = "Unknown"
+
+    def compile(self, header: List[str], partial: bool = False) -> "_RowParser":
+        positions = {name.strip().lstrip("\ufeff").casefold(): i for i, name in reversed(list(enumerate(header)))}
+        columns = {}
+        for column, standard in _IMPORT_COLUMNS.items():
+            names = tuple(standard) + tuple(self.aliases.get(column, ()))
+            columns[column] = next((positions[n.casefold()] for n in names if n.casefold() in positions), None)
+        if columns["title"] is None:
+            raise ValueError(f"no title column in CSV header {header!r} for profile {self.name!r}")
+        return _RowParser(columns, len(header), self.default_author, partial)
+
+
+IMPORT_PROFILES: Dict[str, ImportProfile] = {"default": ImportProfile()}
+
+
+class _RowParser:
+    """
+    Parses one CSV row into a Book. A `partial` parser leaves author, copies
+    and item_type as None where the cell is blank or missing, so an update
+    can tell them from values the feed supplied; complete() fills them in.
+    """
+    __slots__ = ("title", "author", "year", "copies", "isbn", "item_type", "width", "default_author", "partial")
+
+    def __init__(self, columns: Dict[str, Optional[int]], width: int, default_author: str, partial: bool = False):
+        # missing optional columns read from a padding cell that is always ""
+        for column in _IMPORT_COLUMNS:
+            setattr(self, column, width if columns[column] is None else columns[column])
+        self.width = width + 1
+        self.default_author = default_author
+        self.partial = partial
+
+    def __call__(self, values: List[str]) -> Tuple[Optional["Book"], Optional[str]]:
+        if len(values) < self.width:
+            values = values + [""] * (self.width - len(values))
+        title = values[self.title].strip()
+        if not title:
+            return None, "missing title"
+        author = values[self.author].strip() or None
+        year_raw = values[self.year].strip()
+        copies_raw = values[self.copies].strip()
+        year = int(year_raw) if year_raw.isdigit() else None
+        try:
+            copies = max(1, int(copies_raw)) if copies_raw else None
+        except ValueError:
+            copies = None
+        isbn = values[self.isbn].strip() or None
+        item_type = values[self.item_type].strip().casefold() or None
+        book = Book.create(title=title, author=author, year=year, copies=copies, isbn=isbn, item_type=item_type)
+        return (book if self.partial else self.complete(book)), None
+
+    def complete(self, book: "Book") -> "Book":
+        if book.author is not None and book.copies_total is not None and book.item_type is not None:
+            return book
+        copies = 1 if book.copies_total is None else book.copies_total
+        return dataclasses.replace(book, author=book.author or self.default_author, copies_total=copies,
+                                   copies_available=copies, item_type=book.item_type or "book")
+
+
+def _csv_chunks(csv_path: Path, chunk_bytes: int, delimiter: str = ",") -> Tuple[List[str], List[Tuple[int, int, int]]]:
+    """
+    Read the header and split the rest of the file into (start, end, first
+    line number) byte ranges of roughly `chunk_bytes`, cutting only at
+    newlines that are outside quoted fields (an even number of quotes so far).
+    """
+    with csv_path.open("rb") as f:
+        header_line = f.readline()
+        fieldnames = next(csv.reader([header_line.decode("utf-8")], delimiter=delimiter), [])
+        start = f.tell()
+        size = csv_path.stat().st_size
+        chunks = []
+        line, quotes, pos = 2, 0, start
+        chunk_start, chunk_line = start, 2
+        target = start + chunk_bytes
+        while pos < size:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            offset = 0
+            while pos + len(block) > target:
+                nl = block.find(b"\n", max(offset, target - pos))
+                if nl < 0:
+                    break
+                q = quotes + block.count(b'"', 0, nl)
+                if q % 2:
+                    target = pos + nl + 1  # newline inside a quoted field; try the next one
+                    continue
+                cut = pos + nl + 1
+                line_at_cut = line + block.count(b"\n", 0, nl + 1)
+                chunks.append((chunk_start, cut, chunk_line))
+                chunk_start, chunk_line = cut, line_at_cut
+                offset = nl + 1
+                target = cut + chunk_bytes
+            quotes += block.count(b'"')
+            line += block.count(b"\n")
+            pos += len(block)
+        if chunk_start < size:
+            chunks.append((chunk_start, size, chunk_line))
+    return fieldnames, chunks
+
+
+def _iter_csv_range(csv_path: Path, start: int, end: int, first_line: int, fieldnames: List[str],
+                    profile: ImportProfile, partial: bool = False) -> Iterator[Tuple[int, Optional["Book"], Optional[str]]]:
+    """Yield (line number, book or None, skip reason) for each record in the byte range."""
+    def lines(f):
+        pos = start
+        for raw in f:
+            if pos >= end:
+                break
+            pos += len(raw)
+            yield raw.decode("utf-8")
+
+    parse = profile.compile(fieldnames, partial)
+    with csv_path.open("rb") as f:
+        f.seek(start)
+        reader = csv.reader(lines(f), delimiter=profile.delimiter)
+        for values in reader:
+            if not values:
+                continue
+            book, reason = parse(values)
+            yield first_line + reader.line_num - 1, book, reason
+
+
+def _parse_csv_chunk(csv_path: Path, index: int, start: int, end: int, first_line: int, fieldnames: List[str],
+                     profile: ImportProfile, partial: bool = False,
+                     pack: Optional[Callable[["Book"], tuple]] = None) -> Tuple[list, List[Tuple[int, str]], ChunkStats]:
+    # with `pack`, each book comes back as a (line number, *pack(book)) tuple
+    started = time.perf_counter()
+    books, skipped, rows = [], [], 0
+    for line, book, reason in _iter_csv_range(csv_path, start, end, first_line, fieldnames, profile, partial):
+        rows += 1
+        if book is None:
+            skipped.append((line, reason))
+        else:
+            books.append(book if pack is None else (line,) + pack(book))
+    return books, skipped, ChunkStats(index, start, end, rows, time.perf_counter() - started)
+
+
+def _parse_csv_chunk_packed(*args) -> Tuple[List[tuple], List[Tuple[int, str]], ChunkStats]:
+    # process-pool entry point: plain field tuples pickle far cheaper than dataclasses
+    return _parse_csv_chunk(*args, pack=operator.attrgetter(*(f.name for f in fields(Book))))
+
+
+try:
+    from compression import zstd  # stdlib from Python 3.14
+except ImportError:
+    zstd = None
+
+# compressed export formats, picked by name or by the target's suffix
+EXPORT_COMPRESSION: Dict[str, Callable[[io.RawIOBase], io.BufferedIOBase]] = {
+    "gzip": lambda f: gzip.GzipFile(fileobj=f, mode="wb", compresslevel=1, mtime=0),
+    "bz2": lambda f: bz2.BZ2File(f, "wb"),
+    "xz": lambda f: lzma.LZMAFile(f, "wb"),
+}
+_EXPORT_SUFFIXES = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz"}
+if zstd is not None:
+    EXPORT_COMPRESSION["zstd"] = lambda f: zstd.ZstdFile(f, "wb")
+    _EXPORT_SUFFIXES[".zst"] = "zstd"
+
+
+def _write_csv(f, compression: Optional[str], header: List[str], rows: Iterable[tuple],
+               chunk_rows: int = 4096) -> int:
+    """Write header + rows to the binary file `f` in chunks of rows; returns the row count."""
+    out = EXPORT_COMPRESSION[compression](f) if compression else f
+    text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+    count = 0
+    try:
+        writer = csv.writer(text)
+        writer.writerow(header)
+        rows = iter(rows)
+        for chunk in iter(lambda: list(itertools.islice(rows, chunk_rows)), []):
+            writer.writerows(chunk)
+            count += len(chunk)
+        text.flush()
+    finally:
+        text.detach()
+    if out is not f:
+        out.close()
+    return count
+
+
+def _shard_of(record_id: str, shards: int) -> int:
+    # contiguous ranges of the first id byte, so shard files cover id prefixes
+    try:
+        lead = int(record_id[:2], 16)
+    except ValueError:
+        lead = zlib.crc32(record_id.encode("utf-8")) & 0xFF
+    return lead * shards >> 8
+
+
+def _export_rows(path: Path, compression: Optional[str], header: List[str], rows: List[tuple]) -> int:
+    written = 0
+
+    def write(f):
+        nonlocal written
+        written = _write_csv(f, compression, header, rows)
+
+    _atomic_write(path, write, "wb")
+    return written
+
+
+# ---------------------------
+# Derived indexes
+# ---------------------------
+
+class _Derived:
+    """
+    In-memory structure derived from the app's tables. It is built on first
+    use, told about every mutation afterwards, and dropped whenever state is
+    (re)loaded so it gets rebuilt from the new tables.
+    """
+
+    def build(self, app: "LibraryApp") -> None:
+        raise NotImplementedError
+
+    def book_added(self, book: "Book") -> None:
+        pass
+
+    def book_changed(self, old: "Book", book: "Book") -> None:
+        pass
+
+    def patron_added(self, patron: "Patron") -> None:
+        pass
+
+    def loan_opened(self, loan: "Loan", book: "Book") -> None:
+        pass
+
+    def loan_closed(self, loan: "Loan", book: Optional["Book"]) -> None:
+        pass
+
 
-    @classmethod
-    def from_dict(cls, data: dict) -> "Book":
-        return cls(**data)
+class _LoanIndex(_Derived):
+    """Open loan ids: all of them, by patron and by book (dicts as ordered sets)."""
 
+    def __init__(self):
+        self.open: Dict[str, None] = {}
+        self.by_patron: Dict[str, Dict[str, None]] = {}
+        self.by_book: Dict[str, Dict[str, None]] = {}
 
-@dataclass
-class Patron:
-    id: str
-    name: str
-    email: str
+    def build(self, app: "LibraryApp") -> None:
+        for loan in app._open_loans():
+            self.loan_opened(loan, None)
 
-    @staticmethod
-    def create(name: str, email: str) -> "Patron":
-        return Patron(id=str(uuid.uuid4()), name=name, email=email)
+    def loan_opened(self, loan: "Loan", book: Optional["Book"]) -> None:
+        self.open[loan.id] = None
+        self.by_patron.setdefault(loan.patron_id, {})[loan.id] = None
+        self.by_book.setdefault(loan.book_id, {})[loan.id] = None
+
+    def loan_closed(self, loan: "Loan", book: Optional["Book"]) -> None:
+        self.open.pop(loan.id, None)
+        for index, key in ((self.by_patron, loan.patron_id), (self.by_book, loan.book_id)):
+            ids = index.get(key)
+            if ids is not None:
+                ids.pop(loan.id, None)
+                if not ids:
+                    del index[key]
 
-    def to_dict(self) -> dict:
-        return asdict(self)
+
+class _Stats(_Derived):
+    """Running totals behind summary(), each mutation adjusting them in O(1)."""
+
+    def __init__(self):
+        self.books = self.patrons = self.loans = self.open_loans = 0
+        self.copies_total = self.copies_available = 0
 
     @classmethod
-    def from_dict(cls, data: dict) -> "Patron":
-        return cls(**data)
+    def from_snapshot(cls, stats: dict) -> "_Stats":
+        """Totals as saved by _snapshot_stats, instead of a build()."""
+        totals = cls()
+        for name in ("books", "patrons", "loans", "open_loans", "copies_total", "copies_available"):
+            setattr(totals, name, stats[name])
+        return totals
 
+    def build(self, app: "LibraryApp") -> None:
+        aggregate = getattr(app.books, "aggregate", None)
+        if aggregate is not None:
+            self.books, total, available = aggregate("COUNT(*)", "SUM(copies_total)", "SUM(copies_available)")
+            self.copies_total, self.copies_available = total or 0, available or 0
+            self.patrons = len(app.patrons)
+            self.loans = len(app.loans)
+            self.open_loans = app.loans.aggregate("COUNT(*)", where="return_date IS NULL")[0]
+            return
+        for book in getattr(app.books, "scan", app.books.values)():
+            self.book_added(book)
+        self.patrons = len(app.patrons)
+        self.loans = len(app.loans)
+        self.open_loans = sum(1 for _ in app._open_loans())
 
-@dataclass
-class Loan:
-    id: str
-    book_id: str
-    patron_id: str
-    loan_date: str
-    return_date: Optional[str]
+    def book_added(self, book: "Book") -> None:
+        self.books += 1
+        self.copies_total += book.copies_total
+        self.copies_available += book.copies_available
 
-    @staticmethod
-    def create(book_id: str, patron_id: str) -> "Loan":
-        return Loan(
-            id=str(uuid.uuid4()),
-            book_id=book_id,
-            patron_id=patron_id,
-            loan_date=datetime.utcnow().isoformat(),
-            return_date=None,
-        )
+    def book_changed(self, old: "Book", book: "Book") -> None:
+        self.copies_total += book.copies_total - old.copies_total
+        self.copies_available += book.copies_available - old.copies_available
 
-    def to_dict(self) -> dict:
-        return asdict(self)
+    def patron_added(self, patron: "Patron") -> None:
+        self.patrons += 1
+
+    def loan_opened(self, loan: "Loan", book: Optional["Book"]) -> None:
+        self.loans += 1
+        self.open_loans += 1
+        self.copies_available -= 1
+
+    def loan_closed(self, loan: "Loan", book: Optional["Book"]) -> None:
+        self.open_loans -= 1
+        if book is not None:
+            self.copies_available += 1
+
+
+_DAY_US = 86400 * 1000000
+_LOAN_GROUPS = ("day", "month", "year", "book", "patron")
+
+
+def _iso_micros(value: Optional[str]) -> Optional[int]:
+    """Microseconds since the epoch for an ISO timestamp (aware ones in UTC), else None."""
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return (dt - _EPOCH) // _MICROSECOND
+
+
+def _loan_bound(value: Optional[str]) -> Optional[int]:
+    if value is None:
+        return None
+    micros = _iso_micros(value)
+    if micros is None:
+        raise ValueError(f"Not an ISO date or timestamp: {value!r}")
+    return micros
+
+
+def _period_starts(first: int, last: int, months: int) -> List[int]:
+    """Start (in epoch microseconds) of every `months`-long calendar period covering [first, last]."""
+    start = _EPOCH + _MICROSECOND * first
+    year, month = start.year, 1 if months == 12 else start.month
+    starts = []
+    while True:
+        micros = (datetime(year, month, 1) - _EPOCH) // _MICROSECOND
+        if micros > last:
+            return starts
+        starts.append(micros)
+        year, month = (year + 1, 1) if month + months > 12 else (year, month + months)
+
+
+class _LoanHistory(_Derived):
+    """
+    Every loan as columns (book and patron numbers, loan, return and due
+    dates in epoch microseconds) for analytics. When the app already keeps loans
+    in a _LoanColumns store the history is that store's own arrays; else it
+    keeps copies, appended to on checkout and patched on return. Date
+    ranges are found by bisecting the loan dates, and a report is one pass
+    over the selected rows. Loans whose dates are not ISO timestamps are
+    left out.
+    """
+
+    def __init__(self):
+        self.store: Optional[_LoanColumns] = None
+        self.books = _Interner()
+        self.patrons = _Interner()
+        self.book = array("I")
+        self.patron = array("I")
+        self.loan_date = array("q")
+        self.return_date = array("q")
+        self.due_date = array("q")
+        self.open_rows: Dict[str, int] = {}
+        self._sorted_upto = 0
+        self._sorted = True
+
+    def build(self, app: "LibraryApp") -> None:
+        if isinstance(app.loans, _LoanColumns):
+            store = self.store = app.loans
+            self.books, self.patrons = store._books, store._patrons
+            self.book, self.patron = store._book, store._patron
+            self.loan_date, self.return_date = store._loan_date, store._return_date
+            self.due_date = store._due_date
+            return
+        for loan in app.loans.values():
+            self._append(loan)
+
+    def _append(self, loan: "Loan") -> None:
+        self.open_rows[loan.id] = len(self.book)
+        self.book.append(self.books.number(loan.book_id))
+        self.patron.append(self.patrons.number(loan.patron_id))
+        loaned = _iso_micros(loan.loan_date)
+        self.loan_date.append(_NO_DATE if loaned is None else loaned)
+        self.return_date.append(_NO_DATE)
+        due = _iso_micros(loan.due_date)
+        self.due_date.append(_NO_DATE if due is None else due)
+        if loan.return_date is not None:
+            self.loan_closed(loan, None)
+
+    def loan_opened(self, loan: "Loan", book: Optional["Book"]) -> None:
+        if self.store is None:
+            self._append(loan)
+
+    def loan_closed(self, loan: "Loan", book: Optional["Book"]) -> None:
+        if self.store is None:
+            row = self.open_rows.pop(loan.id, None)
+            returned = _iso_micros(loan.return_date)
+            if row is not None:
+                self.return_date[row] = _ODD_DATE if returned is None else returned
+
+    def _is_sorted(self) -> bool:
+        # loans arrive in date order, so only the new tail needs checking
+        dates, done = self.loan_date, self._sorted_upto
+        if self._sorted and len(dates) > done:
+            tail = dates[max(done - 1, 0):]
+            self._sorted = all(map(operator.le, tail, tail[1:]))
+            self._sorted_upto = len(dates)
+        return self._sorted
+
+    def rows(self, since: Optional[int], until: Optional[int]):
+        """Rows with a known loan date in [since, until), as a range when possible."""
+        dates = self.loan_date
+        lo_value = _ODD_DATE + 1 if since is None else max(since, _ODD_DATE + 1)
+        deleted = self.store is not None and len(self.store._rows) != len(self.store._keys)
+        if self._is_sorted() and not deleted:
+            lo = bisect.bisect_left(dates, lo_value)
+            hi = len(dates) if until is None else bisect.bisect_left(dates, until)
+            return range(lo, max(lo, hi))
+        keep = map(operator.ge, dates, itertools.repeat(lo_value))
+        if until is not None:
+            keep = map(operator.and_, keep, map(operator.lt, dates, itertools.repeat(until)))
+        if deleted:
+            keep = map(operator.and_, keep, map(operator.is_not, self.store._keys, itertools.repeat(None)))
+        return list(itertools.compress(range(len(dates)), keep))
+
+    def _take(self, column: array, rows) -> array:
+        if isinstance(rows, range):
+            return column[rows.start:rows.stop]
+        return array(column.typecode, map(column.__getitem__, rows))
+
+    def group_keys(self, by: str, rows, loaned: array) -> Tuple[list, Callable[[int], object]]:
+        """Per-row group numbers and a function turning a group number into its label."""
+        if by == "book":
+            return self._take(self.book, rows), self.books.values.__getitem__
+        if by == "patron":
+            return self._take(self.patron, rows), self.patrons.values.__getitem__
+        if by == "day":
+            return (list(map(operator.floordiv, loaned, itertools.repeat(_DAY_US))),
+                    lambda day: (_EPOCH + timedelta(days=day)).date().isoformat())
+        if by in ("month", "year"):
+            if not loaned:
+                return [], str
+            starts = _period_starts(min(loaned), max(loaned), 12 if by == "year" else 1)
+            fmt = "%Y" if by == "year" else "%Y-%m"
+            keys = list(map(bisect.bisect_right, itertools.repeat(starts), loaned))
+            return keys, lambda n: (_EPOCH + _MICROSECOND * starts[n - 1]).strftime(fmt)
+        raise ValueError(f"Unknown grouping {by!r}; expected one of {_LOAN_GROUPS}")
+
+    def report(self, by: str, since: Optional[int], until: Optional[int]) -> Dict[object, Dict[str, object]]:
+        rows = self.rows(since, until)
+        loaned = self._take(self.loan_date, rows)
+        returned = self._take(self.return_date, rows)
+        keys, label = self.group_keys(by, rows, loaned)
+        groups: Dict[int, List[int]] = {}  # group -> [loans, returned, total length of those]
+        for key, start, end in zip(keys, loaned, returned):
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = [0, 0, 0]
+            group[0] += 1
+            if end > _ODD_DATE:
+                group[1] += 1
+                group[2] += end - start
+        result = {}
+        for key in sorted(groups):
+            size, n_done, total = groups[key]
+            result[label(key)] = {
+                "loans": size,
+                "returned": n_done,
+                "open": size - n_done,
+                "avg_days": total / n_done / _DAY_US if n_done else None,
+            }
+        return result
+
+    def busiest(self, by: str, n: int, since: Optional[int], until: Optional[int]) -> List[Tuple[str, int]]:
+        rows = self.rows(since, until)
+        column, values = (self.book, self.books.values) if by == "book" else (self.patron, self.patrons.values)
+        counts = collections.Counter(self._take(column, rows))
+        return [(values[code], count) for code, count in counts.most_common(n)]
+
+
+def _due_micros(loan: "Loan", book: Optional["Book"]) -> Optional[int]:
+    if loan.due_date is not None:
+        return _iso_micros(loan.due_date)
+    # loans from before due dates existed fall due one loan period after checkout
+    loaned = _iso_micros(loan.loan_date)
+    if loaned is None:
+        return None
+    return loaned + loan_period(book.item_type if book is not None else "book") * _DAY_US
+
+
+class _OverdueIndex(_Derived):
+    """
+    Open loans in a min-heap keyed on due date (epoch microseconds).
+    Returned loans are dropped lazily and the heap is rebuilt once they make
+    up half of it. Loans due before a moment are found by visiting only heap
+    nodes due before it, so the cost follows the answer, not the loan count.
+    """
+
+    def __init__(self):
+        self.heap: List[Tuple[int, str]] = []
+        self.due: Dict[str, int] = {}  # open loan id -> due
 
     @classmethod
-    def from_dict(cls, data: dict) -> "Loan":
-        return cls(**data)
+    def from_snapshot(cls, due: Dict[str, int]) -> "_OverdueIndex":
+        """The index over due dates saved by _snapshot_stats, instead of a build()."""
+        index = cls()
+        index.due = dict(due)
+        index.heap = [(micros, loan_id) for loan_id, micros in index.due.items()]
+        heapq.heapify(index.heap)
+        return index
 
+    def build(self, app: "LibraryApp") -> None:
+        for loan in app._open_loans():
+            due = _due_micros(loan, app.books.get(loan.book_id) if loan.due_date is None else None)
+            if due is not None:
+                self.due[loan.id] = due
+        self.heap = [(due, loan_id) for loan_id, due in self.due.items()]
+        heapq.heapify(self.heap)
 
-# ---------------------------
-# Persistence & I/O
-# ---------------------------
+    def loan_opened(self, loan: "Loan", book: Optional["Book"]) -> None:
+        due = _due_micros(loan, book)
+        if due is not None:
+            self.due[loan.id] = due
+            heapq.heappush(self.heap, (due, loan.id))
 
-class PersistenceError(Exception):
-    pass
+    def loan_closed(self, loan: "Loan", book: Optional["Book"]) -> None:
+        self.due.pop(loan.id, None)
+        if len(self.heap) > 2 * len(self.due) + 64:
+            self.heap = [(due, loan_id) for loan_id, due in self.due.items()]
+            heapq.heapify(self.heap)
+
+    def due_before(self, moment: int) -> List[Tuple[int, str]]:
+        """(due, loan id) of open loans due before `moment`, earliest first."""
+        heap, due = self.heap, self.due
+        found = []
+        stack = [0] if heap else []
+        while stack:
+            i = stack.pop()
+            entry = heap[i]
+            if entry[0] >= moment:
+                continue  # nothing below this node is due earlier
+            if due.get(entry[1]) == entry[0]:
+                found.append(entry)
+            stack.extend(c for c in (2 * i + 1, 2 * i + 2) if c < len(heap))
+        found.sort()
+        return found
+
+
+class _Fines(_Derived):
+    """
+    Fines per patron: min(days overdue, max_days) * per_day for every
+    loan returned late or still out past its due date, at the rate of the
+    book's item type. Late returns are settled once, in a single pass over
+    the _LoanHistory columns, and the returning patron's total is adjusted
+    on every later return; fines still accruing on open loans come from the
+    overdue heap. Per-patron answers are cached for the day and dropped
+    when that patron returns something.
+    """
+
+    def __init__(self, rates: Dict[str, FineRate]):
+        self.rates = dict(rates)
+        self.settled: Dict[str, float] = {}
+        self.cache: Dict[str, Tuple[int, float]] = {}  # patron -> (day, total)
+
+    def rate(self, item_type: str) -> FineRate:
+        return self.rates.get(item_type) or self.rates.get("book") or FineRate()
+
+    def fine(self, due: Optional[int], until: int, item_type: str) -> float:
+        # counted in calendar (UTC) days, so a fine only changes at midnight
+        if due is None:
+            return 0.0
+        days = until // _DAY_US - due // _DAY_US
+        if days <= 0:
+            return 0.0
+        rate = self.rate(item_type)
+        return min(days, rate.max_days) * rate.per_day
+
+    def build(self, app: "LibraryApp") -> None:
+        history = app._index(_LoanHistory)
+        item_types = {book.id: book.item_type for book in getattr(app.books, "scan", app.books.values)()}
+        # item type of each book number in the history
+        kinds = [item_types.get(book_id, "book") for book_id in history.books.values]
+        rates = [self.rate(kind) for kind in kinds]
+        patrons = history.patrons.values
+        settled = self.settled
+        for book, patron, loaned, due, returned in zip(history.book, history.patron, history.loan_date,
+                                                       history.due_date, history.return_date):
+            if returned <= _ODD_DATE:
+                continue  # still out, or returned at an unreadable time
+            if due == _NO_DATE:
+                if loaned <= _ODD_DATE:
+                    continue
+                # legacy loans without a due date fall due one loan period after checkout
+                due = loaned + loan_period(kinds[book]) * _DAY_US
+            elif due == _ODD_DATE:
+                continue
+            days = returned // _DAY_US - due // _DAY_US
+            if days > 0:
+                rate = rates[book]
+                name = patrons[patron]
+                settled[name] = settled.get(name, 0.0) + min(days, rate.max_days) * rate.per_day
+
+    def loan_closed(self, loan: "Loan", book: Optional["Book"]) -> None:
+        returned = _iso_micros(loan.return_date)
+        if returned is not None:
+            amount = self.fine(_due_micros(loan, book), returned, book.item_type if book else "book")
+            if amount:
+                self.settled[loan.patron_id] = self.settled.get(loan.patron_id, 0.0) + amount
+        self.cache.pop(loan.patron_id, None)
+
+
+_TOKEN = re.compile(r"\w+")
+_FIELD_WEIGHTS = (("title", 2.0), ("author", 1.0))
+
+
+def _tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.casefold()) if text else []
+
+
+class _SearchIndex(_Derived):
+    """
+    Inverted index over Book.title and Book.author: term -> {book_id: weight},
+    where a title hit weighs more than an author hit. Terms are also kept
+    sorted so a prefix maps to a contiguous run of them.
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, float]] = {}
+        self.terms: List[str] = []
+        self.size = 0
+
+    def build(self, app: "LibraryApp") -> None:
+        for book in app.books.values():
+            self._add(book)
+        self.terms = sorted(self.postings)
+
+    def book_added(self, book: "Book") -> None:
+        for term in self._add(book):
+            bisect.insort(self.terms, term)
+
+    def book_changed(self, old: "Book", book: "Book") -> None:
+        for field, _ in _FIELD_WEIGHTS:
+            for term in _tokenize(getattr(old, field)):
+                posting = self.postings.get(term)
+                if posting is not None and posting.pop(old.id, None) is not None and not posting:
+                    del self.postings[term]
+                    del self.terms[bisect.bisect_left(self.terms, term)]
+        self.size -= 1
+        self.book_added(book)
+
+    def _add(self, book: "Book") -> List[str]:
+        new_terms = []
+        weights: Dict[str, float] = {}
+        for field, weight in _FIELD_WEIGHTS:
+            for term in _tokenize(getattr(book, field)):
+                weights[term] = weights.get(term, 0.0) + weight
+        for term, weight in weights.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = {}
+                new_terms.append(term)
+            posting[book.id] = weight
+        self.size += 1
+        return new_terms
+
+    def _expand(self, prefix: str) -> List[str]:
+        start = bisect.bisect_left(self.terms, prefix)
+        end = start
+        while end < len(self.terms) and self.terms[end].startswith(prefix):
+            end += 1
+        return self.terms[start:end]
+
+    def query(self, text: str, limit: int, prefix: bool) -> List[Tuple[float, str]]:
+        tokens = _tokenize(text)
+        if not tokens:
+            return []
+        # every token must match; the last one may be a prefix of a term
+        per_token: List[Dict[str, float]] = []
+        for i, token in enumerate(tokens):
+            terms = self._expand(token) if prefix and i == len(tokens) - 1 else [token]
+            scores: Dict[str, float] = {}
+            for term in terms:
+                posting = self.postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + self.size / len(posting))
+                for book_id, weight in posting.items():
+                    score = weight * idf
+                    if score > scores.get(book_id, 0.0):
+                        scores[book_id] = score
+            if not scores:
+                return []
+            per_token.append(scores)
+        per_token.sort(key=len)
+        candidates = per_token[0]
+        for scores in per_token[1:]:
+            candidates = {bid: s + scores[bid] for bid, s in candidates.items() if bid in scores}
+            if not candidates:
+                return []
+        return heapq.nlargest(limit, ((score, bid) for bid, score in candidates.items()))
+
+    def fuzzy_query(self, text: str, trigrams: "_TrigramIndex", limit: int, threshold: float,
+                    prefix: bool) -> List[Tuple[float, str]]:
+        tokens = _tokenize(text)
+        if not tokens:
+            return []
+        # per book, the best similarity reached for each query word, averaged
+        totals: Dict[str, float] = {}
+        for i, token in enumerate(tokens):
+            similar = trigrams.similar(token, threshold)
+            if prefix and i == len(tokens) - 1:
+                similar.update(dict.fromkeys(self._expand(token), 1.0))
+            best: Dict[str, float] = {}
+            for term, similarity in similar.items():
+                for book_id in self.postings.get(term, ()):
+                    if similarity > best.get(book_id, 0.0):
+                        best[book_id] = similarity
+            for book_id, similarity in best.items():
+                totals[book_id] = totals.get(book_id, 0.0) + similarity
+        n = len(tokens)
+        return heapq.nlargest(limit, ((total / n, bid) for bid, total in totals.items() if total / n >= threshold))
+
+
+def _trigrams(term: str) -> Set[str]:
+    padded = f"  {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class _TrigramIndex(_Derived):
+    """
+    Trigram index over the search vocabulary (words of titles and authors),
+    used to find terms that look like a misspelled query word. Indexing
+    terms rather than books keeps it small: the catalog grows much faster
+    than the vocabulary.
+    """
+
+    def __init__(self):
+        self.grams: Dict[str, List[str]] = {}
+        self.gram_count: Dict[str, int] = {}
+
+    def build(self, app: "LibraryApp") -> None:
+        for term in app._index(_SearchIndex).postings:
+            self._add_term(term)
+
+    def book_added(self, book: "Book") -> None:
+        for field, _ in _FIELD_WEIGHTS:
+            for term in _tokenize(getattr(book, field)):
+                if term not in self.gram_count:
+                    self._add_term(term)
+
+    def book_changed(self, old: "Book", book: "Book") -> None:
+        # terms that lost their last book stay; they simply match no postings
+        self.book_added(book)
+
+    def _add_term(self, term: str) -> None:
+        grams = _trigrams(term)
+        self.gram_count[term] = len(grams)
+        for gram in grams:
+            self.grams.setdefault(gram, []).append(term)
+
+    def similar(self, token: str, threshold: float) -> Dict[str, float]:
+        """Vocabulary terms whose trigram Jaccard similarity to `token` is >= threshold."""
+        grams = _trigrams(token)
+        shared: Dict[str, int] = {}
+        for gram in grams:
+            for term in self.grams.get(gram, ()):
+                shared[term] = shared.get(term, 0) + 1
+        n = len(grams)
+        result = {}
+        for term, common in shared.items():
+            similarity = common / (n + self.gram_count[term] - common)
+            if similarity >= threshold:
+                result[term] = similarity
+        return result
+
+
+def _title_author_year_key(book: "Book") -> tuple:
+    return " ".join(_tokenize(book.title)), " ".join(_tokenize(book.author)), book.year
+
+
+def _isbn_key(book: "Book") -> Optional[str]:
+    return re.sub(r"[^0-9X]", "", book.isbn.upper()) or None if book.isbn else None
+
+
+# natural keys for upsert imports; a key of None means "never matches"
+BOOK_KEYS: Dict[str, Callable[["Book"], object]] = {
+    "title_author_year": _title_author_year_key,
+    "isbn": _isbn_key,
+}
+
+
+class _BookKeyIndex(_Derived):
+    """Hash index natural key -> book id; the first book seen with a key owns it."""
+
+    def __init__(self, key: Callable[["Book"], object]):
+        self.key = key
+        self.ids: Dict[object, str] = {}
+
+    def build(self, app: "LibraryApp") -> None:
+        for book in app.books.values():
+            self.book_added(book)
+
+    def book_added(self, book: "Book") -> None:
+        key = self.key(book)
+        if key is not None:
+            self.ids.setdefault(key, book.id)
+
+    def book_changed(self, old: "Book", book: "Book") -> None:
+        key = self.key(old)
+        if self.ids.get(key) == old.id:
+            del self.ids[key]
+        self.book_added(book)
+
+
+def _merge_book(current: "Book", incoming: "Book", on_match: str) -> "Book":
+    # fields `incoming` leaves as None were not in the feed (see _RowParser) and keep their stored value
+    if on_match == "add":
+        return dataclasses.replace(current, copies_total=current.copies_total + incoming.copies_total,
+                                   copies_available=current.copies_available + incoming.copies_total)
+    changes = {f.name: getattr(incoming, f.name) for f in fields(Book)
+               if f.name not in ("id", "copies_total", "copies_available") and getattr(incoming, f.name) is not None}
+    if incoming.copies_total is None:
+        return dataclasses.replace(current, **changes)
+    out = current.copies_total - current.copies_available
+    if incoming.copies_total < out:
+        raise ValueError(f"copies {incoming.copies_total} is fewer than the {out} on loan")
+    return dataclasses.replace(current, copies_total=incoming.copies_total,
+                               copies_available=incoming.copies_total - out, **changes)
 
 
 class LibraryApp:
     """
     Controller for library functions and persistence.
+
+    State lives in a storage backend. The default "json" backend keeps a
+    snapshot file (see JsonBackend for journal=, lazy=, codec= and
+    columnar_loans=); with backend="sqlite" the tables live in a SQLite
+    database instead.
+
+    State files are parsed incrementally, one record at a time; pass
+    `progress(section, count)` to be told how far loading has got.
+
+    `codec` picks the snapshot format written by `save_state` ("json" or the
+    compact "binary"); loading detects the format of whatever file it finds.
+
+    Snapshots are written atomically. Concurrent `save_state()` calls are
+    group-committed: callers arriving within `group_commit_window` seconds
+    (or while a write is in flight) share a single write + fsync.
+
+    With thread_safe=True one app can serve many threads. Circulation calls
+    hold the state lock shared and serialize only on striped per-book locks,
+    so desks working on different books run in parallel. Queries and reports
+    hold it shared too and read the derived indexes under a shared index
+    lock, which index updates take exclusively; only building an index and
+    full-table copies (exports, imports, saves) hold the state lock
+    exclusively, so they see no half-applied change.
     """
 
-    def __init__(self, state_path: Optional[Path] = None):
+    def __init__(self, state_path: Optional[Path] = None, journal: bool = False,
+                 compact_threshold: int = 4 * 1024 * 1024, group_commit_window: float = 0.0,
+                 progress: Optional[Callable[[str, int], None]] = None, lazy: bool = False,
+                 codec: str = "json", backend: str = "json", columnar_loans: bool = False,
+                 thread_safe: bool = False):
         base = Path(__file__).parent
-        self.state_path: Path = (Path(state_path) if state_path else base / "library_state.json")
-        self.books: Dict[str, Book] = {}
-        self.patrons: Dict[str, Patron] = {}
-        self.loans: Dict[str, Loan] = {}
-        self._load_state_if_exists()
+        if backend == "json":
+            self.state_path: Path = (Path(state_path) if state_path else base / "library_state.json")
+            self._backend: StorageBackend = JsonBackend(self.state_path, SNAPSHOT_CODECS[codec], lazy=lazy,
+                                                        journal=journal, compact_threshold=compact_threshold,
+                                                        columnar_loans=columnar_loans)
+        elif backend == "sqlite":
+            snapshot_only = [f"{name}=True" for name, value in
+                             (("journal", journal), ("lazy", lazy), ("columnar_loans", columnar_loans)) if value]
+            if snapshot_only:
+                raise ValueError(f"{', '.join(snapshot_only)} only applies to the json backend; "
+                                 "backend='sqlite' keeps its rows in the database")
+            self.state_path = Path(state_path) if state_path else base / "library_state.db"
+            self._backend = SqliteBackend(self.state_path, SNAPSHOT_CODECS[codec])
+        else:
+            raise ValueError(f"Unknown storage backend: {backend!r}")
+        self.books: MutableMapping[str, Book] = {}
+        self.patrons: MutableMapping[str, Patron] = {}
+        self.loans: MutableMapping[str, Loan] = {}
+        self._group_commit = _GroupCommit(group_commit_window)
+        self._derived: Dict[object, _Derived] = {}
+        self.fine_rates: Dict[str, FineRate] = dict(FINE_RATES)
+        self.thread_safe = thread_safe
+        self._state_lock = _RWLock() if thread_safe else _Unlocked()
+        self._book_locks = _StripedLocks() if thread_safe else _Unlocked()
+        self._index_lock = _RWLock() if thread_safe else _Unlocked()
+        self._loan_lock = threading.Lock() if thread_safe else _Unlocked()  # columnar loan store inserts
+        self._load_state_if_exists(progress)
+
+    # ------- Persistence --------
+    @property
+    def codec(self) -> SnapshotCodec:
+        return self._backend.codec
+
+    @codec.setter
+    def codec(self, codec: SnapshotCodec) -> None:
+        self._backend.codec = codec
 
-    # ------- Persistence (JSON) --------
     def save_state(self, path: Optional[Path] = None) -> None:
         path = Path(path) if path else self.state_path
-        data = {
-            "books": {bid: b.to_dict() for bid, b in self.books.items()},
-            "patrons": {pid: p.to_dict() for pid, p in self.patrons.items()},
-            "loans": {lid: l.to_dict() for lid, l in self.loans.items()},
-        }
-        try:
-            with path.open("w", encoding="utf-8") as f:
-                json.dump(data, f, indent=2)
-        except Exception as e:
-            raise PersistenceError(f"Failed to save state to {path}: {e}")
+        if path != self.state_path:
+            _write_snapshot(self, path, self.codec)
+        else:
+            self._group_commit.run(lambda: self._backend.save(self))
 
-    def _load_state_if_exists(self) -> None:
-        if not self.state_path.exists():
-            return
+    @_guarded("exclusive")
+    def compact(self) -> None:
+        """Fold the journal into a fresh snapshot of the current state."""
+        self._backend.compact(self)
+
+    def close(self) -> None:
+        self._backend.close()
+
+    def _commit(self, *records: dict) -> None:
+        self._backend.commit(records)
+
+    def _commit_many(self, records: Iterable[dict]) -> None:
+        # backends that ignore records (plain snapshots) never build them
+        self._backend.commit(records)
+
+    def _load_state_if_exists(self, progress: Optional[Callable[[str, int], None]] = None) -> None:
+        self._derived.clear()
         try:
-            with self.state_path.open("r", encoding="utf-8") as f:
-                data = json.load(f)
-            self.books = {bid: Book.from_dict(d) for bid, d in data.get("books", {}).items()}
-            self.patrons = {pid: Patron.from_dict(d) for pid, d in data.get("patrons", {}).items()}
-            self.loans = {lid: Loan.from_dict(d) for lid, d in data.get("loans", {}).items()}
+            self.books, self.patrons, self.loans = self._backend.load(progress)
         except Exception as e:
             raise PersistenceError(f"Failed to load state from {self.state_path}: {e}")
+        self._seed_derived()
 
-    def load_state(self, path: Path) -> None:
+    @_guarded("exclusive")
+    def load_state(self, path: Path, progress: Optional[Callable[[str, int], None]] = None) -> None:
         p = Path(path)
         if not p.exists():
             raise PersistenceError(f"State file does not exist: {p}")
+        self._derived.clear()
         try:
-            with p.open("r", encoding="utf-8") as f:
-                data = json.load(f)
-            self.books = {bid: Book.from_dict(d) for bid, d in data.get("books", {}).items()}
-            self.patrons = {pid: Patron.from_dict(d) for pid, d in data.get("patrons", {}).items()}
-            self.loans = {lid: Loan.from_dict(d) for lid, d in data.get("loans", {}).items()}
-            self.state_path = p
+            self.books, self.patrons, self.loans = self._backend.load_from(p, progress)
+            self.state_path = self._backend.path
         except Exception as e:
             raise PersistenceError(f"Failed to load state: {e}")
+        self._seed_derived()
+
+    def _seed_derived(self) -> None:
+        # saved totals spare a lazy load from decoding every record for summary()
+        stats = self._backend.stats
+        if stats is not None:
+            self._derived[_Stats] = _Stats.from_snapshot(stats)
+            self._derived[_OverdueIndex] = _OverdueIndex.from_snapshot(stats["due"])
+
+    # ------- Derived indexes --------
+    def _index(self, kind: type, *args) -> _Derived:
+        slot = (kind, *args) if args else kind
+        index = self._derived.get(slot)
+        if index is None:
+            if not self._state_lock.held_exclusively():
+                raise _IndexNotBuilt(slot)
+            index = kind(*args)
+            index.build(self)
+            self._derived[slot] = index
+        return index
+
+    def _notify(self, event: str, *args) -> None:
+        with self._index_lock.exclusive():
+            for index in self._derived.values():
+                getattr(index, event)(*args)
+
+    def _open_loans(self) -> Iterable[Loan]:
+        where = getattr(self.loans, "where", None)
+        if where is not None:
+            return where("return_date IS NULL")
+        loans = getattr(self.loans, "scan", self.loans.values)()
+        return (loan for loan in loans if loan.return_date is None)
 
     # ------- CSV import/export --------
-    def import_books_from_csv(self, csv_path: Path) -> List[Book]:
+    def import_books_from_csv(self, csv_path: Path, **options) -> List[Book]:
+        return self.import_books(csv_path, **options).books
+
+    def import_books(self, csv_path: Path, workers: int = 1, chunk_bytes: int = 8 * 1024 * 1024,
+                     batch_size: int = 10000, retain: bool = True, profile="default",
+                     key=None, on_match: str = "update") -> ImportReport:
+        """
+        Import books from CSV and report what happened. With workers > 1 the
+        file is cut into ~`chunk_bytes` byte ranges that are parsed and
+        validated in a process pool; results are merged in file order.
+        retain=False leaves report.books empty (the counters still count).
+        See iter_import_books for `key` and `on_match`.
+        """
+        report = ImportReport()
+        for batch in self.iter_import_books(csv_path, batch_size, workers, chunk_bytes, report, profile,
+                                            key, on_match):
+            if retain:
+                report.books.extend(batch)
+        return report
+
+    def iter_import_books(self, csv_path: Path, batch_size: int = 10000, workers: int = 1,
+                          chunk_bytes: int = 8 * 1024 * 1024,
+                          report: Optional[ImportReport] = None, profile="default",
+                          key=None, on_match: str = "update") -> Iterator[List[Book]]:
+        """
+        Stream books from CSV in batches of up to `batch_size`. Each batch is
+        stored, committed and indexed before it is yielded, so a consumer that
+        drops the batches only holds one batch at a time on top of the store.
+        Skipped rows and chunk stats accumulate in `report` if one is given.
+        `profile` is an ImportProfile or the name of one in IMPORT_PROFILES.
+
+        With a `key` (a name in BOOK_KEYS or a function of a Book) rows whose
+        key matches a stored book are merged into it instead of inserted:
+        on_match="update" takes the row's non-blank fields and copy count, "add"
+        adds the row's copies. Batches then hold the inserted and changed
+        books. An update that would leave fewer copies than are on loan is
+        skipped.
+        """
         csv_path = Path(csv_path)
         if not csv_path.exists():
             raise PersistenceError(f"CSV file not found: {csv_path}")
-        added = []
+        report = report if report is not None else ImportReport()
+        if isinstance(profile, str):
+            if profile not in IMPORT_PROFILES:
+                raise ValueError(f"Unknown import profile: {profile!r}")
+            profile = IMPORT_PROFILES[profile]
+        if isinstance(key, str):
+            if key not in BOOK_KEYS:
+                raise ValueError(f"Unknown book key: {key!r}")
+            key = BOOK_KEYS[key]
+        if on_match not in ("update", "add"):
+            raise ValueError(f"Unknown on_match mode: {on_match!r}")
+        # an update must tell blank cells from values, so rows stay partial until stored
+        partial = key is not None and on_match == "update"
         try:
-            with csv_path.open("r", encoding="utf-8", newline="") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    title = (row.get("title") or row.get("Title") or "").strip()
-                    author = (row.get("author") or row.get("Author") or "Unknown").strip()
-                    year_raw = (row.get("year") or row.get("Year") or "").strip()
-                    copies_raw = (row.get("copies") or row.get("Copies") or "1").strip()
-                    year = int(year_raw) if year_raw.isdigit() else None
-                    try:
-                        copies = max(1, int(copies_raw))
-                    except Exception:
-                        copies = 1
-                    if not title:
-                        # skip invalid rows
-                        continue
-                    book = Book.create(title=title, author=author, year=year, copies=copies)
-                    self.books[book.id] = book
-                    added.append(book)
-            return added
+            fieldnames, chunks = _csv_chunks(csv_path, chunk_bytes if workers > 1 else 1 << 62, profile.delimiter)
+            # fails on an unusable header before any work is done
+            parser = profile.compile(fieldnames)
+            store = functools.partial(self._store_imported, report=report, key=key, on_match=on_match,
+                                      complete=parser.complete)
+            jobs = [(csv_path, i, start, end, line, fieldnames, profile, partial)
+                    for i, (start, end, line) in enumerate(chunks)]
+            if workers > 1 and len(jobs) > 1:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                    # keep only a couple of chunks per worker in flight
+                    waiting = iter(jobs)
+                    pending = [pool.submit(_parse_csv_chunk_packed, *job)
+                               for job in itertools.islice(waiting, 2 * workers)]
+                    while pending:
+                        packed, skipped, stats = pending.pop(0).result()
+                        pending.extend(pool.submit(_parse_csv_chunk_packed, *job)
+                                       for job in itertools.islice(waiting, 1))
+                        report.skipped.extend(skipped)
+                        report.chunks.append(stats)
+                        for i in range(0, len(packed), batch_size):
+                            yield store([(t[0], Book(*t[1:])) for t in packed[i:i + batch_size]])
+            else:
+                for index, (start, end, line) in enumerate(chunks):
+                    started, rows, batch = time.perf_counter(), 0, []
+                    for line_no, book, reason in _iter_csv_range(csv_path, start, end, line, fieldnames, profile,
+                                                                 partial):
+                        rows += 1
+                        if book is None:
+                            report.skipped.append((line_no, reason))
+                            continue
+                        batch.append((line_no, book))
+                        if len(batch) >= batch_size:
+                            yield store(batch)
+                            batch = []
+                    if batch:
+                        yield store(batch)
+                    report.chunks.append(ChunkStats(index, start, end, rows, time.perf_counter() - started))
         except PersistenceError:
             raise
         except Exception as e:
             raise PersistenceError(f"Failed to import CSV {csv_path}: {e}")
 
-    def export_books_to_csv(self, csv_path: Path) -> None:
+    @_guarded("exclusive")
+    def _store_imported(self, rows: List[Tuple[int, Book]], report: ImportReport, key=None,
+                        on_match: str = "update", complete: Callable[[Book], Book] = lambda book: book) -> List[Book]:
+        # rows are (line number, book); partial books are completed before they are inserted
+        if key is None:
+            books = [book for _, book in rows]
+            with self._backend.transaction():
+                for book in books:
+                    self.books[book.id] = book
+                self._commit_many({"op": "book", "book": b.to_dict()} for b in books)
+            for book in books:
+                self._notify("book_added", book)
+            report.inserted += len(books)
+            return books
+        with self._backend.transaction():
+            return self._store_keyed(rows, report, self._index(_BookKeyIndex, key), on_match, complete)
+
+    def _store_keyed(self, rows: List[Tuple[int, Book]], report: ImportReport, index: "_BookKeyIndex",
+                     on_match: str, complete: Callable[[Book], Book]) -> List[Book]:
+        # notify as we go so that repeats within the batch find each other
+        stored = []
+        for line, row in rows:
+            book = complete(row)
+            book_id = index.ids.get(index.key(book))
+            if book_id is None:
+                self.books[book.id] = book
+                self._notify("book_added", book)
+                report.inserted += 1
+                stored.append(book)
+                continue
+            current = self.books[book_id]
+            try:
+                merged = _merge_book(current, row, on_match)
+            except ValueError as e:
+                report.skipped.append((line, str(e)))
+                continue
+            if merged == current:
+                report.unchanged += 1
+                continue
+            self.books[book_id] = merged
+            self._notify("book_changed", current, merged)
+            report.updated += 1
+            stored.append(merged)
+        self._commit_many({"op": "book", "book": b.to_dict()} for b in stored)
+        return stored
+
+    def export_books_to_csv(self, csv_path: Path, **options) -> int:
+        return self.export_csv("books", csv_path, **options)
+
+    def export_patrons_to_csv(self, csv_path: Path, **options) -> int:
+        return self.export_csv("patrons", csv_path, **options)
+
+    def export_loans_to_csv(self, csv_path: Path, **options) -> int:
+        return self.export_csv("loans", csv_path, **options)
+
+    @_guarded("exclusive")
+    def export_csv(self, table: str, csv_path: Path, columns: Optional[List[str]] = None,
+                   where: Optional[Callable[[object], bool]] = None,
+                   compression: Optional[str] = None) -> int:
+        """
+        Stream one table ("books", "patrons" or "loans") to CSV and return the
+        number of rows written. `columns` picks and orders fields (default:
+        all), `where` filters records, and `compression` ("gzip", "bz2",
+        "xz", or "zstd" where available) defaults from the file suffix.
+        The file is replaced atomically once it is complete.
+        """
         csv_path = Path(csv_path)
+        model = dict(_MODELS).get(table)
+        if model is None:
+            raise ValueError(f"Unknown table: {table!r}")
+        columns = list(columns) if columns else [f.name for f in fields(model)]
+        unknown = set(columns) - {f.name for f in fields(model)}
+        if unknown:
+            raise ValueError(f"Unknown {table} columns: {sorted(unknown)}")
+        if compression is None:
+            compression = _EXPORT_SUFFIXES.get(csv_path.suffix)
+        elif compression not in EXPORT_COMPRESSION:
+            raise ValueError(f"Unknown compression: {compression!r}")
+        records = getattr(self, table).values()
+        if where is not None:
+            records = filter(where, records)
+        get = operator.attrgetter(*columns)
+        rows = map(get, records) if len(columns) > 1 else ((get(r),) for r in records)
+        written = 0
         try:
-            # ensure parent exists
             csv_path.parent.mkdir(parents=True, exist_ok=True)
-            with csv_path.open("w", encoding="utf-8", newline="") as f:
-                writer = csv.writer(f)
-                writer.writerow(["id", "title", "author", "year", "copies_total", "copies_available"])
-                for b in self.books.values():
-                    writer.writerow([b.id, b.title, b.author, b.year, b.copies_total, b.copies_available])
+
+            def write(f):
+                nonlocal written
+                written = _write_csv(f, compression, columns, rows)
+
+            _atomic_write(csv_path, write, "wb")
         except Exception as e:
             raise PersistenceError(f"Failed to export CSV to {csv_path}: {e}")
+        return written
+
+    def export_all(self, dest_dir: Path, tables: Iterable[str] = ("books", "patrons", "loans"),
+                   shards: int = 1, workers: int = 4, processes: bool = False,
+                   compression: Optional[str] = "gzip") -> Dict[Path, int]:
+        """
+        Export whole tables into `dest_dir` as <table>.csv[.gz], or as
+        <table>-NN.csv[.gz] split into `shards` by id prefix, and return the
+        row count per file. All rows are copied at one point in time up
+        front; the files are then written concurrently on a thread pool (a
+        process pool with processes=True) while the app keeps serving.
+        """
+        dest_dir = Path(dest_dir)
+        if compression is not None and compression not in EXPORT_COMPRESSION:
+            raise ValueError(f"Unknown compression: {compression!r}")
+        suffix = ".csv" + next((s for s, c in _EXPORT_SUFFIXES.items() if c == compression), "")
+        models = dict(_MODELS)
+        tables = list(tables)
+        for table in tables:
+            if table not in models:
+                raise ValueError(f"Unknown table: {table!r}")
+        try:
+            with self._state_lock.exclusive():
+                snapshot = self._backend.snapshot_rows(self)
+            dest_dir.mkdir(parents=True, exist_ok=True)
+            jobs = []
+            for table in tables:
+                header = [f.name for f in fields(models[table])]
+                rows = snapshot.pop(table)
+                if shards <= 1:
+                    jobs.append((dest_dir / (table + suffix), compression, header, rows))
+                    continue
+                parts: List[List[tuple]] = [[] for _ in range(shards)]
+                for row in rows:
+                    parts[_shard_of(row[0], shards)].append(row)
+                jobs.extend((dest_dir / f"{table}-{i:02d}{suffix}", compression, header, part)
+                            for i, part in enumerate(parts))
+            if not jobs:
+                return {}
+            pool_type = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+            with pool_type(max_workers=workers) as pool:
+                counts = pool.map(_export_rows, *zip(*jobs))
+                return {job[0]: count for job, count in zip(jobs, counts)}
+        except Exception as e:
+            raise PersistenceError(f"Failed to export to {dest_dir}: {e}")
 
     # ------- Business logic --------
-    def add_book(self, title: str, author: str, year: Optional[int], copies: int = 1) -> Book:
-        book = Book.create(title=title, author=author, year=year, copies=copies)
-        self.books[book.id] = book
+    @_guarded("shared")
+    def add_book(self, title: str, author: str, year: Optional[int], copies: int = 1,
+                 item_type: str = "book") -> Book:
+        book = Book.create(title=title, author=author, year=year, copies=copies, item_type=item_type)
+        with self._backend.transaction():
+            self.books[book.id] = book
+            self._commit({"op": "book", "book": book.to_dict()})
+        self._notify("book_added", book)
         return book
 
+    @_guarded("shared")
     def add_patron(self, name: str, email: str) -> Patron:
         patron = Patron.create(name=name, email=email)
-        self.patrons[patron.id] = patron
+        with self._backend.transaction():
+            self.patrons[patron.id] = patron
+            self._commit({"op": "patron", "patron": patron.to_dict()})
+        self._notify("patron_added", patron)
         return patron
 
+    @_guarded("shared")
     def checkout_book(self, book_id: str, patron_id: str) -> Loan:
-        if book_id not in self.books:
-            raise ValueError("Book not found")
-        if patron_id not in self.patrons:
-            raise ValueError("Patron not found")
-        book = self.books[book_id]
-        if book.copies_available < 1:
-            raise ValueError("No copies available")
-        book.copies_available -= 1
-        loan = Loan.create(book_id=book_id, patron_id=patron_id)
-        self.loans[loan.id] = loan
-        return loan
+        with self._book_locks.hold(book_id):
+            if book_id not in self.books:
+                raise ValueError("Book not found")
+            if patron_id not in self.patrons:
+                raise ValueError("Patron not found")
+            book = self.books[book_id]
+            if book.copies_available < 1:
+                raise ValueError("No copies available")
+            book.copies_available -= 1
+            loan = Loan.create(book_id=book_id, patron_id=patron_id, loan_days=loan_period(book.item_type))
+            with self._backend.transaction():
+                with self._loan_lock:
+                    self.loans[loan.id] = loan
+                self._commit({"op": "checkout", "loan": loan.to_dict(), "copies_available": book.copies_available})
+            self._notify("loan_opened", loan, book)
+            return loan
 
+    @_guarded("shared")
     def return_book(self, loan_id: str) -> Loan:
         if loan_id not in self.loans:
             raise ValueError("Loan not found")
+        with self._book_locks.hold(self.loans[loan_id].book_id):
+            # looked up under the lock: another desk may have just returned it
+            loan = self.loans[loan_id]
+            if loan.return_date is not None:
+                raise ValueError("Book already returned")
+            book = self.books.get(loan.book_id)
+            if book:
+                book.copies_available += 1
+            loan.return_date = datetime.utcnow().isoformat()
+            self._commit({"op": "return", "loan_id": loan.id, "return_date": loan.return_date,
+                          "book_id": loan.book_id, "copies_available": book.copies_available if book else None})
+            self._notify("loan_closed", loan, book)
+            return loan
+
+    @_guarded("shared")
+    def checkout_many(self, requests: Iterable[Tuple[str, str]], atomic: bool = True) -> BatchResult:
+        """
+        Check out a batch of (book_id, patron_id) pairs with one persistence
+        write. Every item is validated before anything changes; with `atomic`
+        a single bad item raises BatchError and nothing is applied, otherwise
+        the good items go through and the bad ones are reported in `errors`.
+        """
+        requests = list(requests)
+        with self._book_locks.hold(*{book_id for book_id, _ in requests}):
+            with self._backend.transaction():
+                applied, errors = self._checkout_many(requests, atomic)
+        for loan, book in applied:
+            self._notify("loan_opened", loan, book)
+        return BatchResult([loan for loan, _ in applied], errors)
+
+    def _checkout_many(self, requests: List[Tuple[str, str]], atomic: bool) -> Tuple[list, Dict[int, str]]:
+        errors: Dict[int, str] = {}
+        # one lookup per distinct book; backends like SQLite build a fresh model per lookup
+        books: Dict[str, Optional[Book]] = {}
+        wanted: Dict[str, int] = {}
+        for i, (book_id, patron_id) in enumerate(requests):
+            if book_id not in books:
+                books[book_id] = self.books.get(book_id)
+            book = books[book_id]
+            if book is None:
+                errors[i] = "Book not found"
+            elif patron_id not in self.patrons:
+                errors[i] = "Patron not found"
+            elif book.copies_available - wanted.get(book_id, 0) < 1:
+                errors[i] = "No copies available"
+            else:
+                wanted[book_id] = wanted.get(book_id, 0) + 1
+        if errors and atomic:
+            raise BatchError(errors)
+        applied: List[Tuple[Loan, Book]] = []
+        records = []
+        try:
+            for i, (book_id, patron_id) in enumerate(requests):
+                if i in errors:
+                    continue
+                book = books[book_id]
+                book.copies_available -= 1
+                loan = Loan.create(book_id=book_id, patron_id=patron_id, loan_days=loan_period(book.item_type))
+                with self._loan_lock:
+                    self.loans[loan.id] = loan
+                applied.append((loan, book))
+                records.append({"op": "checkout", "loan": loan.to_dict(), "copies_available": book.copies_available})
+            self._commit_many(records)
+        except Exception:
+            for loan, book in applied:
+                book.copies_available += 1
+                with self._loan_lock:
+                    self.loans.pop(loan.id, None)  # SQLite already rolled its rows back
+            raise
+        return applied, errors
+
+    @_guarded("shared")
+    def return_many(self, loan_ids: Iterable[str], atomic: bool = True) -> BatchResult:
+        """Return a batch of loans with one persistence write; see checkout_many for `atomic`."""
+        loan_ids = list(loan_ids)
+        held = {loan.book_id for loan in map(self.loans.get, loan_ids) if loan} if self.thread_safe else ()
+        with self._book_locks.hold(*held):
+            return self._return_many(loan_ids, atomic)
+
+    def _return_many(self, loan_ids: List[str], atomic: bool) -> BatchResult:
+        errors: Dict[int, str] = {}
+        loans: Dict[str, Loan] = {}
+        books: Dict[str, Optional[Book]] = {}
+        for i, loan_id in enumerate(loan_ids):
+            loan = self.loans.get(loan_id)
+            if loan is None:
+                errors[i] = "Loan not found"
+            elif loan.return_date is not None or loan_id in loans:
+                errors[i] = "Book already returned"
+            else:
+                loans[loan_id] = loan
+                if loan.book_id not in books:
+                    books[loan.book_id] = self.books.get(loan.book_id)
+        if errors and atomic:
+            raise BatchError(errors)
+        returned = datetime.utcnow().isoformat()
+        applied: List[Tuple[Loan, Optional[Book]]] = []
+        records = []
+        try:
+            for i, loan_id in enumerate(loan_ids):
+                if i in errors:
+                    continue
+                loan = loans[loan_id]
+                book = books[loan.book_id]
+                if book:
+                    book.copies_available += 1
+                loan.return_date = returned
+                applied.append((loan, book))
+                records.append({"op": "return", "loan_id": loan.id, "return_date": returned, "book_id": loan.book_id,
+                                "copies_available": book.copies_available if book else None})
+            self._commit_many(records)
+        except Exception:
+            for loan, book in applied:
+                if book:
+                    book.copies_available -= 1
+                loan.return_date = None
+            raise
+        for loan, book in applied:
+            self._notify("loan_closed", loan, book)
+        return BatchResult([loan for loan, _ in applied], errors)
+
+    # ------- Queries --------
+    @_query
+    def active_loans(self) -> List[Loan]:
+        return [self.loans[lid] for lid in self._index(_LoanIndex).open]
+
+    @_query
+    def active_loans_for_patron(self, patron_id: str) -> List[Loan]:
+        """What does this patron have out right now?"""
+        return [self.loans[lid] for lid in self._index(_LoanIndex).by_patron.get(patron_id, ())]
+
+    @_query
+    def active_loans_for_book(self, book_id: str) -> List[Loan]:
+        """Who holds copies of this book right now?"""
+        return [self.loans[lid] for lid in self._index(_LoanIndex).by_book.get(book_id, ())]
+
+    @_query
+    def overdue_loans(self, as_of: Optional[str] = None) -> List[Loan]:
+        """Open loans past their due date as of `as_of` (default: now), most overdue first."""
+        moment = _loan_bound(as_of) if as_of is not None else _iso_micros(datetime.utcnow().isoformat())
+        return [self.loans[loan_id] for _, loan_id in self._index(_OverdueIndex).due_before(moment)]
+
+    def _fine_index(self) -> _Fines:
+        index = self._derived.get(_Fines)
+        if index is None or index.rates != self.fine_rates:
+            if not self._state_lock.held_exclusively():
+                raise _IndexNotBuilt(_Fines)
+            index = _Fines(self.fine_rates)
+            index.build(self)
+            self._derived[_Fines] = index
+        return index
+
+    def _accrued_fine(self, fines: _Fines, loan_id: str, moment: int) -> float:
         loan = self.loans[loan_id]
-        if loan.return_date is not None:
-            raise ValueError("Book already returned")
         book = self.books.get(loan.book_id)
-        if book:
-            book.copies_available += 1
-        loan.return_date = datetime.utcnow().isoformat()
-        return loan
+        return fines.fine(_due_micros(loan, book), moment, book.item_type if book else "book")
+
+    @_query
+    def patron_fines(self, patron_id: str, as_of: Optional[str] = None) -> float:
+        """What `patron_id` owes as of `as_of` (default: now), per self.fine_rates."""
+        moment = _loan_bound(as_of) if as_of is not None else _iso_micros(datetime.utcnow().isoformat())
+        fines = self._fine_index()
+        cached = fines.cache.get(patron_id)
+        if cached is not None and cached[0] == moment // _DAY_US:
+            return cached[1]
+        total = fines.settled.get(patron_id, 0.0)
+        for loan_id in self._index(_LoanIndex).by_patron.get(patron_id, ()):
+            total += self._accrued_fine(fines, loan_id, moment)
+        total = round(total, 2)
+        fines.cache[patron_id] = (moment // _DAY_US, total)
+        return total
+
+    @_query
+    def fines(self, as_of: Optional[str] = None) -> Dict[str, float]:
+        """Every patron who owes something, with the amount: settled late returns plus overdue loans."""
+        moment = _loan_bound(as_of) if as_of is not None else _iso_micros(datetime.utcnow().isoformat())
+        fines = self._fine_index()
+        totals = dict(fines.settled)
+        for _, loan_id in self._index(_OverdueIndex).due_before(moment):
+            amount = self._accrued_fine(fines, loan_id, moment)
+            if amount:
+                patron_id = self.loans[loan_id].patron_id
+                totals[patron_id] = totals.get(patron_id, 0.0) + amount
+        day = moment // _DAY_US
+        result = {}
+        for patron_id, total in totals.items():
+            total = round(total, 2)
+            fines.cache[patron_id] = (day, total)
+            if total:
+                result[patron_id] = total
+        return result
+
+    @_query
+    def loan_report(self, by: str = "month", since: Optional[str] = None,
+                    until: Optional[str] = None) -> Dict[object, Dict[str, object]]:
+        """
+        Circulation grouped by "day", "month", "year", "book" (id) or "patron"
+        (id): per group the number of loans, how many were returned or are
+        still open, and the average length in days of the returned ones.
+        `since`/`until` are ISO dates or timestamps bounding loan_date, with
+        `until` exclusive.
+        """
+        return self._index(_LoanHistory).report(by, _loan_bound(since), _loan_bound(until))
+
+    @_query
+    def busiest_books(self, n: int = 10, since: Optional[str] = None,
+                      until: Optional[str] = None) -> List[Tuple[Book, int]]:
+        """The `n` most borrowed books (still in the catalog) with their loan counts."""
+        history = self._index(_LoanHistory)
+        top = history.busiest("book", n, _loan_bound(since), _loan_bound(until))
+        return [(self.books[book_id], count) for book_id, count in top if book_id in self.books]
+
+    @_query
+    def search(self, query: str, limit: int = 20, prefix: bool = True, fuzzy: bool = False,
+               threshold: float = 0.3) -> List[Book]:
+        """
+        Catalog search over title and author. Case-insensitive; all words must
+        match and the last one may be a word prefix ("hob" finds "Hobbit").
+        Results are ranked best first, title matches above author matches.
+
+        With fuzzy=True words are matched by trigram similarity instead, so
+        "tolkein hobit" still finds "The Hobbit"; books are ranked by their
+        average best similarity per query word and dropped below `threshold`.
+        """
+        index = self._index(_SearchIndex)
+        if fuzzy:
+            hits = index.fuzzy_query(query, self._index(_TrigramIndex), limit, threshold, prefix)
+        else:
+            hits = index.query(query, limit, prefix)
+        return [self.books[bid] for _, bid in hits]
 
     # convenience: simple report
+    @_query
     def summary(self) -> dict:
+        """
+        Catalog and circulation totals. Running totals make everything O(1)
+        except loans_overdue, which costs O(overdue loans).
+        """
+        stats = self._index(_Stats)
         return {
-            "books_total": len(self.books),
-            "patrons_total": len(self.patrons),
-            "loans_total": len(self.loans),
+            "books_total": stats.books,
+            "patrons_total": stats.patrons,
+            "loans_total": stats.loans,
+            "loans_open": stats.open_loans,
+            "copies_total": stats.copies_total,
+            "copies_available": stats.copies_available,
+            "copies_out": stats.copies_total - stats.copies_available,
+            "loans_overdue": len(self._index(_OverdueIndex).due_before(
+                _iso_micros(datetime.utcnow().isoformat()))),
         }
 
 
+# ---------------------------
+# asyncio facade
+# ---------------------------
+
+class AsyncLibraryApp:
+    """
+    asyncio front end for a thread-safe LibraryApp. Circulation and queries
+    are in-memory and run straight on the event loop, except that mutations
+    run on `executor` (default: the loop's) when the backend writes each
+    one out (journal=True or SQLite). Loading, saving and CSV import/export
+    always run there, so the loop keeps serving while they work.
+
+    Mutations do not save by themselves: the first one schedules a save
+    `save_delay` seconds later and everything that happens until it runs
+    shares that one write. `flush()` writes immediately; `close()` flushes
+    and closes the app. A background save that fails is reported by the
+    next `flush()` (and so by `close()`), after that flush has saved again.
+    """
+
+    def __init__(self, app: LibraryApp, executor: Optional[concurrent.futures.Executor] = None,
+                 save_delay: float = 0.05):
+        if not app.thread_safe:
+            raise ValueError("AsyncLibraryApp saves off the event loop; it needs LibraryApp(thread_safe=True)")
+        self.app = app
+        self.executor = executor
+        self.save_delay = save_delay
+        self._dirty = False
+        self._save_task: Optional[asyncio.Task] = None
+        self._save_error: Optional[Exception] = None
+
+    @classmethod
+    async def open(cls, state_path: Optional[Path] = None, executor: Optional[concurrent.futures.Executor] = None,
+                   save_delay: float = 0.05, **options) -> "AsyncLibraryApp":
+        """Load (or create) the library in `state_path` without blocking the loop; `options` go to LibraryApp."""
+        loop = asyncio.get_running_loop()
+        app = await loop.run_in_executor(executor, functools.partial(LibraryApp, state_path, thread_safe=True,
+                                                                     **options))
+        return cls(app, executor, save_delay)
+
+    async def _offload(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def _mutate(self, func, *args):
+        if self.app._backend.commits_to_disk:
+            result = await self._offload(func, *args)
+        else:
+            result = func(*args)
+        self._changed()
+        return result
+
+    def _changed(self) -> None:
+        self._dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.get_running_loop().create_task(self._save_soon())
+
+    async def _save_soon(self) -> None:
+        await asyncio.sleep(self.save_delay)
+        try:
+            # changes made while a write is in flight get one more write
+            while self._dirty:
+                self._dirty = False
+                await self._offload(self.app.save_state)
+        except Exception as e:
+            self._dirty = True  # still unsaved
+            self._save_error = e
+
+    async def flush(self) -> None:
+        """Save everything changed so far, now; raise if a background save failed since the last flush."""
+        error, self._save_error = self._save_error, None
+        self._dirty = False
+        await self._offload(self.app.save_state)
+        if error is not None:
+            raise PersistenceError(f"A background save failed (saved again by this flush): {error}") from error
+
+    async def close(self) -> None:
+        if self._save_task is not None and not self._save_task.done():
+            self._save_task.cancel()
+        try:
+            await self.flush()
+        finally:
+            await self._offload(self.app.close)
+
+    async def load_state(self, path: Path) -> None:
+        await self._offload(self.app.load_state, path)
+
+    # ------- Circulation --------
+    async def add_book(self, title: str, author: str, year: Optional[int], copies: int = 1,
+                       item_type: str = "book") -> Book:
+        return await self._mutate(self.app.add_book, title, author, year, copies, item_type)
+
+    async def add_patron(self, name: str, email: str) -> Patron:
+        return await self._mutate(self.app.add_patron, name, email)
+
+    async def checkout_book(self, book_id: str, patron_id: str) -> Loan:
+        return await self._mutate(self.app.checkout_book, book_id, patron_id)
+
+    async def return_book(self, loan_id: str) -> Loan:
+        return await self._mutate(self.app.return_book, loan_id)
+
+    async def checkout_many(self, requests: Iterable[Tuple[str, str]], atomic: bool = True) -> BatchResult:
+        # materialized here: a generator must not be consumed on another thread
+        return await self._mutate(self.app.checkout_many, list(requests), atomic)
+
+    async def return_many(self, loan_ids: Iterable[str], atomic: bool = True) -> BatchResult:
+        return await self._mutate(self.app.return_many, list(loan_ids), atomic)
+
+    # ------- Queries --------
+    async def active_loans_for_patron(self, patron_id: str) -> List[Loan]:
+        return self.app.active_loans_for_patron(patron_id)
+
+    async def search(self, query: str, **options) -> List[Book]:
+        return self.app.search(query, **options)
+
+    async def summary(self) -> dict:
+        return self.app.summary()
+
+    # ------- CSV import/export --------
+    async def import_books(self, csv_path: Path, **options) -> ImportReport:
+        report = await self._offload(self.app.import_books, csv_path, **options)
+        self._changed()
+        return report
+
+    async def export_csv(self, table: str, csv_path: Path, **options) -> int:
+        return await self._offload(self.app.export_csv, table, csv_path, **options)
+
+    async def export_all(self, dest_dir: Path, **options) -> Dict[Path, int]:
+        return await self._offload(self.app.export_all, dest_dir, **options)
+
+
 # ---------------------------
 # CLI demo (keeps file self-contained)
 # ---------------------------
@@ -314,5 +3548,201 @@ def demo_cli():
         except Exception as e:
             print("Error:", e)
 
+# ---------------------------
+# Scriptable CLI
+# ---------------------------
+def _cli_add_book(app: LibraryApp, title: str, author: str, year: Optional[int] = None, copies: int = 1,
+                  item_type: str = "book") -> dict:
+    if copies < 1:
+        raise ValueError("copies must be a positive integer")
+    return app.add_book(title, author, year, copies=copies, item_type=item_type).to_dict()
+
+
+def _cli_add_patron(app: LibraryApp, name: str, email: str) -> dict:
+    return app.add_patron(name, email).to_dict()
+
+
+def _cli_checkout(app: LibraryApp, book_id: str, patron_id: str) -> dict:
+    return app.checkout_book(book_id, patron_id).to_dict()
+
+
+def _cli_return(app: LibraryApp, loan_id: str) -> dict:
+    return app.return_book(loan_id).to_dict()
+
+
+def _cli_import(app: LibraryApp, path: str, profile: str = "default", workers: int = 1) -> dict:
+    if workers < 1:
+        raise ValueError("workers must be a positive integer")
+    report = app.import_books(Path(path), workers=workers, profile=profile, retain=False)
+    return {"inserted": report.inserted, "updated": report.updated, "unchanged": report.unchanged,
+            "skipped": len(report.skipped)}
+
+
+def _cli_export(app: LibraryApp, path: str, table: str = "books", compression: Optional[str] = None) -> dict:
+    return {"rows": app.export_csv(table, Path(path), compression=compression)}
+
+
+def _cli_summary(app: LibraryApp) -> dict:
+    return app.summary()
+
+
+# command -> (handler, whether it changes state)
+CLI_COMMANDS: Dict[str, Tuple[Callable[..., dict], bool]] = {
+    "add-book": (_cli_add_book, True),
+    "add-patron": (_cli_add_patron, True),
+    "checkout": (_cli_checkout, True),
+    "return": (_cli_return, True),
+    "import": (_cli_import, True),
+    "export": (_cli_export, False),
+    "summary": (_cli_summary, False),
+}
+
+
+_CLI_TYPE_NAMES = {str: "a string", int: "an integer", type(None): "null"}
+
+
+def _check_cli_args(command: str, handler: Callable[..., dict], args: dict) -> None:
+    """Hold batch-file arguments to the handler's signature; a bad value would be saved for good."""
+    params = list(inspect.signature(handler).parameters.values())[1:]  # after `app`
+    hints = typing.get_type_hints(handler)
+    unknown = sorted(set(args) - {p.name for p in params})
+    if unknown:
+        raise ValueError(f"{command}: unknown argument(s) {', '.join(unknown)}")
+    missing = [p.name for p in params if p.default is inspect.Parameter.empty and p.name not in args]
+    if missing:
+        raise ValueError(f"{command}: missing argument(s) {', '.join(missing)}")
+    for name, value in args.items():
+        kinds = typing.get_args(hints[name]) or (hints[name],)
+        # bool is an int subclass, but JSON true is not a year or a copy count
+        if not isinstance(value, kinds) or (isinstance(value, bool) and bool not in kinds):
+            raise ValueError(f"{command}: {name} must be " + " or ".join(_CLI_TYPE_NAMES[k] for k in kinds))
+
+
+def run_command_file(app: LibraryApp, lines: Iterable[str], keep_going: bool = False,
+                     out: Optional[TextIO] = None, err: Optional[TextIO] = None) -> Tuple[int, int]:
+    """
+    Run JSONL commands such as {"cmd": "checkout", "book_id": ..., "patron_id": ...}
+    against `app`, writing one JSON result per command to `out`. Stops at the
+    first failure unless `keep_going`. Returns (commands run, failures); the
+    caller saves once at the end.
+    """
+    out = out or sys.stdout
+    err = err or sys.stderr
+    ran = failed = 0
+    for number, line in enumerate(lines, 1):
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        result = None
+        try:
+            args = json.loads(line)
+            if not isinstance(args, dict):
+                raise ValueError("a command must be a JSON object")
+            command = args.pop("cmd", None)
+            if command not in CLI_COMMANDS:
+                raise ValueError(f"unknown or missing command: {command!r}")
+            handler, _ = CLI_COMMANDS[command]
+            _check_cli_args(command, handler, args)
+        except ValueError as e:
+            error = str(e)
+        else:
+            try:
+                result = handler(app, **args)
+            except (ValueError, OSError, PersistenceError) as e:
+                error = str(e)
+            except Exception as e:
+                # report it like any other failure; earlier commands still get saved
+                error = f"{type(e).__name__}: {e}"
+        ran += 1
+        if result is None:
+            failed += 1
+            print(f"line {number}: {error}", file=err)
+            if not keep_going:
+                break
+            continue
+        print(json.dumps(result), file=out)
+    return ran, failed
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Command-line entry point. With no arguments it starts the interactive
+    demo; otherwise it runs one command, or a JSONL command file with
+    `batch`, against a single load and a single save of the state.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        demo_cli()
+        return 0
+    parser = argparse.ArgumentParser(prog="main.py", description="Library management from the command line.")
+    parser.add_argument("--state", type=Path, default=None, help="state file (default: library_state.json here)")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--journal", action="store_true", help="append mutations to a journal instead of "
+                                                                 "rewriting the snapshot")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("add-book")
+    p.add_argument("title")
+    p.add_argument("author")
+    p.add_argument("--year", type=int)
+    p.add_argument("--copies", type=int, default=1)
+    p.add_argument("--item-type", dest="item_type", default="book")
+    p = sub.add_parser("add-patron")
+    p.add_argument("name")
+    p.add_argument("email")
+    p = sub.add_parser("checkout")
+    p.add_argument("book_id")
+    p.add_argument("patron_id")
+    p = sub.add_parser("return")
+    p.add_argument("loan_id")
+    p = sub.add_parser("import", help="import books from a CSV file")
+    p.add_argument("path")
+    p.add_argument("--profile", default="default", choices=sorted(IMPORT_PROFILES))
+    p.add_argument("--workers", type=int, default=1)
+    p = sub.add_parser("export", help="export a table to CSV")
+    p.add_argument("path")
+    p.add_argument("--table", default="books", choices=[name for name, _ in _MODELS])
+    p.add_argument("--compression", choices=sorted(EXPORT_COMPRESSION))
+    sub.add_parser("summary")
+    p = sub.add_parser("batch", help="run a JSONL command file ('-' for stdin)")
+    p.add_argument("file")
+    p.add_argument("--keep-going", action="store_true", help="run the remaining commands after a failure")
+    sub.add_parser("demo", help="the interactive menu")
+    args = vars(parser.parse_args(argv))
+    if args["journal"] and args["backend"] != "json":
+        parser.error("--journal only applies to --backend json; sqlite commits every change itself")
+    command = args.pop("command")
+    if command == "demo":
+        demo_cli()
+        return 0
+    try:
+        app = LibraryApp(state_path=args.pop("state"), backend=args.pop("backend"), journal=args.pop("journal"))
+    except PersistenceError as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    try:
+        if command == "batch":
+            if args["file"] == "-":
+                ran, failed = run_command_file(app, sys.stdin, args["keep_going"])
+            else:
+                with open(args["file"], encoding="utf-8") as f:
+                    ran, failed = run_command_file(app, f, args["keep_going"])
+            changed = ran > failed
+        else:
+            handler, changed = CLI_COMMANDS[command]
+            try:
+                print(json.dumps(handler(app, **args)))
+                failed = 0
+            except (ValueError, PersistenceError) as e:
+                print(f"error: {e}", file=sys.stderr)
+                failed, changed = 1, False
+        if changed:
+            app.save_state()
+    except (OSError, PersistenceError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        app.close()
+    return 1 if failed else 0
+
+
 if __name__ == "__main__":
-    demo_cli()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
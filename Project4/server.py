@@ -0,0 +1,238 @@
+# Project 4
+# Library Management
+# server.py
+"""
+HTTP/JSON service around one thread-safe LibraryApp, so many branch
+terminals can share a single process. Run from this folder, e.g.:
+    python server.py --state library_state.json --port 8326
+
+Endpoints (JSON in, JSON out):
+    GET  /summary
+    GET  /search?q=hobbit&limit=20&fuzzy=1
+    POST /books                 {"title", "author", "year", "copies", "item_type"}
+    GET  /books/<id>
+    POST /patrons               {"name", "email"}
+    GET  /patrons/<id>
+    GET  /patrons/<id>/loans
+    POST /loans                 {"book_id", "patron_id"}
+    GET  /loans/<id>
+    POST /loans/batch           {"items": [{"book_id", "patron_id"}, ...], "atomic": true}
+    POST /loans/<id>/return
+    POST /returns               {"loan_ids": [...], "atomic": true}
+
+Connections are kept alive (HTTP/1.1). Each request gets its own thread;
+a mutation is acknowledged only once it is saved, and saves from
+concurrent requests are group-committed, so a burst of checkouts from
+many terminals shares one write + fsync.
+"""
+
+import argparse
+import json
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from main import BatchError, LibraryApp
+
+
+_REQUIRED = object()
+_KIND_NAMES = {str: "a string", int: "an integer", bool: "true or false", list: "a list"}
+
+
+class _HttpError(Exception):
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class LibraryRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    # headers and body go out as separate writes; without this Nagle holds back the body
+    disable_nagle_algorithm = True
+    server: "LibraryServer"
+
+    def do_GET(self) -> None:
+        self._handle("GET")
+
+    def do_POST(self) -> None:
+        self._handle("POST")
+
+    def _handle(self, method: str) -> None:
+        try:
+            url = urlsplit(self.path)
+            parts = tuple(p for p in url.path.split("/") if p)
+            body = self._read_body() if method == "POST" else None
+            status, payload, changed = self._route(method, parts, parse_qs(url.query), body)
+            if changed:
+                self.server.app.save_state()
+        except _HttpError as e:
+            status, payload = e.status, {"error": str(e)}
+        except BatchError as e:
+            status, payload = HTTPStatus.CONFLICT, {"error": str(e), "errors": {str(i): r for i, r in e.errors.items()}}
+        except ValueError as e:
+            not_found = str(e).endswith("not found")
+            status, payload = (HTTPStatus.NOT_FOUND if not_found else HTTPStatus.CONFLICT), {"error": str(e)}
+        except Exception as e:  # PersistenceError and anything unexpected
+            status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"{type(e).__name__}: {e}"}
+        self._send(status, payload)
+
+    def _read_body(self) -> dict:
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # without a usable length the rest of the stream cannot be framed
+            self.close_connection = True
+            raise _HttpError(HTTPStatus.BAD_REQUEST, "Content-Length must be a whole number")
+        raw = self.rfile.read(length) if length else b"{}"
+        try:
+            body = json.loads(raw)
+        except ValueError:
+            raise _HttpError(HTTPStatus.BAD_REQUEST, "Request body is not valid JSON")
+        if not isinstance(body, dict):
+            raise _HttpError(HTTPStatus.BAD_REQUEST, "Request body must be a JSON object")
+        return body
+
+    def _route(self, method: str, parts: Tuple[str, ...], query: dict,
+               body: Optional[dict]) -> Tuple[HTTPStatus, object, bool]:
+        """Return (status, payload, whether state changed)."""
+        app = self.server.app
+        if method == "GET":
+            if parts == ("summary",):
+                return HTTPStatus.OK, app.summary(), False
+            if parts == ("search",):
+                q = query.get("q", [""])[0]
+                limit = query.get("limit", ["20"])[0]
+                if not limit.isdigit():
+                    raise _HttpError(HTTPStatus.BAD_REQUEST, "limit must be a whole number")
+                limit = int(limit)
+                fuzzy = query.get("fuzzy", ["0"])[0] not in ("0", "false", "")
+                return HTTPStatus.OK, [b.to_dict() for b in app.search(q, limit=limit, fuzzy=fuzzy)], False
+            if len(parts) == 2 and parts[0] == "books":
+                return HTTPStatus.OK, self._get(app.books, parts[1], "Book").to_dict(), False
+            if len(parts) == 2 and parts[0] == "patrons":
+                return HTTPStatus.OK, self._get(app.patrons, parts[1], "Patron").to_dict(), False
+            if len(parts) == 2 and parts[0] == "loans":
+                return HTTPStatus.OK, self._get(app.loans, parts[1], "Loan").to_dict(), False
+            if len(parts) == 3 and parts[0] == "patrons" and parts[2] == "loans":
+                self._get(app.patrons, parts[1], "Patron")
+                return HTTPStatus.OK, [l.to_dict() for l in app.active_loans_for_patron(parts[1])], False
+        else:
+            if parts == ("books",):
+                copies = self._field(body, "copies", int, default=1)
+                if copies < 1:
+                    raise _HttpError(HTTPStatus.BAD_REQUEST, "copies must be a positive integer")
+                book = app.add_book(self._field(body, "title"), self._field(body, "author"),
+                                    self._field(body, "year", int, default=None, nullable=True), copies=copies,
+                                    item_type=self._field(body, "item_type", default="book"))
+                return HTTPStatus.CREATED, book.to_dict(), True
+            if parts == ("patrons",):
+                patron = app.add_patron(self._field(body, "name"), self._field(body, "email"))
+                return HTTPStatus.CREATED, patron.to_dict(), True
+            if parts == ("loans",):
+                loan = app.checkout_book(self._field(body, "book_id"), self._field(body, "patron_id"))
+                return HTTPStatus.CREATED, loan.to_dict(), True
+            if parts == ("loans", "batch"):
+                items = [(self._field(i, "book_id"), self._field(i, "patron_id"))
+                         for i in self._field(body, "items", list)]
+                return self._batch(app.checkout_many(items, self._field(body, "atomic", bool, default=True)))
+            if len(parts) == 3 and parts[0] == "loans" and parts[2] == "return":
+                return HTTPStatus.OK, app.return_book(parts[1]).to_dict(), True
+            if parts == ("returns",):
+                loan_ids = self._field(body, "loan_ids", list)
+                if not all(isinstance(loan_id, str) for loan_id in loan_ids):
+                    raise _HttpError(HTTPStatus.BAD_REQUEST, "loan_ids must be a list of strings")
+                return self._batch(app.return_many(loan_ids, self._field(body, "atomic", bool, default=True)))
+        raise _HttpError(HTTPStatus.NOT_FOUND, f"No such endpoint: {method} {self.path}")
+
+    @staticmethod
+    def _batch(result) -> Tuple[HTTPStatus, object, bool]:
+        payload = {"loans": [l.to_dict() for l in result.loans],
+                   "errors": {str(i): reason for i, reason in result.errors.items()}}
+        return HTTPStatus.OK, payload, bool(result.loans)
+
+    @staticmethod
+    def _get(table, key: str, what: str):
+        record = table.get(key)
+        if record is None:
+            raise _HttpError(HTTPStatus.NOT_FOUND, f"{what} not found")
+        return record
+
+    @staticmethod
+    def _field(body, name: str, kind: type = str, default=_REQUIRED, nullable: bool = False):
+        # anything stored here is journaled for good, so reject wrong types up front
+        if not isinstance(body, dict):
+            raise _HttpError(HTTPStatus.BAD_REQUEST, "Each item must be a JSON object")
+        if name not in body:
+            if default is _REQUIRED:
+                raise _HttpError(HTTPStatus.BAD_REQUEST, f"Missing field: {name}")
+            return default
+        value = body[name]
+        if value is None and nullable:
+            return None
+        # bool is an int subclass; JSON true is not a year or a copy count
+        if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+            raise _HttpError(HTTPStatus.BAD_REQUEST,
+                             f"{name} must be {_KIND_NAMES[kind]}" + (" or null" if nullable else ""))
+        return value
+
+    def _send(self, status: HTTPStatus, payload) -> None:
+        data = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class LibraryServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the socketserver default of 5 drops SYNs when many terminals connect at once (1 s retry)
+    request_queue_size = 128
+
+    def __init__(self, address: Tuple[str, int], app: LibraryApp, verbose: bool = False):
+        if not app.thread_safe:
+            raise ValueError("LibraryServer handles requests on many threads; it needs LibraryApp(thread_safe=True)")
+        self.app = app
+        self.verbose = verbose
+        super().__init__(address, LibraryRequestHandler)
+
+
+def make_app(state_path: Optional[Path] = None, group_commit_window: float = 0.002, **options) -> LibraryApp:
+    """A LibraryApp set up for serving: thread-safe, journaled, with group-committed saves."""
+    options.setdefault("journal", options.get("backend", "json") == "json")
+    return LibraryApp(state_path=state_path, thread_safe=True, group_commit_window=group_commit_window, **options)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--state", type=Path, default=None, help="state file (default: library_state.json here)")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8326)
+    parser.add_argument("--group-commit-window", type=float, default=0.002,
+                        help="seconds a save waits for concurrent requests to join it")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args(argv)
+    app = make_app(args.state, args.group_commit_window, backend=args.backend)
+    server = LibraryServer((args.host, args.port), app, verbose=args.verbose)
+    print(f"Serving {app.state_path} on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        app.save_state()
+        app.close()
+
+
+if __name__ == "__main__":
+    main()
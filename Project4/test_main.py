@@ -14,9 +14,31 @@ from pathlib import Path
 import json
 import csv
 import os
+import threading
+import uuid
+import io
+import contextlib
+import asyncio
+import random
+import time
+import sys
+from datetime import datetime, timedelta
+import sqlite3
+import gzip
+import lzma
+import http.client
+from unittest import mock
 
 # import classes from main.py (assumes both files are in same folder)
 from main import Book, Patron, Loan, LibraryApp, PersistenceError
+import main
+
+
+def _open_app(test, **options):
+    """A LibraryApp that is closed once `test` has finished."""
+    app = LibraryApp(**options)
+    test.addCleanup(app.close)
+    return app
 
 
 class UnitTests(unittest.TestCase):
@@ -46,7 +68,7 @@ class IntegrationTests(unittest.TestCase):
         # create app with temp file for state to avoid interfering with local files
         self.tmpdir = tempfile.TemporaryDirectory()
         self.state_path = Path(self.tmpdir.name) / "state.json"
-        self.app = LibraryApp(state_path=self.state_path)
+        self.app = _open_app(self, state_path=self.state_path)
 
     def tearDown(self):
         self.tmpdir.cleanup()
@@ -62,6 +84,176 @@ class IntegrationTests(unittest.TestCase):
         self.assertIsNotNone(ret.return_date)
         self.assertEqual(self.app.books[b.id].copies_available, 1)
 
+    def test_active_loan_queries_track_circulation(self):
+        b1 = self.app.add_book("Idx One", "Auth", 2000, copies=2)
+        b2 = self.app.add_book("Idx Two", "Auth", 2001, copies=1)
+        p1 = self.app.add_patron("Jo", "jo@example.com")
+        p2 = self.app.add_patron("Kim", "kim@example.com")
+        l1 = self.app.checkout_book(b1.id, p1.id)
+        self.assertEqual(self.app.active_loans_for_patron(p1.id), [l1])
+        l2 = self.app.checkout_book(b1.id, p2.id)
+        l3 = self.app.checkout_book(b2.id, p1.id)
+        self.assertEqual(self.app.active_loans_for_book(b1.id), [l1, l2])
+        self.app.return_book(l1.id)
+        self.assertEqual(self.app.active_loans_for_patron(p1.id), [l3])
+        self.assertEqual(self.app.active_loans_for_book(b1.id), [l2])
+        self.assertEqual(sorted(l.id for l in self.app.active_loans()), sorted([l2.id, l3.id]))
+        self.assertEqual(self.app.active_loans_for_patron("nobody"), [])
+        # a fresh load rebuilds the index from the persisted loans
+        self.app.save_state()
+        app2 = _open_app(self, state_path=self.state_path)
+        self.assertEqual([l.id for l in app2.active_loans_for_patron(p1.id)], [l3.id])
+        self.app.load_state(self.state_path)
+        self.assertEqual([l.id for l in self.app.active_loans_for_book(b1.id)], [l2.id])
+
+    def test_summary_totals_follow_every_mutation(self):
+        app = self.app
+        self.assertEqual(app.summary()["copies_total"], 0)
+        dune = app.add_book("Dune", "Frank Herbert", 1965, copies=3)
+        app.add_book("Emma", "Jane Austen", 1815, copies=2)
+        ann = app.add_patron("Ann", "ann@example.com")
+        loan = app.checkout_book(dune.id, ann.id)
+        app.checkout_book(dune.id, ann.id)
+        app.return_book(loan.id)
+        csv_path = Path(self.tmpdir.name) / "more.csv"
+        csv_path.write_text("title,author,year,copies\nDune,Frank Herbert,1965,5\nIlium,Dan Simmons,2003,1\n")
+        app.import_books(csv_path, key="title_author_year")
+        expected = {"books_total": 3, "patrons_total": 1, "loans_total": 2, "loans_open": 1,
+                    "copies_total": 8, "copies_available": 7, "copies_out": 1, "loans_overdue": 0}
+        self.assertEqual(app.overdue_loans(), [])
+        # answered from running totals, not by scanning the tables
+        with mock.patch.object(app, "books", {}), mock.patch.object(app, "loans", {}):
+            self.assertEqual(app.summary(), expected)
+        app.save_state()
+        self.assertEqual(_open_app(self, state_path=self.state_path).summary(), expected)
+
+    def test_due_dates_and_overdue_loans(self):
+        app = self.app
+        novel = app.add_book("Dune", "Frank Herbert", 1965, copies=3)
+        film = app.add_book("Alien", "Ridley Scott", 1979, item_type="dvd")
+        ann = app.add_patron("Ann", "ann@example.com")
+        book_loan = app.checkout_book(novel.id, ann.id)
+        dvd_loan = app.checkout_book(film.id, ann.id)
+        loaned = datetime.fromisoformat(book_loan.loan_date)
+        self.assertEqual(datetime.fromisoformat(book_loan.due_date) - loaned, timedelta(days=21))
+        self.assertEqual(datetime.fromisoformat(dvd_loan.due_date) - datetime.fromisoformat(dvd_loan.loan_date),
+                         timedelta(days=7))
+        # a loan saved before due dates existed is due one book period after checkout
+        legacy = Loan(str(uuid.uuid4()), novel.id, ann.id, (loaned - timedelta(days=30)).isoformat(), None)
+        app.loans[legacy.id] = legacy
+        self.assertEqual(app.overdue_loans(), [legacy])
+        self.assertEqual(app.summary()["loans_overdue"], 1)
+        in_ten_days = (loaned + timedelta(days=10)).isoformat()
+        self.assertEqual([l.id for l in app.overdue_loans(as_of=in_ten_days)], [legacy.id, dvd_loan.id])
+        app.return_book(legacy.id)
+        self.assertEqual([l.id for l in app.overdue_loans(as_of=in_ten_days)], [dvd_loan.id])
+        in_a_month = (loaned + timedelta(days=30)).isoformat()
+        self.assertEqual([l.id for l in app.overdue_loans(as_of=in_a_month)], [dvd_loan.id, book_loan.id])
+        app.save_state()
+        reopened = _open_app(self, state_path=self.state_path, columnar_loans=True)
+        self.assertEqual(reopened.loans[dvd_loan.id].due_date, dvd_loan.due_date)
+        self.assertEqual([l.id for l in reopened.overdue_loans(as_of=in_a_month)], [dvd_loan.id, book_loan.id])
+
+    def test_overdue_scan_follows_the_answer(self):
+        index = main._OverdueIndex()
+        for i in range(1000):
+            index.loan_opened(Loan(f"l{i}", "b", "p", "2024-01-01T00:00:00", None,
+                                   (datetime(2024, 1, 1) + timedelta(hours=1000 - i)).isoformat()), None)
+        moment = main._iso_micros("2024-01-01T05:30:00")
+        self.assertEqual([loan_id for _, loan_id in index.due_before(moment)], ["l999", "l998", "l997", "l996", "l995"])
+        for i in range(990):
+            index.loan_closed(Loan(f"l{i}", "b", "p", "", None), None)
+        self.assertLess(len(index.heap), 100)
+        self.assertEqual(len(index.due_before(moment)), 5)
+
+    def test_fines_per_item_type(self):
+        app = self.app
+        app.fine_rates["dvd"] = main.FineRate(per_day=1.0, max_days=5)
+        novel = app.add_book("Dune", "Frank Herbert", 1965, copies=2)
+        film = app.add_book("Alien", "Ridley Scott", 1979, item_type="dvd")
+        ann = app.add_patron("Ann", "ann@example.com")
+        bob = app.add_patron("Bob", "bob@example.com")
+        now = datetime.utcnow()
+        late_book = app.checkout_book(novel.id, ann.id)
+        late_book.due_date = (now - timedelta(days=3)).isoformat()
+        late_dvd = app.checkout_book(film.id, ann.id)
+        late_dvd.due_date = (now - timedelta(days=10)).isoformat()
+        app.checkout_book(novel.id, bob.id)
+        self.assertEqual(app.patron_fines(ann.id), 5.75)
+        self.assertEqual(app.patron_fines(bob.id), 0.0)
+        self.assertEqual(app.fines(), {ann.id: 5.75})
+        # returning settles the dvd at its capped fine and drops the cached total
+        app.return_book(late_dvd.id)
+        self.assertEqual(app.patron_fines(ann.id), 5.75)
+        self.assertEqual(app.patron_fines(ann.id, as_of=(now + timedelta(days=2)).isoformat()), 6.25)
+        # a fresh app settles past returns in one batch pass and agrees
+        app.save_state()
+        reopened = _open_app(self, state_path=self.state_path)
+        reopened.fine_rates["dvd"] = main.FineRate(per_day=1.0, max_days=5)
+        self.assertEqual(reopened.fines(), {ann.id: 5.75})
+        # new rates rebuild the settled totals
+        app.fine_rates["dvd"] = main.FineRate(per_day=2.0, max_days=5)
+        self.assertEqual(app.fines(), {ann.id: 10.75})
+
+    def test_fines_batch_pass_matches_incremental(self):
+        app = _open_app(self, state_path=self.state_path, columnar_loans=True)
+        book = app.add_book("Dune", "Frank Herbert", 1965, copies=50)
+        patrons = [app.add_patron(f"P{i}", f"p{i}@example.com") for i in range(5)]
+        start = datetime(2024, 1, 1)
+        for i in range(40):
+            loan = Loan(str(uuid.uuid4()), book.id, patrons[i % 5].id, start.isoformat(), None,
+                        None if i % 7 == 0 else (start + timedelta(days=i % 9)).isoformat())
+            app.loans[loan.id] = loan
+        app.fines()
+        for loan_id in list(app.loans):
+            app.return_book(loan_id)
+        incremental = app.fines()
+        app.save_state()
+        reopened = _open_app(self, state_path=self.state_path, columnar_loans=True)
+        self.assertEqual(reopened.fines(), incremental)
+        self.assertEqual(len(incremental), 5)
+
+    def test_bulk_checkout_and_return(self):
+        app = self.app
+        dune = app.add_book("Dune", "Frank Herbert", 1965, copies=2)
+        emma = app.add_book("Emma", "Jane Austen", 1815)
+        ann = app.add_patron("Ann", "ann@example.com")
+        bob = app.add_patron("Bob", "bob@example.com")
+        # the third copy of Dune does not exist, so the whole batch is refused
+        with self.assertRaises(main.BatchError) as caught:
+            app.checkout_many([(dune.id, ann.id), (dune.id, bob.id), (dune.id, ann.id), ("nope", ann.id)])
+        self.assertEqual(caught.exception.errors, {2: "No copies available", 3: "Book not found"})
+        self.assertEqual((app.books[dune.id].copies_available, len(app.loans)), (2, 0))
+        with mock.patch.object(app._backend, "commit", wraps=app._backend.commit) as commit:
+            result = app.checkout_many([(dune.id, ann.id), (emma.id, "nobody"), (dune.id, bob.id), (emma.id, bob.id)],
+                                       atomic=False)
+        self.assertEqual(commit.call_count, 1)
+        self.assertEqual(result.errors, {1: "Patron not found"})
+        self.assertEqual([(l.book_id, l.patron_id) for l in result.loans],
+                         [(dune.id, ann.id), (dune.id, bob.id), (emma.id, bob.id)])
+        self.assertEqual(len(app.active_loans_for_patron(bob.id)), 2)
+        ids = [l.id for l in result.loans]
+        with self.assertRaises(main.BatchError):
+            app.return_many([ids[0], ids[0]])
+        result = app.return_many([ids[0], "missing", ids[2]], atomic=False)
+        self.assertEqual(result.errors, {1: "Loan not found"})
+        self.assertEqual(app.books[emma.id].copies_available, 1)
+        self.assertEqual([l.id for l in app.active_loans()], [ids[1]])
+        app.save_state()
+        reopened = _open_app(self, state_path=self.state_path)
+        self.assertEqual(reopened.books[dune.id].copies_available, 1)
+        self.assertEqual([l.id for l in reopened.active_loans()], [ids[1]])
+
+    def test_bulk_checkout_rolls_back_when_the_write_fails(self):
+        app = self.app
+        dune = app.add_book("Dune", "Frank Herbert", 1965, copies=2)
+        ann = app.add_patron("Ann", "ann@example.com")
+        with mock.patch.object(app._backend, "commit", side_effect=PersistenceError("disk full")):
+            with self.assertRaises(PersistenceError):
+                app.checkout_many([(dune.id, ann.id), (dune.id, ann.id)])
+        self.assertEqual((app.books[dune.id].copies_available, len(app.loans)), (2, 0))
+        self.assertEqual(app.active_loans(), [])
+
     def test_save_and_load_state(self):
         b = self.app.add_book("Persist Book", "Auth", 2010, copies=2)
         p = self.app.add_patron("Carol", "c@example.com")
@@ -69,19 +261,1360 @@ class IntegrationTests(unittest.TestCase):
         # save
         self.app.save_state(self.state_path)
         # create new app and load
-        app2 = LibraryApp(state_path=self.state_path)
+        app2 = _open_app(self, state_path=self.state_path)
         # app2 will auto load from provided state_path in its constructor
         self.assertIn(b.id, app2.books)
         self.assertIn(p.id, app2.patrons)
         self.assertTrue(len(app2.loans) >= 1)
 
 
+class SearchTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.app = _open_app(self, state_path=Path(self.tmpdir.name) / "state.json")
+        self.hobbit = self.app.add_book("The Hobbit", "J.R.R. Tolkien", 1937)
+        self.rings = self.app.add_book("The Lord of the Rings", "J.R.R. Tolkien", 1954)
+        self.about = self.app.add_book("Tolkien: A Biography", "Humphrey Carpenter", 1977)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_case_folding_prefix_and_ranking(self):
+        self.assertEqual(self.app.search("HOBBIT"), [self.hobbit])
+        self.assertEqual(self.app.search("hob"), [self.hobbit])
+        self.assertEqual(self.app.search("hob", prefix=False), [])
+        # the title match outranks the two author matches
+        self.assertEqual(self.app.search("tolkien")[0], self.about)
+        self.assertEqual(self.app.search("tolkien lord"), [self.rings])
+        self.assertEqual(self.app.search("tolkien", limit=2), self.app.search("tolkien")[:2])
+        self.assertEqual(self.app.search("  "), [])
+
+    def test_fuzzy_matching_tolerates_typos(self):
+        self.assertEqual(self.app.search("hobit"), [])
+        self.assertEqual(self.app.search("hobit", fuzzy=True), [self.hobbit])
+        self.assertEqual(self.app.search("tolkein hobit", fuzzy=True)[0], self.hobbit)
+        self.assertEqual(len(self.app.search("Tolkein", fuzzy=True)), 3)
+        self.assertEqual(len(self.app.search("Tolkein", fuzzy=True, limit=1)), 1)
+        self.assertEqual(self.app.search("tolkein", fuzzy=True, threshold=0.95), [])
+        later = self.app.add_book("Farmer Giles of Ham", "J.R.R. Tolkien", 1949)
+        self.assertEqual(self.app.search("farmr giles", fuzzy=True), [later])
+
+    def test_index_follows_add_and_import(self):
+        self.assertEqual(self.app.search("silmarillion"), [])
+        silm = self.app.add_book("The Silmarillion", "J.R.R. Tolkien", 1977)
+        self.assertEqual(self.app.search("silm"), [silm])
+        csv_path = Path(self.tmpdir.name) / "more.csv"
+        csv_path.write_text("title,author\nUnfinished Tales,J.R.R. Tolkien\n", encoding="utf-8")
+        added = self.app.import_books_from_csv(csv_path)
+        self.assertEqual(self.app.search("unfinished"), added)
+
+
+class CsvImportTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.base = Path(self.tmpdir.name)
+        self.csv_path = self.base / "books.csv"
+        with self.csv_path.open("w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["title", "author", "year", "copies"])
+            for i in range(300):
+                if i % 50 == 7:
+                    writer.writerow(["", "Nobody", "2000", "1"])
+                elif i % 40 == 3:
+                    writer.writerow([f"Multi\nline \"{i}\"", "Author, Quoted", "1999", "2"])
+                else:
+                    writer.writerow([f"Title {i}", f"Author {i % 7}", str(1900 + i), "1"])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _titles(self, books):
+        return [(b.title, b.author, b.year, b.copies_total) for b in books]
+
+    def test_chunks_split_only_between_records(self):
+        fieldnames, chunks = main._csv_chunks(self.csv_path, 256)
+        self.assertEqual(fieldnames, ["title", "author", "year", "copies"])
+        self.assertGreater(len(chunks), 10)
+        serial = _open_app(self, state_path=self.base / "a.json").import_books(self.csv_path)
+        books, skipped = [], []
+        for i, (start, end, line) in enumerate(chunks):
+            b, s, _ = main._parse_csv_chunk(self.csv_path, i, start, end, line, fieldnames,
+                                                  main.ImportProfile())
+            books += b
+            skipped += s
+        self.assertEqual(self._titles(books), self._titles(serial.books))
+        self.assertEqual(skipped, serial.skipped)
+
+    def test_parallel_import_matches_serial(self):
+        serial = _open_app(self, state_path=self.base / "a.json").import_books(self.csv_path)
+        app = _open_app(self, state_path=self.base / "b.json")
+        report = app.import_books(self.csv_path, workers=2, chunk_bytes=512)
+        self.assertEqual(self._titles(report.books), self._titles(serial.books))
+        self.assertEqual(list(app.books.values()), report.books)
+        # skipped rows carry their physical line numbers (header is line 1)
+        self.assertEqual(report.skipped[0], (2 + 7 + 1, "missing title"))
+        self.assertEqual(len(report.skipped), 6)
+        self.assertGreater(len(report.chunks), 1)
+        self.assertEqual(sum(c.rows for c in report.chunks), 300)
+        self.assertEqual({b.id for b in app.search("multi line")},
+                         {b.id for b in report.books if b.title.startswith("Multi")})
+
+
+    def test_streaming_import_commits_each_batch(self):
+        app = LibraryApp(state_path=self.base / "lib.db", backend="sqlite")
+        report = main.ImportReport()
+        batches = app.iter_import_books(self.csv_path, batch_size=100, report=report)
+        first = next(batches)
+        self.assertEqual(len(first), 100)
+        # the first batch is already durable while the rest is still unread
+        other = sqlite3.connect(str(self.base / "lib.db"))
+        self.assertEqual(other.execute("SELECT COUNT(*) FROM books").fetchone()[0], 100)
+        other.close()
+        rest = [len(b) for b in batches]
+        self.assertEqual(rest, [100, 94])
+        self.assertEqual(report.inserted, 294)
+        app.close()
+
+    def test_import_without_retaining_books(self):
+        app = _open_app(self, state_path=self.base / "a.json", journal=True)
+        with mock.patch.object(app._backend, "commit", wraps=app._backend.commit) as commit:
+            report = app.import_books(self.csv_path, batch_size=50, retain=False)
+        self.assertEqual(report.books, [])
+        self.assertEqual(report.inserted, 294)
+        self.assertEqual(commit.call_count, 6)
+        self.assertEqual(len(_open_app(self, state_path=self.base / "a.json", journal=True).books), 294)
+
+
+    def test_vendor_profile_maps_aliased_columns(self):
+        feed = self.base / "vendor.csv"
+        feed.write_text("\ufeffSKU;Item Name;Writer;Pub Year\n"
+                        "1;Dune;Frank Herbert;1965\n"
+                        "2;Emma;;1815;extra\n"
+                        "3\n", encoding="utf-8")
+        profile = main.ImportProfile("acme", aliases={"title": ("Item Name",), "author": ("writer",),
+                                                      "year": ("pub year",)}, delimiter=";")
+        main.IMPORT_PROFILES["acme"] = profile
+        self.addCleanup(main.IMPORT_PROFILES.pop, "acme")
+        report = _open_app(self, state_path=self.base / "a.json").import_books(feed, profile="acme")
+        self.assertEqual(self._titles(report.books), [("Dune", "Frank Herbert", 1965, 1), ("Emma", "Unknown", 1815, 1)])
+        self.assertEqual(report.skipped, [(4, "missing title")])
+        with self.assertRaises(PersistenceError):
+            _open_app(self, state_path=self.base / "b.json").import_books(feed)
+
+
+    def test_upsert_import_is_idempotent_and_merges(self):
+        app = _open_app(self, state_path=self.base / "a.json", journal=True)
+        first = app.import_books(self.csv_path, key="title_author_year")
+        self.assertEqual((first.inserted, first.updated, first.unchanged), (294, 0, 0))
+        again = app.import_books(self.csv_path, key="title_author_year")
+        self.assertEqual((again.inserted, again.updated, again.unchanged), (0, 0, 294))
+        self.assertEqual(len(app.books), 294)
+
+        feed = self.base / "update.csv"
+        feed.write_text("title,author,year,copies\n"
+                        "  title   1,AUTHOR 1,1901,4\n"
+                        "Title 2,Author 2,1902,3\n", encoding="utf-8")
+        self.assertEqual(app.search("title 1", prefix=False)[0].copies_total, 1)
+        report = app.import_books(feed, key="title_author_year")
+        self.assertEqual((report.inserted, report.updated), (0, 2))
+        renamed = report.books[0]
+        self.assertEqual((renamed.title, renamed.copies_total, renamed.copies_available), ("title   1", 4, 4))
+        self.assertEqual(app.search("title 1", prefix=False)[0].id, renamed.id)
+        added = app.import_books(feed, key="title_author_year", on_match="add")
+        self.assertEqual([b.copies_total for b in added.books], [8, 6])
+        reopened = _open_app(self, state_path=self.base / "a.json", journal=True)
+        self.assertEqual(reopened.books[renamed.id].copies_available, 8)
+
+    def test_upsert_keeps_fields_the_feed_does_not_have(self):
+        catalog = self.base / "catalog.csv"
+        catalog.write_text("title,author,year,isbn,type,copies\n"
+                           "Alien,Ridley Scott,1979,0000000001,dvd,1\n", encoding="utf-8")
+        restock = self.base / "restock.csv"
+        restock.write_text("isbn,title,copies\n0000000001,Alien (4K),3\n", encoding="utf-8")
+        retitle = self.base / "retitle.csv"
+        retitle.write_text("isbn,title\n0000000001,Alien\n", encoding="utf-8")
+        app = _open_app(self, state_path=self.base / "a.json")
+        app.import_books(catalog, key="isbn")
+        self.assertEqual(app.import_books(restock, key="isbn").updated, 1)
+        film = next(iter(app.books.values()))
+        self.assertEqual((film.title, film.author, film.year, film.item_type, film.copies_total),
+                         ("Alien (4K)", "Ridley Scott", 1979, "dvd", 3))
+        app.import_books(retitle, key="isbn")
+        film = next(iter(app.books.values()))
+        self.assertEqual((film.title, film.item_type, film.copies_total, film.copies_available), ("Alien", "dvd", 3, 3))
+
+    def test_upsert_keeps_fields_left_blank_and_copies_on_loan(self):
+        app = _open_app(self, state_path=self.base / "a.json")
+        dune = app.add_book("Dune", "Frank Herbert", 1965, copies=5, item_type="dvd")
+        ann = app.add_patron("Ann", "ann@example.com")
+        loans = [app.checkout_book(dune.id, ann.id) for _ in range(3)]
+        blanks = self.base / "blanks.csv"
+        blanks.write_text("title,author,year,copies,type\n"
+                          "Dune,Frank Herbert,1965,,\n", encoding="utf-8")
+        self.assertEqual(app.import_books(blanks, key="title_author_year").unchanged, 1)
+        by_year = self.base / "by_year.csv"
+        by_year.write_text("title,author,year,copies,type\n"
+                           "Dune,,1965,4,\n", encoding="utf-8")
+        report = app.import_books(by_year, key=lambda b: (b.title, b.year))
+        self.assertEqual(report.updated, 1)
+        self.assertEqual((app.books[dune.id].author, app.books[dune.id].item_type), ("Frank Herbert", "dvd"))
+        self.assertEqual((app.books[dune.id].copies_total, app.books[dune.id].copies_available), (4, 1))
+        # fewer copies than are out on loan is refused, not clamped
+        too_few = self.base / "too_few.csv"
+        too_few.write_text("title,author,year,copies\nDune,Frank Herbert,1965,2\n", encoding="utf-8")
+        report = app.import_books(too_few, key="title_author_year")
+        self.assertEqual((report.updated, report.skipped), (0, [(2, "copies 2 is fewer than the 3 on loan")]))
+        for loan in loans:
+            app.return_book(loan.id)
+        self.assertEqual((app.books[dune.id].copies_total, app.books[dune.id].copies_available), (4, 4))
+        self.assertEqual(app.summary()["copies_out"], 0)
+
+    def test_upsert_by_isbn_in_sqlite(self):
+        feed = self.base / "isbn.csv"
+        feed.write_text("title,author,isbn,copies\n"
+                        "Dune,Frank Herbert,978-0-441-17271-9,1\n"
+                        "Dune (Ace ed.),F. Herbert,9780441172719,2\n"
+                        "Emma,Jane Austen,,1\n"
+                        "Emma,Jane Austen,,1\n", encoding="utf-8")
+        app = LibraryApp(state_path=self.base / "lib.db", backend="sqlite")
+        report = app.import_books(feed, key="isbn")
+        self.assertEqual((report.inserted, report.updated), (3, 1))
+        app.close()
+        reopened = LibraryApp(state_path=self.base / "lib.db", backend="sqlite")
+        dune = [b for b in reopened.books.values() if b.isbn][0]
+        self.assertEqual((dune.title, dune.author, dune.copies_total), ("Dune (Ace ed.)", "F. Herbert", 2))
+        reopened.close()
+
+
+class CsvExportTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.base = Path(self.tmpdir.name)
+        self.app = _open_app(self, state_path=self.base / "state.json")
+        for i in range(20):
+            self.app.add_book(f"Book {i}", "Austen" if i % 4 == 0 else "Other", 1800 + i, copies=2)
+        self.patron = self.app.add_patron("Ann", "ann@example.com")
+        self.loan = self.app.checkout_book(next(iter(self.app.books)), self.patron.id)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_gzip_export_with_columns_and_filter(self):
+        path = self.base / "out" / "austen.csv.gz"
+        written = self.app.export_books_to_csv(path, columns=["title", "year"],
+                                               where=lambda b: b.author == "Austen" and b.year < 1810)
+        self.assertEqual(written, 3)
+        with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows, [["title", "year"], ["Book 0", "1800"], ["Book 4", "1804"], ["Book 8", "1808"]])
+        with self.assertRaises(ValueError):
+            self.app.export_books_to_csv(self.base / "x.csv", columns=["nope"])
+
+    def test_patron_and_loan_exports(self):
+        self.assertEqual(self.app.export_patrons_to_csv(self.base / "patrons.csv"), 1)
+        self.assertEqual(self.app.export_loans_to_csv(self.base / "loans.csv.xz"), 1)
+        with (self.base / "patrons.csv").open(newline="", encoding="utf-8") as f:
+            self.assertEqual(list(csv.DictReader(f)), [self.patron.to_dict()])
+        with lzma.open(self.base / "loans.csv.xz", "rt", encoding="utf-8", newline="") as f:
+            row = next(csv.DictReader(f))
+        self.assertEqual((row["id"], row["return_date"]), (self.loan.id, ""))
+
+
+    def _read(self, path):
+        opener = gzip.open if path.suffix == ".gz" else open
+        with opener(path, "rt", encoding="utf-8", newline="") as f:
+            return list(csv.DictReader(f))
+
+    def test_export_all_shards_by_id_prefix(self):
+        counts = self.app.export_all(self.base / "dump", shards=4, workers=3)
+        self.assertEqual(len(counts), 12)
+        books = []
+        for i in range(4):
+            part = self._read(self.base / "dump" / f"books-{i:02d}.csv.gz")
+            self.assertTrue(all(int(r["id"][:2], 16) * 4 >> 8 == i for r in part))
+            books += part
+        self.assertEqual(sorted(r["id"] for r in books), sorted(self.app.books))
+        self.assertEqual(sum(n for p, n in counts.items() if p.name.startswith("loans")), 1)
+
+    def test_export_all_is_point_in_time(self):
+        book_id = next(iter(self.app.books))
+        snapshot_rows = self.app._backend.snapshot_rows
+
+        def snapshot_then_circulate(app):
+            rows = snapshot_rows(app)
+            app.checkout_book(book_id, self.patron.id)
+            return rows
+
+        with mock.patch.object(self.app._backend, "snapshot_rows", side_effect=snapshot_then_circulate):
+            counts = self.app.export_all(self.base / "dump", compression=None, processes=True, workers=2)
+        self.assertEqual(counts[self.base / "dump" / "loans.csv"], 1)
+        self.assertEqual(len(self.app.loans), 2)
+        exported = {r["id"]: r for r in self._read(self.base / "dump" / "books.csv")}
+        self.assertEqual(exported[book_id]["copies_available"], "1")
+
+    def test_sqlite_export_reads_one_snapshot(self):
+        app = LibraryApp(state_path=self.base / "lib.db", backend="sqlite")
+        book = app.add_book("Dune", "Frank Herbert", 1965, copies=3)
+        patron = app.add_patron("Ann", "ann@example.com")
+        app.checkout_book(book.id, patron.id)
+        counts = app.export_all(self.base / "dump", tables=["books", "loans"])
+        self.assertEqual(sorted(p.name for p in counts), ["books.csv.gz", "loans.csv.gz"])
+        self.assertEqual(self._read(self.base / "dump" / "books.csv.gz")[0]["copies_available"], "2")
+        app.close()
+
+
+class JournalTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state_path = Path(self.tmpdir.name) / "state.json"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_mutations_replayed_from_journal(self):
+        app = LibraryApp(state_path=self.state_path, journal=True)
+        b = app.add_book("Journaled", "Auth", 2001, copies=2)
+        p = app.add_patron("Dana", "d@example.com")
+        loan = app.checkout_book(b.id, p.id)
+        app.return_book(loan.id)
+        app.checkout_book(b.id, p.id)
+        app.save_state()
+        app.close()
+        # no snapshot was written; everything comes back from the log
+        self.assertFalse(self.state_path.exists())
+        app2 = _open_app(self, state_path=self.state_path)
+        self.assertEqual(app2.books[b.id].copies_available, 1)
+        self.assertIsNotNone(app2.loans[loan.id].return_date)
+        self.assertEqual(len(app2.loans), 2)
+
+    def test_torn_last_record_is_ignored(self):
+        app = LibraryApp(state_path=self.state_path, journal=True)
+        b = app.add_book("Kept", "Auth", None)
+        app.close()
+        journal = self.state_path.with_name(self.state_path.name + ".journal")
+        with journal.open("a", encoding="utf-8") as f:
+            f.write('{"op":"book","book":{"id":"x"')
+        app2 = _open_app(self, state_path=self.state_path)
+        self.assertEqual(list(app2.books), [b.id])
+
+    def test_compaction_folds_log_into_snapshot(self):
+        app = LibraryApp(state_path=self.state_path, journal=True, compact_threshold=512)
+        ids = [app.add_book(f"Book {i}", "Auth", 1990 + i).id for i in range(20)]
+        app.close()
+        self.assertTrue(self.state_path.exists())
+        segment = self.state_path.with_name(self.state_path.name + ".journal.1")
+        self.assertFalse(segment.exists())
+        app2 = _open_app(self, state_path=self.state_path)
+        self.assertEqual(sorted(app2.books), sorted(ids))
+
+    def test_failed_fold_keeps_its_segment(self):
+        app = LibraryApp(state_path=self.state_path, journal=True, compact_threshold=512)
+        journal = app._backend._journal
+        with mock.patch.object(journal.codec, "dump", side_effect=OSError("disk full")):
+            ids = [app.add_book(f"Book {i}", "Auth", 1990 + i).id for i in range(10)]
+            journal._compactor.join()
+        # later rotations must not overwrite the segment whose fold failed
+        ids += [app.add_book(f"Book {i}", "Auth", 2000 + i).id for i in range(10, 60)]
+        with self.assertRaises(PersistenceError):
+            app.close()
+        app2 = LibraryApp(state_path=self.state_path, journal=True)
+        self.assertEqual(sorted(app2.books), sorted(ids))
+        app2.close()
+
+    def test_segment_left_by_an_exit_is_folded_on_open(self):
+        app = LibraryApp(state_path=self.state_path, journal=True, compact_threshold=512)
+        # the process exits before the background fold gets to run
+        with mock.patch.object(main._Journal, "_fold_segment"):
+            ids = [app.add_book(f"Book {i}", "Auth", 1990 + i).id for i in range(30)]
+            app.close()
+        segment = self.state_path.with_name(self.state_path.name + ".journal.1")
+        self.assertTrue(segment.exists())
+        app2 = LibraryApp(state_path=self.state_path, journal=True, compact_threshold=512)
+        self.assertFalse(segment.exists())
+        ids += [app2.add_book(f"Book {i}", "Auth", 2000 + i).id for i in range(30, 60)]
+        app2.close()
+        app3 = _open_app(self, state_path=self.state_path)
+        self.assertEqual(sorted(app3.books), sorted(ids))
+
+    def test_plain_save_supersedes_journal(self):
+        app = LibraryApp(state_path=self.state_path, journal=True)
+        b = app.add_book("Old", "Auth", None)
+        app.close()
+        app2 = _open_app(self, state_path=self.state_path)
+        app2.books[b.id].copies_available = 0
+        app2.save_state()
+        app3 = _open_app(self, state_path=self.state_path)
+        self.assertEqual(app3.books[b.id].copies_available, 0)
+
+
+class SnapshotWriteTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state_path = Path(self.tmpdir.name) / "state.json"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_failed_save_leaves_previous_snapshot_intact(self):
+        app = _open_app(self, state_path=self.state_path)
+        b = app.add_book("Safe", "Auth", 1999)
+        app.save_state()
+        app.books[b.id].year = object()  # not JSON serializable
+        with self.assertRaises(PersistenceError):
+            app.save_state()
+        app2 = _open_app(self, state_path=self.state_path)
+        self.assertEqual(app2.books[b.id].year, 1999)
+        self.assertEqual(os.listdir(self.tmpdir.name), ["state.json"])
+
+    def test_concurrent_saves_share_commits(self):
+        app = _open_app(self, state_path=self.state_path, group_commit_window=0.05)
+        app.add_book("Burst", "Auth", None)
+        threads = [threading.Thread(target=app.save_state) for _ in range(8)]
+        with mock.patch.object(main, "_write_snapshot", wraps=main._write_snapshot) as write:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertLess(write.call_count, 8)
+        self.assertEqual(len(_open_app(self, state_path=self.state_path).books), 1)
+
+
+class StreamingLoadTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state_path = Path(self.tmpdir.name) / "state.json"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_reader_matches_json_load_across_chunk_boundaries(self):
+        app = _open_app(self, state_path=self.state_path)
+        for i in range(30):
+            app.add_book(f"T\u00e9st {i} \"quoted\"", "Auth", 1900 + i, copies=i + 1)
+        app.add_patron("Eve", "eve@example.com")
+        app.save_state()
+        with self.state_path.open("r", encoding="utf-8") as f:
+            expected = json.load(f)
+        expected["extra"] = {"ignored": [1, 2, 3]}
+        with self.state_path.open("w", encoding="utf-8") as f:
+            json.dump(expected, f)
+        with self.state_path.open("r", encoding="utf-8") as f:
+            got = {"books": {}, "patrons": {}, "loans": {}}
+            for section, key, record in main._JsonStateReader(f, chunk_size=7):
+                got[section][key] = record
+        del expected["extra"], expected["stats"]
+        self.assertEqual(got, expected)
+
+    def test_progress_callback_reports_final_counts(self):
+        app = _open_app(self, state_path=self.state_path)
+        for i in range(3):
+            app.add_book(f"Book {i}", "Auth", None)
+        app.save_state()
+        calls = []
+        _open_app(self, state_path=self.state_path, progress=lambda section, n: calls.append((section, n)))
+        self.assertIn(("books", 3), calls)
+        self.assertIn(("loans", 0), calls)
+
+    def test_truncated_file_raises_persistence_error(self):
+        self.state_path.write_text('{"books": {"a": {"id": "a", "ti', encoding="utf-8")
+        with self.assertRaises(PersistenceError):
+            LibraryApp(state_path=self.state_path)
+
+
+class LazyLoadTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state_path = Path(self.tmpdir.name) / "state.json"
+        app = _open_app(self, state_path=self.state_path)
+        self.books = [app.add_book(f"L\u00e4zy {i}", "Auth", 2000 + i, copies=2) for i in range(5)]
+        self.patron = app.add_patron("Finn", "f@example.com")
+        self.loan = app.checkout_book(self.books[0].id, self.patron.id)
+        app.save_state()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_records_materialize_on_first_access(self):
+        app = LibraryApp(state_path=self.state_path, lazy=True)
+        self.assertEqual(app.summary()["books_total"], 5)
+        self.assertEqual(len(app.books._loaded), 0)
+        b = app.books[self.books[3].id]
+        self.assertEqual(b, self.books[3])
+        self.assertIs(app.books[self.books[3].id], b)
+        self.assertEqual(len(app.books._loaded), 1)
+        self.assertEqual(list(app.books), [b.id for b in self.books])
+        app.close()
+
+    def test_non_ascii_ids_whether_escaped_or_raw(self):
+        ids = ["b\u00fccher", "caf\u00e9 \"quoted\"", "\u65e5\u672c-" + "x" * 70000]  # the last straddles a buffer
+        data = {"books": {i: Book(i, "T", "A", None, 1, 1).to_dict() for i in ids}, "patrons": {}, "loans": {}}
+        for ensure_ascii in (True, False):
+            with self.subTest(ensure_ascii=ensure_ascii):
+                self.state_path.write_text(json.dumps(data, indent=2, ensure_ascii=ensure_ascii), encoding="utf-8")
+                app = _open_app(self, state_path=self.state_path, lazy=True)
+                self.assertEqual(list(app.books), ids)
+                self.assertEqual([app.books[i].id for i in ids], ids)
+
+    def test_lazy_app_circulates_and_saves(self):
+        app = LibraryApp(state_path=self.state_path, lazy=True)
+        app.return_book(self.loan.id)
+        extra = app.add_book("New", "Auth", None)
+        app.save_state()
+        app.close()
+        app2 = _open_app(self, state_path=self.state_path)
+        self.assertEqual(len(app2.books), 6)
+        self.assertIn(extra.id, app2.books)
+        self.assertEqual(app2.books[self.books[0].id].copies_available, 2)
+
+    def test_lazy_load_replays_journal(self):
+        app = LibraryApp(state_path=self.state_path, journal=True)
+        app.return_book(self.loan.id)
+        app.close()
+        app2 = LibraryApp(state_path=self.state_path, lazy=True)
+        self.assertIsNotNone(app2.loans[self.loan.id].return_date)
+        self.assertEqual(app2.books[self.books[0].id].copies_available, 2)
+        app2.close()
+
+    def test_summary_comes_from_totals_saved_with_the_snapshot(self):
+        for codec in ("json", "binary"):
+            with self.subTest(codec=codec):
+                path = self.state_path.with_name(f"{codec}.state")
+                path.write_bytes(self.state_path.read_bytes())
+                app = _open_app(self, state_path=path, codec=codec)
+                app.loans[self.loan.id].due_date = "2000-01-01T00:00:00"
+                app.save_state()
+                # journaled changes on top of the snapshot adjust the saved totals
+                app = _open_app(self, state_path=path, journal=True)
+                app.checkout_book(self.books[1].id, self.patron.id)
+                app.add_book("Extra", "Auth", None, copies=3)
+                app.close()
+                expected = _open_app(self, state_path=path).summary()
+                self.assertEqual((expected["loans_open"], expected["loans_overdue"]), (2, 1))
+                lazy = _open_app(self, state_path=path, lazy=True)
+                with mock.patch.object(main._LazyTable, "_peek", side_effect=AssertionError("record decoded")):
+                    self.assertEqual(lazy.summary(), expected)
+                lazy.return_book(self.loan.id)
+                self.assertEqual(lazy.summary()["loans_overdue"], 0)
+
+    def test_lazy_reads_survive_a_journal_fold(self):
+        app = _open_app(self, state_path=self.state_path)
+        patrons = [app.add_patron(f"Patron {i}", f"p{i}@example.com") for i in range(20)]
+        app.save_state()
+        app = LibraryApp(state_path=self.state_path, lazy=True, journal=True, compact_threshold=512)
+        for i in range(20):
+            app.add_book(f"Folded {i}", "Auth", 2000 + i)
+        app._backend._journal._compactor.join()
+        self.assertFalse(self.state_path.with_name(self.state_path.name + ".journal.1").exists())
+        # the fold renamed a new snapshot over the file these offsets were taken from
+        self.assertEqual([app.patrons[p.id] for p in patrons], patrons)
+        self.assertEqual(app.summary()["books_total"], 25)
+        app.close()
+
+
+class BinaryCodecTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tmp = Path(self.tmpdir.name)
+        self.app = _open_app(self, state_path=self.tmp / "state.json")
+        p = self.app.add_patron("Gus \u00fc", "g@example.com")
+        for i in range(10):
+            b = self.app.add_book(f"Book {i}", "Auth", 1990 + i if i % 2 else None, copies=2)
+            loan = self.app.checkout_book(b.id, p.id)
+            if i % 3 == 0:
+                self.app.return_book(loan.id)
+        # values that must not be "compacted" into uuids/epochs
+        odd = Book("not-a-uuid", "nul\0title", "A" * 300, -5, 1, 1)
+        self.app.books[odd.id] = odd
+        self.app.loans["odd"] = Loan("odd", "not-a-uuid", p.id, "2024-01-01", None)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def dump(self, app):
+        return {name: {k: v.to_dict() for k, v in getattr(app, name).items()}
+                for name in ("books", "patrons", "loans")}
+
+    def test_binary_snapshot_round_trips(self):
+        path = self.tmp / "state.bin"
+        self.app.codec = main.SNAPSHOT_CODECS["binary"]
+        self.app.save_state(path)
+        self.assertEqual(self.dump(_open_app(self, state_path=path)), self.dump(self.app))
+        lazy = LibraryApp(state_path=path, lazy=True)
+        self.assertEqual(self.dump(lazy), self.dump(self.app))
+        lazy.close()
+
+    def test_models_are_built_from_columns_even_for_older_schemas(self):
+        path = self.tmp / "old.bin"
+        data = self.dump(self.app)
+        for loan in data["loans"].values():
+            del loan["due_date"]  # written before loans had due dates
+        codec = main.SNAPSHOT_CODECS["binary"]
+        with path.open("wb") as f:
+            codec.dump(f, data)
+        factories = dict(main._MODELS)
+        expected = [(section, key, factories[section].from_dict(record))
+                    for section, key, record in codec.records(path)]
+        self.assertEqual(list(codec.models(path)), expected)
+        self.assertTrue(all(model.due_date is None for section, _, model in expected if section == "loans"))
+
+    def test_convert_to_binary_and_back(self):
+        self.app.save_state()
+        binary, back = self.tmp / "state.bin", self.tmp / "back.json"
+        main.convert_snapshot(self.app.state_path, binary, "binary")
+        main.convert_snapshot(binary, back, "json")
+        self.assertLess(binary.stat().st_size, self.app.state_path.stat().st_size)
+        with self.app.state_path.open() as a, back.open() as b:
+            self.assertEqual(json.load(a), json.load(b))
+
+    def test_binary_app_keeps_its_codec_when_compacting(self):
+        path = self.tmp / "journaled.bin"
+        app = LibraryApp(state_path=path, journal=True, codec="binary")
+        app.add_book("J", "Auth", None)
+        app.compact()
+        app.close()
+        self.assertIs(main.codec_for_file(path), main.SNAPSHOT_CODECS["binary"])
+        self.assertEqual(len(_open_app(self, state_path=path).books), 1)
+
+
+    def test_journaled_binary_folds_legacy_records(self):
+        # the repo's own sample state predates isbn/item_type
+        legacy = self.tmp / "legacy.json"
+        legacy.write_bytes((Path(main.__file__).parent / "library_state.json").read_bytes())
+        state = self.tmp / "legacy.bin"
+        main.convert_snapshot(legacy, state, "binary")
+        app = LibraryApp(state_path=state, codec="binary", journal=True, compact_threshold=512)
+        ids = list(app.books)
+        p = app.add_patron("Hana", "h@example.com")
+        ids += [app.add_book(f"New {i}", "Auth", 2000 + i, item_type="dvd").id for i in range(10)]
+        app.checkout_book(ids[0], p.id)
+        app.close()  # raises if the background fold failed
+        self.assertFalse(state.with_name(state.name + ".journal.1").exists())
+        app2 = _open_app(self, state_path=state)
+        self.assertEqual(sorted(app2.books), sorted(ids))
+        self.assertEqual(app2.books[ids[0]].item_type, "book")
+        self.assertEqual(app2.books[ids[0]].copies_available, 0)
+
+class ColumnarLoanTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state = Path(self.tmpdir.name) / "state.json"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_views_behave_like_loans(self):
+        store = main._LoanColumns()
+        loan = Loan.create("b1", "p1")
+        odd = Loan("legacy-7", "b1", "p2", "2024-01-05", None)
+        store[loan.id] = loan
+        store[odd.id] = odd
+        self.assertEqual(store[loan.id], loan)
+        self.assertEqual(store[odd.id], odd)
+        self.assertIsInstance(store[loan.id], Loan)
+        self.assertEqual(list(store), [loan.id, odd.id])
+        view = store[loan.id]
+        view.return_date = "2024-02-01T10:00:00.250000"
+        self.assertEqual(store[loan.id].return_date, "2024-02-01T10:00:00.250000")
+        self.assertEqual(store[loan.id].to_dict()["return_date"], "2024-02-01T10:00:00.250000")
+        del store[odd.id]
+        self.assertNotIn(odd.id, store)
+        self.assertEqual(len(store), 1)
+
+    def test_app_circulates_and_round_trips(self):
+        app = LibraryApp(state_path=self.state, columnar_loans=True, journal=True)
+        book = app.add_book("Dune", "Frank Herbert", 1965, copies=2)
+        patron = app.add_patron("Ann", "ann@example.com")
+        first = app.checkout_book(book.id, patron.id)
+        second = app.checkout_book(book.id, patron.id)
+        returned = app.return_book(first.id)
+        self.assertIsNotNone(returned.return_date)
+        self.assertEqual(app.active_loans(), [second])
+        with self.assertRaises(ValueError):
+            app.return_book(first.id)
+        app.close()
+        reopened = LibraryApp(state_path=self.state, columnar_loans=True, journal=True)
+        self.assertIsInstance(reopened.loans, main._LoanColumns)
+        self.assertEqual(reopened.loans[first.id].return_date, returned.return_date)
+        reopened.compact()
+        reopened.close()
+        plain = _open_app(self, state_path=self.state)
+        self.assertEqual(sorted(l.to_dict()["id"] for l in plain.loans.values()), sorted([first.id, second.id]))
+        with self.assertRaises(ValueError):
+            LibraryApp(state_path=self.state, columnar_loans=True, lazy=True)
+
+
+class LoanHistoryTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _library(self, **options):
+        app = _open_app(self, state_path=Path(self.tmpdir.name) / "state.json", **options)
+        self.dune = app.add_book("Dune", "Frank Herbert", 1965, copies=5)
+        self.emma = app.add_book("Emma", "Jane Austen", 1815, copies=5)
+        self.ann = app.add_patron("Ann", "ann@example.com")
+        history = [  # book, loan date, return date
+            (self.dune, "2024-01-03T10:00:00", "2024-01-13T10:00:00"),
+            (self.dune, "2024-01-20T09:30:00", None),
+            (self.emma, "2024-01-31T23:00:00", "2024-02-02T11:00:00"),
+            (self.dune, "2024-02-14T12:00:00", "2024-02-15T12:00:00"),
+            (self.emma, "2023-12-30T08:00:00", "2024-01-01T08:00:00"),
+        ]
+        for book, loaned, returned in history:
+            loan = Loan(str(uuid.uuid4()), book.id, self.ann.id, loaned, returned)
+            app.loans[loan.id] = loan
+        return app
+
+    def _check(self, app):
+        months = app.loan_report("month")
+        self.assertEqual(list(months), ["2023-12", "2024-01", "2024-02"])
+        self.assertEqual(months["2024-01"], {"loans": 3, "returned": 2, "open": 1, "avg_days": 5.75})
+        self.assertEqual(app.loan_report("year", since="2024-01-01")["2024"]["loans"], 4)
+        self.assertEqual(app.loan_report("book", until="2024-02-01")[self.emma.id]["avg_days"], 1.75)
+        self.assertEqual(app.loan_report("day", since="2024-02-14", until="2024-02-15"),
+                         {"2024-02-14": {"loans": 1, "returned": 1, "open": 0, "avg_days": 1.0}})
+        self.assertEqual(app.busiest_books(1), [(app.books[self.dune.id], 3)])
+        # later circulation is reflected without a rebuild
+        loan = app.checkout_book(self.emma.id, self.ann.id)
+        app.checkout_book(self.emma.id, self.ann.id)
+        app.return_book(loan.id)
+        self.assertEqual(app.loan_report("patron")[self.ann.id]["loans"], 7)
+        self.assertEqual(app.loan_report("patron")[self.ann.id]["open"], 2)
+        self.assertEqual([count for _, count in app.busiest_books(2)], [4, 3])
+        with self.assertRaises(ValueError):
+            app.loan_report("week")
+        with self.assertRaises(ValueError):
+            app.loan_report(since="last tuesday")
+
+    def test_report_over_loan_dict(self):
+        self._check(self._library())
+
+    def test_in_order_loans_are_range_selected(self):
+        app = _open_app(self, state_path=Path(self.tmpdir.name) / "state.json")
+        book = app.add_book("Dune", "Frank Herbert", 1965, copies=5)
+        patron = app.add_patron("Ann", "ann@example.com")
+        first = app.checkout_book(book.id, patron.id)
+        history = app._index(main._LoanHistory)
+        for _ in range(3):
+            app.checkout_book(book.id, patron.id)
+        rows = history.rows(main._iso_micros(first.loan_date), None)
+        self.assertEqual(rows, range(0, 4))
+        self.assertEqual(sum(g["loans"] for g in app.loan_report("day", since=first.loan_date).values()), 4)
+
+    def test_report_over_columnar_store(self):
+        app = self._library(columnar_loans=True)
+        self._check(app)
+        self.assertIs(app._index(main._LoanHistory).loan_date, app.loans._loan_date)
+
+
+class SqliteBackendTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tmp = Path(self.tmpdir.name)
+        self.db_path = self.tmp / "library.db"
+        self.app = LibraryApp(state_path=self.db_path, backend="sqlite")
+
+    def tearDown(self):
+        self.app.close()
+        self.tmpdir.cleanup()
+
+    def test_circulation_survives_reopen(self):
+        b = self.app.add_book("SQL Book", "Auth", 2005, copies=2)
+        p = self.app.add_patron("Hal", "h@example.com")
+        loan = self.app.checkout_book(b.id, p.id)
+        self.assertEqual(self.app.books[b.id].copies_available, 1)
+        self.app.return_book(loan.id)
+        self.app.checkout_book(b.id, p.id)
+        self.app.close()
+        app2 = LibraryApp(state_path=self.db_path, backend="sqlite")
+        self.assertEqual(app2.summary(), {"books_total": 1, "patrons_total": 1, "loans_total": 2, "loans_open": 1,
+                                          "copies_total": 2, "copies_available": 1, "copies_out": 1,
+                                          "loans_overdue": 0})
+        self.assertEqual(app2.books[b.id].copies_available, 1)
+        self.assertIsNotNone(app2.loans[loan.id].return_date)
+        app2.close()
+
+    def test_checkout_is_rechecked_inside_the_transaction(self):
+        b = self.app.add_book("Last Copy", "Auth", None, copies=1)
+        p = self.app.add_patron("Ivy", "i@example.com")
+        other = LibraryApp(state_path=self.db_path, backend="sqlite")
+        stale = other.books[b.id]
+        self.app.checkout_book(b.id, p.id)
+        # `other` saw one copy available, but the database no longer has it
+        with mock.patch.object(other.books, "__getitem__", return_value=stale):
+            with self.assertRaises(ValueError):
+                other.checkout_book(b.id, p.id)
+        other.close()
+        self.assertEqual(len(self.app.loans), 1)
+        self.assertEqual(self.app.books[b.id].copies_available, 0)
+
+    def test_bulk_circulation_is_one_transaction(self):
+        b = self.app.add_book("Bulk", "Auth", None, copies=3)
+        p = self.app.add_patron("Kim", "k@example.com")
+        loans = self.app.checkout_many([(b.id, p.id)] * 3).loans
+        self.assertEqual(self.app.books[b.id].copies_available, 0)
+        self.app.return_many(l.id for l in loans[:2])
+        self.assertEqual(self.app.books[b.id].copies_available, 2)
+        # another connection takes a copy first; the batch rolls back whole
+        other = LibraryApp(state_path=self.db_path, backend="sqlite")
+        other.checkout_book(b.id, p.id)
+        other.close()
+        with self.assertRaises(ValueError):
+            self.app.checkout_many([(b.id, p.id)] * 2)
+        self.assertEqual(self.app.books[b.id].copies_available, 1)
+        self.assertEqual(len(self.app.loans), 4)
+
+    def test_load_state_imports_json_snapshot(self):
+        json_app = _open_app(self, state_path=self.tmp / "state.json")
+        b = json_app.add_book("From JSON", "Auth", 1999)
+        json_app.save_state()
+        self.app.add_book("Replaced", "Auth", None)
+        self.app.load_state(json_app.state_path)
+        self.assertEqual(list(self.app.books), [b.id])
+        self.assertEqual(self.app.state_path, self.db_path)
+
+    def test_active_loan_queries(self):
+        b = self.app.add_book("SQL Idx", "Auth", None, copies=2)
+        p = self.app.add_patron("Lee", "l@example.com")
+        loan = self.app.checkout_book(b.id, p.id)
+        self.app.return_book(self.app.checkout_book(b.id, p.id).id)
+        self.app.close()
+        app2 = LibraryApp(state_path=self.db_path, backend="sqlite")
+        self.assertEqual([l.id for l in app2.active_loans_for_patron(p.id)], [loan.id])
+        app2.close()
+
+    def test_rollback_keeps_rows_another_thread_is_committing(self):
+        paused = threading.Event()
+        release = threading.Event()
+        commit = self.app._backend.commit
+
+        def slow_commit(records):
+            records = list(records)
+            if records[0]["op"] == "book":
+                paused.set()
+                release.wait(5)
+            commit(records)
+
+        self.app._backend.commit = slow_commit
+        adder = threading.Thread(target=lambda: self.app.add_book("Acknowledged", "Auth", None))
+        adder.start()
+        paused.wait(5)
+        # another caller's transaction fails and rolls back while the book is being committed
+        failing = threading.Thread(target=lambda: self.assertRaises(ValueError, commit, [
+            {"op": "return", "loan_id": "missing", "return_date": "2024-01-01T00:00:00", "book_id": "missing"}]))
+        failing.start()
+        failing.join(0.2)
+        release.set()
+        adder.join()
+        failing.join()
+        conn = sqlite3.connect(str(self.db_path))
+        try:
+            self.assertEqual(conn.execute("SELECT title FROM books").fetchall(), [("Acknowledged",)])
+        finally:
+            conn.close()
+
+    def test_json_backend_options_are_refused(self):
+        for option in ("journal", "lazy", "columnar_loans"):
+            with self.assertRaisesRegex(ValueError, f"{option}=True only applies to the json backend"):
+                LibraryApp(state_path=self.tmp / "other.db", backend="sqlite", **{option: True})
+        self.assertFalse((self.tmp / "other.db").exists())
+
+    def test_open_loans_use_partial_index(self):
+        plan = self.app._backend._conn.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM loans WHERE return_date IS NULL AND book_id = ?", ("x",)).fetchall()
+        self.assertIn("loans_open", " ".join(str(row) for row in plan))
+
+
+class ConcurrencyTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state_path = Path(self.tmpdir.name) / "state.json"
+        # switch threads far more often than usual to shake out races
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+        self.tmpdir.cleanup()
+
+    def hammer(self, app, threads=16, rounds=300):
+        books = [app.add_book(f"Book {i}", "Auth", None, copies=1 + i % 3) for i in range(8)]
+        patrons = [app.add_patron(f"P{i}", f"p{i}@example.com") for i in range(threads)]
+        app.summary()  # build the derived indexes up front so desks update them concurrently
+        failures = []
+
+        def desk(n):
+            rng = random.Random(n)
+            mine = []
+            try:
+                for _ in range(rounds):
+                    roll = rng.random()
+                    if roll < 0.45:
+                        try:
+                            mine.append(app.checkout_book(rng.choice(books).id, patrons[n].id).id)
+                        except ValueError:
+                            pass
+                    elif roll < 0.55:
+                        result = app.checkout_many([(rng.choice(books).id, patrons[n].id) for _ in range(3)],
+                                                   atomic=False)
+                        mine.extend(loan.id for loan in result.loans)
+                    elif roll < 0.9 and mine:
+                        app.return_book(mine.pop(rng.randrange(len(mine))))
+                    elif roll < 0.95:
+                        stats = app.summary()
+                        if not 0 <= stats["copies_available"] <= stats["copies_total"]:
+                            failures.append(stats)
+                    else:
+                        app.save_state()
+                app.return_many(mine[: len(mine) // 2])
+            except Exception as e:  # pragma: no cover - reported below
+                failures.append(e)
+
+        workers = [threading.Thread(target=desk, args=(n,)) for n in range(threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        self.assertEqual(failures, [])
+        for book in books:
+            book = app.books[book.id]
+            out = sum(1 for loan in app.loans.values() if loan.book_id == book.id and loan.return_date is None)
+            self.assertTrue(0 <= book.copies_available <= book.copies_total)
+            self.assertEqual(book.copies_available, book.copies_total - out)
+            self.assertEqual(len(app.active_loans_for_book(book.id)), out)
+        stats = app.summary()
+        self.assertEqual(stats["loans_total"], len(app.loans))
+        self.assertEqual(stats["loans_open"], len(app.active_loans()))
+        self.assertEqual(stats["copies_out"], stats["loans_open"])
+        return books
+
+    def test_many_desks_never_oversell(self):
+        app = _open_app(self, state_path=self.state_path, thread_safe=True)
+        self.hammer(app)
+        app.save_state()
+        reopened = _open_app(self, state_path=self.state_path)
+        self.assertEqual(reopened.summary(), app.summary())
+
+    def test_many_desks_on_journaled_columnar_store(self):
+        app = LibraryApp(state_path=self.state_path, thread_safe=True, journal=True, columnar_loans=True)
+        self.hammer(app, threads=8)
+        app.close()
+        reopened = _open_app(self, state_path=self.state_path, columnar_loans=True)
+        self.assertEqual(reopened.summary()["loans_total"], len(app.loans))
+        self.assertEqual(reopened.summary()["copies_available"], app.summary()["copies_available"])
+
+    def test_many_desks_on_sqlite(self):
+        app = _open_app(self, state_path=self.state_path.with_suffix(".db"), backend="sqlite", thread_safe=True)
+        self.hammer(app, threads=4, rounds=100)
+
+    def test_queries_share_the_lock(self):
+        app = _open_app(self, state_path=self.state_path, thread_safe=True)
+        b = app.add_book("The Hobbit", "Tolkien", 1937)
+        p = app.add_patron("Ann", "a@example.com")
+        loan = app.checkout_book(b.id, p.id)
+        # the first query to need an index builds it under the exclusive lock
+        app.search("hobbit")
+        app.active_loans_for_patron(p.id)
+        inside = threading.Event()
+        release = threading.Event()
+        query = main._SearchIndex.query
+
+        def slow_query(index, *args):
+            inside.set()
+            release.wait(5)
+            return query(index, *args)
+
+        with mock.patch.object(main._SearchIndex, "query", slow_query):
+            searcher = threading.Thread(target=app.search, args=("hobbit",))
+            searcher.start()
+            inside.wait(5)
+            # a second query runs while the first still holds its locks
+            found = []
+            reader = threading.Thread(target=lambda: found.extend(app.active_loans_for_patron(p.id)))
+            reader.start()
+            reader.join(2)
+            alive = reader.is_alive()
+            release.set()
+            searcher.join()
+            reader.join()
+        self.assertFalse(alive)
+        self.assertEqual([l.id for l in found], [loan.id])
+
+    def test_exclusive_waits_for_shared_holders(self):
+        lock = main._RWLock()
+        events = []
+        inside = threading.Event()
+        release = threading.Event()
+
+        def reader():
+            with lock.shared():
+                with lock.shared():  # re-entrant
+                    inside.set()
+                    release.wait()
+                    events.append("read")
+
+        def writer():
+            inside.wait()
+            with lock.exclusive():
+                events.append("write")
+
+        threads = [threading.Thread(target=reader), threading.Thread(target=writer)]
+        for t in threads:
+            t.start()
+        inside.wait()
+        time.sleep(0.05)
+        self.assertEqual(events, [])
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(events, ["read", "write"])
+        with lock.shared():
+            self.assertRaises(RuntimeError, lambda: lock.exclusive().__enter__())
+
+
+class AsyncFacadeTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tmp = Path(self.tmpdir.name)
+        self.state_path = self.tmp / "state.json"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    async def test_burst_of_mutations_is_one_save(self):
+        lib = await main.AsyncLibraryApp.open(self.state_path)
+        with mock.patch.object(lib.app._backend, "save", wraps=lib.app._backend.save) as save:
+            book = await lib.add_book("Dune", "Frank Herbert", 1965, copies=50)
+            patron = await lib.add_patron("Ann", "ann@example.com")
+            loans = [await lib.checkout_book(book.id, patron.id) for _ in range(30)]
+            await lib.return_many(loan.id for loan in loans[:10])
+            await lib._save_task
+        self.assertEqual(save.call_count, 1)
+        reopened = _open_app(self, state_path=self.state_path)
+        self.assertEqual(reopened.summary()["loans_open"], 20)
+        await lib.close()
+
+    async def test_failed_background_save_is_reported(self):
+        lib = await main.AsyncLibraryApp.open(self.state_path, save_delay=0)
+        with mock.patch.object(lib.app._backend, "save", side_effect=[PersistenceError("disk full"), None]):
+            book = await lib.add_book("Dune", "Frank Herbert", 1965)
+            await lib._save_task
+            with self.assertRaisesRegex(PersistenceError, "disk full"):
+                await lib.flush()
+        await lib.flush()  # reported once
+        with mock.patch.object(lib.app._backend, "save", side_effect=PersistenceError("still full")):
+            await lib.add_patron("Ann", "ann@example.com")
+            await lib._save_task
+            with self.assertRaises(PersistenceError):
+                await lib.close()
+        self.assertIn(book.id, _open_app(self, state_path=self.state_path).books)
+
+    async def test_loop_keeps_serving_during_a_save(self):
+        lib = await main.AsyncLibraryApp.open(self.state_path, save_delay=0)
+        book = await lib.add_book("Dune", "Frank Herbert", 1965, copies=5)
+        patron = await lib.add_patron("Ann", "ann@example.com")
+        await lib._save_task
+        started = threading.Event()
+        real_write = main._atomic_write
+
+        def slow_write(*args):
+            started.set()
+            time.sleep(0.3)
+            real_write(*args)
+
+        with mock.patch.object(main, "_atomic_write", slow_write):
+            saving = asyncio.ensure_future(lib.flush())
+            while not started.is_set():
+                await asyncio.sleep(0.005)
+            begun = time.perf_counter()
+            loan = await lib.checkout_book(book.id, patron.id)
+            self.assertLess(time.perf_counter() - begun, 0.1)
+            self.assertFalse(saving.done())
+            await saving
+        await lib.close()
+        reopened = _open_app(self, state_path=self.state_path)
+        self.assertIn(loan.id, reopened.loans)
+
+    async def test_large_save_holds_up_circulation_only_while_copying(self):
+        books = {str(i): Book(str(i), f"Title {i}", "Auth", 2000, 2, 2).to_dict() for i in range(30000)}
+        patron = Patron("p", "Ann", "ann@example.com")
+        self.state_path.write_text(json.dumps({"books": books, "patrons": {"p": patron.to_dict()}, "loans": {}}),
+                                   encoding="utf-8")
+        lib = await main.AsyncLibraryApp.open(self.state_path)
+        begun = time.perf_counter()
+        saving = asyncio.ensure_future(lib.flush())
+        slowest = 0.0
+        while not saving.done():
+            started = time.perf_counter()
+            loan = await lib.checkout_book("7", patron.id)
+            await lib.return_book(loan.id)
+            slowest = max(slowest, time.perf_counter() - started)
+            await asyncio.sleep(0.002)
+        # the state lock covers the copy of field tuples, not building and encoding the records
+        self.assertLess(slowest, (time.perf_counter() - begun) / 4)
+        await lib.close()
+
+    async def test_journaled_mutations_run_off_the_loop(self):
+        lib = await main.AsyncLibraryApp.open(self.state_path, journal=True)
+        loop_thread = threading.get_ident()
+        real_commit = lib.app._backend.commit
+        threads = []
+
+        def commit(records):
+            threads.append(threading.get_ident())
+            real_commit(records)
+
+        with mock.patch.object(lib.app._backend, "commit", commit):
+            book = await lib.add_book("Dune", "Frank Herbert", 1965)
+            patron = await lib.add_patron("Ann", "ann@example.com")
+            await lib.return_book((await lib.checkout_book(book.id, patron.id)).id)
+        self.assertEqual(len(threads), 4)
+        self.assertNotIn(loop_thread, threads)
+        await lib.close()
+
+    async def test_import_and_export_run_off_the_loop(self):
+        csv_path = self.tmp / "books.csv"
+        csv_path.write_text("title,author,year,copies\nDune,Frank Herbert,1965,2\nEmma,Jane Austen,1815,1\n",
+                            encoding="utf-8")
+        lib = await main.AsyncLibraryApp.open(self.state_path, journal=True)
+        report = await lib.import_books(csv_path)
+        self.assertEqual(len(report.books), 2)
+        self.assertEqual(len(await lib.search("dune")), 1)
+        self.assertEqual(await lib.export_csv("books", self.tmp / "out.csv.gz"), 2)
+        await lib.close()
+        with gzip.open(self.tmp / "out.csv.gz", "rt", encoding="utf-8") as f:
+            self.assertEqual(len(list(csv.DictReader(f))), 2)
+        with self.assertRaises(ValueError):
+            main.AsyncLibraryApp(_open_app(self, state_path=self.tmp / "other.json"))
+
+
+class ServerTests(unittest.TestCase):
+    def setUp(self):
+        import server
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state_path = Path(self.tmpdir.name) / "state.json"
+        self.app = server.make_app(self.state_path, group_commit_window=0.05)
+        self.server = server.LibraryServer(("127.0.0.1", 0), self.app)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.conn = self.connect()
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.app.close()
+        self.tmpdir.cleanup()
+
+    def connect(self):
+        return http.client.HTTPConnection(*self.server.server_address, timeout=10)
+
+    def call(self, method, path, body=None, conn=None):
+        conn = conn or self.conn
+        conn.request(method, path, json.dumps(body) if body is not None else None)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+
+    def test_circulation_over_one_kept_alive_connection(self):
+        status, book = self.call("POST", "/books", {"title": "The Hobbit", "author": "Tolkien", "year": 1937,
+                                                    "copies": 2})
+        self.assertEqual(status, 201)
+        sock = self.conn.sock
+        _, patron = self.call("POST", "/patrons", {"name": "Ann", "email": "ann@example.com"})
+        status, loan = self.call("POST", "/loans", {"book_id": book["id"], "patron_id": patron["id"]})
+        self.assertEqual(status, 201)
+        self.assertEqual(self.call("GET", f"/loans/{loan['id']}"), (200, loan))
+        self.assertEqual(self.call("GET", f"/books/{book['id']}")[1]["copies_available"], 1)
+        self.assertEqual([l["id"] for l in self.call("GET", f"/patrons/{patron['id']}/loans")[1]], [loan["id"]])
+        self.assertEqual([b["id"] for b in self.call("GET", "/search?q=hobit&fuzzy=1")[1]], [book["id"]])
+        status, batch = self.call("POST", "/loans/batch", {"items": [{"book_id": book["id"],
+                                                                      "patron_id": patron["id"]}] * 2})
+        self.assertEqual(status, 409)
+        self.assertEqual(batch["errors"], {"1": "No copies available"})
+        self.assertEqual(self.call("POST", f"/loans/{loan['id']}/return")[0], 200)
+        self.assertEqual(self.call("POST", f"/loans/{loan['id']}/return")[0], 409)
+        self.assertEqual(self.call("POST", "/returns", {"loan_ids": ["nope"], "atomic": False})[1]["errors"],
+                         {"0": "Loan not found"})
+        self.assertEqual(self.call("GET", "/summary")[1]["loans_total"], 1)
+        self.assertIs(self.conn.sock, sock)
+        # acknowledged mutations are already durable
+        reopened = LibraryApp(state_path=self.state_path, journal=True)
+        self.assertEqual(reopened.summary()["loans_total"], 1)
+        reopened.close()
+
+    def test_bad_requests(self):
+        self.assertEqual(self.call("GET", "/books/missing")[0], 404)
+        self.assertEqual(self.call("GET", "/nowhere")[0], 404)
+        self.assertEqual(self.call("POST", "/loans", {"book_id": "x"}), (400, {"error": "Missing field: patron_id"}))
+        self.assertEqual(self.call("POST", "/loans", {"book_id": "x", "patron_id": "y"})[0], 404)
+        self.conn.request("POST", "/books", "{not json")
+        response = self.conn.getresponse()
+        self.assertEqual((response.status, json.loads(response.read())["error"]), (400, "Request body is not valid JSON"))
+        for length in ("ten", "-1"):
+            conn = self.connect()
+            conn.putrequest("POST", "/books")
+            conn.putheader("Content-Length", length)
+            conn.endheaders()
+            response = conn.getresponse()
+            self.assertEqual((response.status, json.loads(response.read())),
+                             (400, {"error": "Content-Length must be a whole number"}), length)
+            conn.close()
+        self.assertEqual(self.call("GET", "/loans/missing"), (404, {"error": "Loan not found"}))
+
+    def test_wrongly_typed_bodies_are_rejected(self):
+        _, book = self.call("POST", "/books", {"title": "Dune", "author": "Herbert", "year": None})
+        cases = [
+            ("/books", {"title": "Dune", "author": "Herbert", "copies": "2"}, "copies must be an integer"),
+            ("/books", {"title": "Dune", "author": "Herbert", "copies": 0}, "copies must be a positive integer"),
+            ("/books", {"title": "Dune", "author": "Herbert", "year": True}, "year must be an integer or null"),
+            ("/books", {"title": ["x"], "author": None}, "title must be a string"),
+            ("/patrons", {"name": "Ann", "email": 7}, "email must be a string"),
+            ("/loans", {"book_id": 1, "patron_id": "p"}, "book_id must be a string"),
+            ("/loans/batch", {"items": {"book_id": "b"}}, "items must be a list"),
+            ("/loans/batch", {"items": ["b"]}, "Each item must be a JSON object"),
+            ("/returns", {"loan_ids": "abc"}, "loan_ids must be a list"),
+            ("/returns", {"loan_ids": [1]}, "loan_ids must be a list of strings"),
+            ("/returns", {"loan_ids": [], "atomic": "no"}, "atomic must be true or false"),
+        ]
+        for path, body, error in cases:
+            self.assertEqual(self.call("POST", path, body), (400, {"error": error}), body)
+        summary = self.call("GET", "/summary")
+        self.assertEqual((summary[0], summary[1]["books_total"], summary[1]["copies_total"]), (200, 1, 1))
+        self.assertEqual(self.call("GET", f"/books/{book['id']}")[1]["year"], None)
+
+    def test_concurrent_mutations_share_saves(self):
+        _, book = self.call("POST", "/books", {"title": "Dune", "author": "Herbert", "year": 1965, "copies": 100})
+        _, patron = self.call("POST", "/patrons", {"name": "Ann", "email": "ann@example.com"})
+        terminals = 12
+        ready = threading.Barrier(terminals)
+        statuses = []
+
+        def terminal():
+            conn = self.connect()
+            ready.wait()
+            statuses.append(self.call("POST", "/loans", {"book_id": book["id"], "patron_id": patron["id"]}, conn)[0])
+            conn.close()
+
+        with mock.patch.object(self.app._backend, "save", wraps=self.app._backend.save) as save:
+            threads = [threading.Thread(target=terminal) for _ in range(terminals)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(statuses, [201] * terminals)
+        self.assertLess(save.call_count, terminals / 2)
+        self.assertEqual(self.app.books[book["id"]].copies_available, 100 - terminals)
+
+
+class CliTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tmp = Path(self.tmpdir.name)
+        self.state_path = self.tmp / "state.json"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def run_cli(self, *args):
+        out, err = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            code = main.main(["--state", str(self.state_path), *args])
+        return code, [json.loads(line) for line in out.getvalue().splitlines()], err.getvalue()
+
+    def test_single_commands(self):
+        code, (book,), _ = self.run_cli("add-book", "Dune", "Frank Herbert", "--year", "1965", "--copies", "2")
+        self.assertEqual((code, book["year"], book["copies_total"]), (0, 1965, 2))
+        _, (patron,), _ = self.run_cli("add-patron", "Ann", "ann@example.com")
+        _, (loan,), _ = self.run_cli("checkout", book["id"], patron["id"])
+        self.assertEqual(self.run_cli("return", "missing"), (1, [], "error: Loan not found\n"))
+        self.assertEqual(self.run_cli("summary")[1][0]["loans_open"], 1)
+        self.assertEqual(self.run_cli("return", loan["id"])[0], 0)
+        self.assertEqual(self.run_cli("export", str(self.tmp / "loans.csv"), "--table", "loans")[1], [{"rows": 1}])
+        with (self.tmp / "loans.csv").open(encoding="utf-8") as f:
+            self.assertIsNotNone(next(csv.DictReader(f))["return_date"])
+
+    def test_journal_is_refused_with_sqlite(self):
+        with self.assertRaises(SystemExit) as raised:
+            self.run_cli("--backend", "sqlite", "--journal", "summary")
+        self.assertEqual(raised.exception.code, 2)
+        self.assertFalse(self.state_path.exists())
+
+    def test_batch_file_loads_and_saves_once(self):
+        app = _open_app(self, state_path=self.state_path)
+        book = app.add_book("Dune", "Frank Herbert", 1965, copies=2)
+        patron = app.add_patron("Ann", "ann@example.com")
+        app.save_state()
+        csv_path = self.tmp / "books.csv"
+        csv_path.write_text("title,author,year,copies\nEmma,Jane Austen,1815,1\n", encoding="utf-8")
+        commands = [{"cmd": "checkout", "book_id": book.id, "patron_id": patron.id}] * 3 + [
+            {"cmd": "import", "path": str(csv_path)},
+            {"cmd": "add-patron", "name": "Bob"},
+            {"cmd": "nope"},
+            {"cmd": "summary"},
+        ]
+        batch = self.tmp / "nightly.jsonl"
+        batch.write_text("# nightly run\n" + "".join(json.dumps(c) + "\n" for c in commands), encoding="utf-8")
+        save = mock.patch.object(LibraryApp, "save_state", autospec=True, side_effect=LibraryApp.save_state)
+        load = mock.patch.object(LibraryApp, "_load_state_if_exists", autospec=True,
+                                 side_effect=LibraryApp._load_state_if_exists)
+        with save as saves, load as loads:
+            code, results, errors = self.run_cli("batch", "--keep-going", str(batch))
+        self.assertEqual((loads.call_count, saves.call_count), (1, 1))
+        self.assertEqual(code, 1)
+        self.assertEqual(errors.splitlines()[0], "line 4: No copies available")
+        self.assertEqual(len(errors.splitlines()), 3)
+        self.assertEqual(results[-1]["books_total"], 2)
+        self.assertEqual(_open_app(self, state_path=self.state_path).summary()["loans_open"], 2)
+        # without --keep-going the run stops at the first failure but keeps what came before
+        batch.write_text(json.dumps({"cmd": "add-patron", "name": "Cy", "email": "c@example.com"}) + "\n"
+                         + json.dumps({"cmd": "checkout", "book_id": book.id, "patron_id": patron.id}) + "\n"
+                         + json.dumps({"cmd": "summary"}) + "\n", encoding="utf-8")
+        code, results, errors = self.run_cli("batch", str(batch))
+        self.assertEqual((code, len(results), errors), (1, 1, "line 2: No copies available\n"))
+        self.assertEqual(_open_app(self, state_path=self.state_path).summary()["patrons_total"], 2)
+
+
+    def test_batch_arguments_are_checked_and_errors_reported_truthfully(self):
+        csv_path = self.tmp / "books.csv"
+        csv_path.write_text("title,author\nEmma,Jane Austen\n", encoding="utf-8")
+        commands = [
+            {"cmd": "add-book", "title": "Dune", "author": "Herbert", "copies": "3"},
+            {"cmd": "add-book", "title": "Dune", "author": "Herbert", "year": True},
+            {"cmd": "add-book", "title": "Dune", "author": "Herbert", "copies": 0},
+            {"cmd": "add-book", "title": "Dune"},
+            {"cmd": "add-patron", "name": "Ann", "email": "a@example.com", "phone": "1"},
+            {"cmd": "import", "path": str(csv_path), "profile": "nope"},
+            {"author": "no command"},
+            {"cmd": "add-book", "title": "Dune", "author": "Herbert", "year": 1965, "copies": 2},
+            {"cmd": "summary"},
+        ]
+        batch = self.tmp / "bad.jsonl"
+        batch.write_text("".join(json.dumps(c) + "\n" for c in commands), encoding="utf-8")
+        with mock.patch.object(LibraryApp, "summary", side_effect=RuntimeError("boom")):
+            code, results, errors = self.run_cli("batch", "--keep-going", str(batch))
+        self.assertEqual(code, 1)
+        self.assertEqual(errors.splitlines(), [
+            "line 1: add-book: copies must be an integer",
+            "line 2: add-book: year must be an integer or null",
+            "line 3: copies must be a positive integer",
+            "line 4: add-book: missing argument(s) author",
+            "line 5: add-patron: unknown argument(s) phone",
+            "line 6: Unknown import profile: 'nope'",
+            "line 7: unknown or missing command: None",
+            "line 9: RuntimeError: boom",
+        ])
+        self.assertEqual(len(results), 1)
+        # the one good command was saved, and nothing broken was
+        code, (summary,), _ = self.run_cli("summary")
+        self.assertEqual((code, summary["books_total"], summary["copies_total"]), (0, 1, 2))
+
 class SystemTests(unittest.TestCase):
     def setUp(self):
         self.tmpdir = tempfile.TemporaryDirectory()
         self.tmpdir_path = Path(self.tmpdir.name)
         self.state_path = self.tmpdir_path / "system_state.json"
-        self.app = LibraryApp(state_path=self.state_path)
+        self.app = _open_app(self, state_path=self.state_path)
         # create a sample CSV for import
         self.sample_csv = self.tmpdir_path / "sample_books.csv"
         with self.sample_csv.open("w", encoding="utf-8", newline="") as f:
@@ -111,7 +1644,7 @@ class SystemTests(unittest.TestCase):
         self.app.save_state(self.state_path)
         self.assertTrue(self.state_path.exists())
         # load into new app
-        app2 = LibraryApp(state_path=self.state_path)
+        app2 = _open_app(self, state_path=self.state_path)
         self.assertIn(book.id, app2.books)
         self.assertIn(patron.id, app2.patrons)
         # ensure loans persisted